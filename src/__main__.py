@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 # I ought to clean these imports up a bit.
-import socket, datetime, time, sys, threading, random, subprocess, os, json, signal, traceback, ConfigParser, ast, proxy, web, globals, storage, hashlib, cProfile
+import socket, datetime, time, sys, threading, random, subprocess, os, json, signal, traceback, ConfigParser, ast, proxy, web, globals, storage, hashlib, cProfile, metrics
 from log import *
 from config import Config
 from irc import IRC
-from server import Server
+from server import Server, COMMAND_ADMIN
 from importlib import import_module
 from scripts import Scripts
 from api import API
@@ -31,9 +31,11 @@ class Wrapper:
 		self.update = False
 		self.storage = storage.Storage("main", self.log)
 		self.permissions = storage.Storage("permissions", self.log)
+		self.metrics = metrics.Metrics()
 		
 		self.commands = {}
 		self.events = {}
+		self.consolePatterns = {} # plugin ID -> [(event, compiled regex)], see api.registerConsolePattern
 		self.permission = {}
 		self.help = {}
 	def loadPlugin(self, i):
@@ -82,6 +84,7 @@ class Wrapper:
 		del self.commands[plugin]
 		del self.events[plugin]
 		del self.help[plugin]
+		if plugin in self.consolePatterns: del self.consolePatterns[plugin]
 		try:
 			self.plugins[plugin]["main"].onDisable()
 		except:
@@ -633,7 +636,7 @@ class Wrapper:
 			if len(input) < 1: continue
 			if input[0] is not "/": 
 				try:
-					self.server.console(input)
+					self.server.console(input, COMMAND_ADMIN)
 				except:
 					break
 				continue
@@ -680,7 +683,7 @@ class Wrapper:
 			elif command == "raw":
 				if self.server.state in (1, 2, 3):
 					if len(argsAfter(1)) > 0:
-						self.server.console(argsAfter(1))
+						self.server.console(argsAfter(1), COMMAND_ADMIN)
 					else:
 						self.log.info("Usage: /raw [command]")
 				else:
@@ -695,6 +698,26 @@ class Wrapper:
 					self.server.unfreeze()
 				else:
 					self.log.error("Server is not started. Please run `/start` to boot it up.")	
+			elif command in ("ban-ip", "allow-ip", "pardon-ip", "import-bans"):
+				if not self.proxy:
+					self.log.error("IP bans are enforced by the proxy, which isn't running")
+				elif args(1) == None:
+					self.log.info("Usage: /ban-ip|/allow-ip <address or CIDR range> [reason], /pardon-ip <address or CIDR range>, /import-bans <file>")
+				else:
+					try:
+						if command == "ban-ip":
+							self.log.info("Banned %s" % self.proxy.banAddress(args(1), argsAfter(2) or "Banned by an operator"))
+						elif command == "allow-ip":
+							self.log.info("Exempted %s from IP bans" % self.proxy.allowAddress(args(1), argsAfter(2) or "Allowed by an operator"))
+						elif command == "pardon-ip":
+							if self.proxy.pardonAddress(args(1)): self.log.info("Removed the ban or exemption for %s" % args(1))
+							else: self.log.error("%s isn't banned or exempted (ranges must be pardoned exactly as they were banned)" % args(1))
+						else:
+							self.log.info("Imported %d addresses and ranges from %s" % (self.proxy.importAddressBans(argsAfter(1)), argsAfter(1)))
+					except ValueError as e:
+						self.log.error(str(e))
+					except IOError as e:
+						self.log.error("Could not read ban list: %s" % e)
 			elif command == "help":
 				self.log.info("/reload - Reload plugins")	
 				self.log.info("/plugins - Lists plugins")	
@@ -704,6 +727,7 @@ class Wrapper:
 				self.log.info("/halt - Shutdown Wrapper.py completely")
 				self.log.info("/freeze & /unfreeze - Temporarily locks the server up until /unfreeze is executed")
 				self.log.info("/mem - Get memory usage of the server")
+				self.log.info("/ban-ip, /allow-ip & /pardon-ip [address or CIDR range] - Manage the proxy's IP bans. /import-bans [file] bans everything in a ban list")
 				self.log.info("/raw [command] - Send command to the Minecraft Server. Useful for Forge commands like `/fml confirm`.")
 				self.log.info("Wrapper.py Version %s" % self.getBuildString())
 			else:
@@ -721,7 +745,7 @@ if __name__ == "__main__":
 		wrapper.disablePlugins()
 		wrapper.halt = True
 		try:
-			wrapper.server.console("save-all")
+			wrapper.server.console("save-all", COMMAND_ADMIN)
 			wrapper.server.stop("Wrapper.py received shutdown signal - bye", save=False)
 		except:
 			pass
@@ -1,4 +1,4 @@
-import json, time, nbt, items, storage
+import json, time, nbt, items, storage, re
 from api.player import Player
 from api.minecraft import Minecraft
 """ api.py contains the majority of code for the plugin API. """
@@ -81,6 +81,12 @@ class API:
 			self.wrapper.log.debug("[%s] Registered event '%s'" % (self.name, eventType))
 		if self.id not in self.wrapper.events: self.wrapper.events[self.id] = {}
 		self.wrapper.events[self.id][eventType] = callback
+	def registerConsolePattern(self, eventType, pattern):
+		""" Calls the event eventType whenever a server console message matches pattern (a regular expression, searched for in the message after the timestamp and thread prefix). Register a callback for eventType with registerEvent as usual. The payload holds the pattern's named groups, plus 'message' (the message), 'line' (the whole console line) and 'flavour' ('vanilla', 'forge', 'spigot' or 'legacy'). """
+		if not self.internal:
+			self.wrapper.log.debug("[%s] Registered console pattern for event '%s'" % (self.name, eventType))
+		if self.id not in self.wrapper.consolePatterns: self.wrapper.consolePatterns[self.id] = []
+		self.wrapper.consolePatterns[self.id].append((eventType, re.compile(pattern)))
 	def registerPermission(self, permission=None, value=False):
 		""" Used to set a default for a specific permission node. 
 		
@@ -21,10 +21,13 @@ class Minecraft:
 				except:
 					print traceback.format_exc()
 		return players
-	def console(self, string):
-		""" Run a command in the Minecraft server's console. """
+	def console(self, string, bulk=False):
+		""" Run a command in the Minecraft server's console. Pass bulk=True when sending many commands at once, so they queue up behind
+		everything else instead of delaying other plugins' and the operators' commands. """
+		import server # not at the top: server.py imports the api
 		try:
-			self.getServer().console(string)
+			if bulk: self.getServer().console(string, server.COMMAND_BULK)
+			else: self.getServer().console(string)
 		except:
 			pass
 	def setBlock(self, x, y, z, tileName, dataValue=0, oldBlockHandling="replace", dataTag={}):
@@ -92,17 +95,57 @@ class Minecraft:
 	def getTime(self):
 		""" Returns the time of the world in ticks. """
 		return int(str(self.getLevelInfo()["Time"]))
-	#def getBlock(self, x, y, z):
-#		""" UNIMPLEMENTED FUNCTION. """
-#		# this function doesn't really work well yet
-#		self.console("testforblock %d %d %d air" % (x, y, z))
-#		while True:
-#			event = self.api.blockForEvent("server.consoleMessage")
-#			def args(i):
-#				try: return event["message"].split(" ")[i]
-#				except: return ""
-#			if args(3) == "The" and args(4) == "block" and args(6) == "%d,%d,%d" % (x, y, z):
-#				return {"block": args(8)}
+	def query(self, command, matcher, timeout=5, follow=0):
+		""" Runs a console command and returns a future-like query object for its reply. 'matcher' is a regular expression (or a function that
+		takes a console line and returns something true) that picks out the reply; 'follow' is how many more lines to take after it. Call
+		.result() on the query to wait for the reply's lines, or .addCallback(function) to be called with the query when it's in. Concurrent
+		queries are matched to replies in the order their commands were sent, so put anything specific to the command in the matcher.
+		Don't call .result() from a console event handler (server.consoleMessage, player.message, etc.): those run on the thread that reads
+		the reply, so result() raises queries.QueryTimeout there instead of waiting forever. Use .addCallback() in handlers. """
+		return self.getServer().query(command, matcher, timeout, follow)
+	def getBlock(self, x, y, z, timeout=5):
+		""" Returns the display name of the block at x, y, z (as the server prints it, e.g. 'Stone'), or 'Air'. Blocks until the server
+		answers, and raises queries.QueryTimeout if it doesn't within the timeout - or right away when called from a console event handler,
+		which runs on the thread that would read the answer. Use query() with addCallback() there. """
+		position = "%d,%d,%d" % (x, y, z)
+		query = self.query("testforblock %d %d %d minecraft:air" % (x, y, z),
+			r"^(?:Successfully found the block at %s\.|The block at %s is (?P<block>.*) \(expected: .*\)\.)$" % (position, position), timeout)
+		query.result()
+		return query.match.group("block") or "Air"
+	def getServerStatus(self, backend="local"):
+		""" Returns the proxy's cached status snapshot of a backend server (version, protocol, players, maxPlayers, motd, latency in seconds, online, time), or None if proxy mode is off or it hasn't been polled yet. Never touches the network. """
+		if not self.wrapper.proxy: return None
+		return self.wrapper.proxy.getStatus(backend)
+	def getPacketStats(self):
+		""" Returns the proxy's packet counters since startup, or None if proxy mode is off. Keyed by direction ('clientbound'/'serverbound'), then
+		packet ID: received/sent packet counts, wireIn/wireOut (bytes on the wire, compressed), bytesIn/bytesOut (uncompressed), and decodeTime and
+		handlerTime in seconds. 'queueTime' has a histogram per direction of how long packets sat in the proxy's send queues. """
+		if not self.wrapper.proxy: return None
+		return self.wrapper.proxy.getPacketStats()
+	def getTickStats(self):
+		""" Returns the server's tick health estimate: 'tps' (a dict of estimated ticks per second over the last '1m', '5m' and '15m'), and for the last minute 'warnings' (Can't keep up! lines), 'skipped' ticks, 'behind' (the most ms behind), 'probeLatency' and 'probeLatencyMax' (lag probe reply times in seconds, if probes are on), plus 'lagging'. The server.lag event carries the same dict when 'lagging' changes. """
+		return self.getServer().getTickStats()
+	def getResourceUsage(self):
+		""" Returns the server process' latest resource sample: rss (bytes), cpu (seconds used), cpuPercent (100 is one core), threads, readBytes, writeBytes, fds and time. Fields /proc doesn't give us are None, and so is the whole thing if the server isn't running or this isn't Linux. """
+		return self.getServer().getResourceUsage()
+	def getResourceHistory(self, since=None, points=None):
+		""" Returns a list of resource samples (as in getResourceUsage), oldest first. 'since' keeps only samples taken after that timestamp, and 'points' downsamples longer histories to that many samples. """
+		return self.getServer().getResourceHistory(since, points)
+	def banAddress(self, network, reason="Banned by an operator", source="Server"):
+		""" Bans an IP address or CIDR range (1.2.3.4, 1.2.3.0/24, 2001:db8::/32) from connecting through the proxy. Raises ValueError for anything that isn't an address or range. Returns the range as stored, or None if proxy mode is off. """
+		if not self.wrapper.proxy: return None
+		return self.wrapper.proxy.banAddress(network, reason, source)
+	def allowAddress(self, network, reason="Allowed by an operator", source="Server"):
+		""" Exempts an address or range from wider banned ranges. The most specific range wins, so allowing 10.1.2.3 inside a banned 10.0.0.0/8 lets just that address in. """
+		if not self.wrapper.proxy: return None
+		return self.wrapper.proxy.allowAddress(network, reason, source)
+	def pardonAddress(self, network):
+		""" Removes the ban or exemption for exactly this address or range. Returns False if there wasn't one. """
+		if not self.wrapper.proxy: return False
+		return self.wrapper.proxy.pardonAddress(network)
+	def isAddressBanned(self, address):
+		if not self.wrapper.proxy: return False
+		return self.wrapper.proxy.isAddressBanned(address)
 	def getServer(self):
 		""" Returns the server context. """
 		return self.wrapper.server
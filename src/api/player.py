@@ -18,6 +18,8 @@ class Player:
 					self.client = client
 					self.uuid = client.uuid
 					break
+			if username in self.wrapper.proxy.remoteClients: # client is handled by a proxy worker process
+				self.uuid = self.wrapper.proxy.remoteClients[username]["uuid"]
 		
 		self.data = storage.Storage(self.uuid, root="wrapper-data/players")
 		if not "firstLoggedIn" in self.data: self.data["firstLoggedIn"] = (time.time(), time.tzname)
@@ -52,9 +54,10 @@ class Player:
 		self.client.message(string)
 	def getClient(self):
 		if self.client == None:
+			if not self.wrapper.proxy: return None
 			for client in self.wrapper.proxy.clients:
 				try:
-					if client.username == username:
+					if client.username == self.username:
 						self.client = client
 						return self.client
 				except:
@@ -91,10 +94,15 @@ class Player:
 		return False
 	# Visual notifications
 	def message(self, message=""):
+		""" Sends a chat message (a JSON chat object, or a string with &-prefixed formatting codes) to the player. In proxy mode it goes straight into the player's connection; otherwise it's a tellraw. """
 		if isinstance(message, dict):
-			self.wrapper.server.console("tellraw %s %s" % (self.username, json.dumps(message)))
+			message = json.dumps(message)
 		else:
-			self.wrapper.server.console("tellraw %s %s" % (self.username, self.wrapper.server.processColorCodes(message)))
+			message = self.wrapper.server.processColorCodes(message)
+		if self.wrapper.proxy and self.wrapper.config["Proxy"]["direct-chat"]:
+			client = self.getClient()
+			if client and client.sendChat(message): return
+		self.wrapper.server.console("tellraw %s %s" % (self.username, message))
 	def actionMessage(self, message=""):
 		if self.getClient().version > 10:
 			self.getClient().send(0x02, "string|byte", (json.dumps({"text": self.processColorCodesOld(message)}), 2))
@@ -124,6 +132,27 @@ class Player:
 	def getHeldItem(self):
 		""" Returns the item object of an item currently being held. """
 		return self.getClient().inventory[36 + self.getClient().slot]
+	def getInventory(self):
+		""" Returns the player's inventory as mirrored by the proxy: 'slots' (slot number -> item dict or None, using the protocol's window 0 numbering), 'cursor' (the item being dragged), 'held' (selected hotbar slot), 'window' (the open container, see getOpenWindow) and 'stale' (True while a shift-click or drag hasn't been confirmed by the server yet). Item dicts have id, count, damage and nbt - call item["nbt"].decode() for the NBT compound. Proxy mode only. """
+		return self.getClient().playerInventory.toDict()
+	def getCursorItem(self):
+		""" Returns the item the player is carrying on their cursor in an inventory window, or None. Proxy mode only. """
+		return self.getClient().playerInventory.cursor
+	def getOpenWindow(self):
+		""" Returns the container the player has open (chest, furnace, etc.) as a dict with id, type, title, size, slots and properties, or None if they don't have one open. Proxy mode only. """
+		return self.getClient().playerInventory.getWindow()
+	def getArmor(self):
+		""" Returns the helmet, chestplate, leggings and boots the player is wearing, as a list of item dicts (None for empty slots). Proxy mode only. """
+		return self.getClient().playerInventory.getArmor()
+	def findItems(self, id, damage=None):
+		""" Returns the inventory slot numbers holding the given item ID (and damage value, if specified). Proxy mode only. """
+		return self.getClient().playerInventory.findItems(id, damage)
+	def countItem(self, id, damage=None):
+		""" Returns how many of the given item ID (and damage value, if specified) the player has in their inventory. Proxy mode only. """
+		return self.getClient().playerInventory.countItem(id, damage)
+	def getBandwidthStats(self):
+		""" Returns the proxy's traffic accounting for this player: bytesSent/bytesReceived totals, the number of packets still queued, and [packets, bytes] per packet ID under 'sent' and 'received'. Proxy mode only. """
+		return self.getClient().packet.getStats()
 	# Permissions-related
 	def hasPermission(self, node):
 		""" If the player has the specified permission node (either directly, or inherited from a group that the player is in), it will return the value (usually True) of the node. Otherwise, it returns False. """
@@ -163,4 +192,16 @@ class Player:
 	# Cross-server commands
 	def connect(self, ip, address):
 		""" Upon calling, the player object will become defunct and the client will be transferred to another server (provided it has offline-mode turned on). """
-		self.client.connect(ip, address)
\ No newline at end of file
+		self.client.connect(ip, address)
+	def connectBackend(self, name):
+		""" Transfer the player to a backend listed in the [Backends] section of wrapper.properties, by name. """
+		backends = self.wrapper.proxy.backends.getBackends()
+		if name not in backends:
+			raise Exception("No such backend '%s'" % name)
+		if name == "local":
+			if self.client.server: self.client.server.close(kill_client=False)
+			self.client.isLocal = True
+			self.client.connect()
+		else:
+			ip, port = backends[name]
+			self.client.connect(ip, port)
\ No newline at end of file
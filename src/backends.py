@@ -0,0 +1,116 @@
+# Backend pool for proxy mode. Lets one proxy front several local servers (e.g. a handful of lobbies) and decides which one a player lands on.
+import socket, threading, time, traceback
+class Backends:
+	def __init__(self, proxy):
+		self.proxy = proxy
+		self.wrapper = proxy.wrapper
+		self.config = proxy.wrapper.config
+		self.log = proxy.wrapper.log
+		self.idle = {} # (host, port) -> list of (socket, openedAt) that are connected but haven't sent a handshake yet
+		self.lock = threading.Lock()
+	def isEnabled(self):
+		return self.config["Backends"]["backends-enabled"]
+	def getBackends(self):
+		""" Returns a dict of backend name -> (host, port). The wrapper-managed server is always called 'local'. """
+		backends = {}
+		if self.config["Backends"]["include-local"] or not self.isEnabled():
+			backends["local"] = ("localhost", self.config["Proxy"]["server-port"])
+		if self.isEnabled():
+			for name in self.config["Backends"]["backends"]:
+				host, port = self.config["Backends"]["backends"][name]
+				backends[name] = (host, port)
+		return backends
+	def getAlive(self):
+		""" Names of the backends in rotation, sorted. """
+		return sorted(name for name in self.getBackends() if self.isAlive(name))
+	def isAlive(self, name):
+		""" A backend is in rotation as long as its last status poll succeeded. """
+		status = self.proxy.getStatus(name)
+		if status == None: return False
+		return status["online"]
+	def getPlayerCount(self, name):
+		count = 0
+		for client in self.proxy.clients:
+			if client.backend == name and not client.abort: count += 1
+		status = self.proxy.getStatus(name)
+		if status and status["players"] > count: return status["players"]
+		return count
+	def choose(self, client):
+		""" Pick a backend name for a joining client according to routing-policy. Falls back to 'local' if nothing is alive, or returns None
+		when 'local' isn't one of the backends either. """
+		alive = self.getAlive()
+		if len(alive) == 0:
+			if "local" in self.getBackends(): return "local"
+			return None
+		policy = self.config["Backends"]["routing-policy"]
+		if policy == "sticky": # the UUID's entry is written by remember() once the connection is up
+			name = self.proxy.getStickyBackend(client.uuid)
+			if name in alive: return name
+			return min(alive, key=self.getPlayerCount)
+		if policy == "lowest-latency":
+			return min(alive, key=lambda name: self.proxy.getStatus(name)["latency"])
+		return min(alive, key=self.getPlayerCount) # least-players
+	def remember(self, client):
+		""" Records the backend a client is now connected to for the sticky policy. Called on every successful connect, so a player moved with
+		connectBackend comes back to the backend they left from. """
+		if not self.config["Backends"]["routing-policy"] == "sticky" or client.uuid == None or client.backend == None: return
+		self.proxy.setStickyBackend(client.uuid, client.backend)
+	def route(self, client):
+		""" Returns (ip, port) for Client.connect(). (None, None) means the wrapper-managed server, None that there's nowhere to send the client. """
+		name = self.choose(client)
+		client.backend = name
+		if name == None:
+			self.log.warn("No backend is available for %s" % client.username)
+			return None
+		if name == "local": return (None, None)
+		self.log.debug("Routing %s to backend '%s'" % (client.username, name))
+		return self.getBackends()[name]
+	def getNameByAddress(self, host, port):
+		backends = self.getBackends()
+		for name in backends:
+			if backends[name] == (host, port): return name
+		return None
+	def getConnection(self, host, port):
+		""" Returns a connected socket to host:port, taking a pre-opened one from the pool when possible. """
+		with self.lock:
+			pool = self.idle.get((host, port), [])
+			while len(pool) > 0:
+				sock, openedAt = pool.pop()
+				if time.time() - openedAt < self.config["Backends"]["pool-max-idle"]:
+					self.wrapper.metrics.increment("proxy.backend_pool_hits")
+					return sock
+				try: sock.close()
+				except: pass
+		self.wrapper.metrics.increment("proxy.backend_pool_misses")
+		sock = socket.socket()
+		sock.connect((host, port))
+		return sock
+	def replenish(self):
+		""" Keeps pool-size idle connections open to every live backend. Servers drop connections that never handshake, so idle sockets are recycled after pool-max-idle seconds. """
+		while not self.wrapper.halt:
+			backends = self.getBackends()
+			for name in backends:
+				address = backends[name]
+				with self.lock:
+					if address not in self.idle: self.idle[address] = []
+					pool = self.idle[address]
+					for i in reversed(range(len(pool))):
+						if time.time() - pool[i][1] >= self.config["Backends"]["pool-max-idle"] or not self.isAlive(name):
+							try: pool[i][0].close()
+							except: pass
+							del pool[i]
+					missing = self.config["Backends"]["pool-size"] - len(pool)
+				if not self.isAlive(name): continue
+				for i in range(missing):
+					try:
+						sock = socket.socket()
+						sock.settimeout(self.config["Proxy"]["status-poll-timeout"])
+						sock.connect(address)
+						sock.settimeout(None)
+					except:
+						self.log.debug("Could not pre-open a connection to backend '%s':" % name)
+						self.log.debug(traceback.format_exc())
+						break
+					with self.lock:
+						self.idle[address].append((sock, time.time()))
+			time.sleep(1)
@@ -46,6 +46,7 @@ class Backups:
 			timestamp = int(time.time())
 			self.console("save-all")
 			self.console("save-off")
+			self.wrapper.server.flushConsole()
 			time.sleep(0.5)
 	
 			if not os.path.exists(str(self.config["Backups"]["backup-location"])):
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# bans.py - IP address bans and exemptions for the proxy, as IPv4/IPv6 CIDR ranges. Ranges live in a path-compressed binary radix tree per address
+# family, so checking an address costs a handful of node hops however many ranges are loaded - cheap enough to run on every accept().
+# The most specific matching range wins: ban 10.0.0.0/8, allow 10.1.2.3, and 10.1.2.3 gets in while the rest of 10.x.x.x doesn't.
+import socket, struct, threading, json
+BAN = "ban"
+ALLOW = "allow"
+def parseAddress(address):
+	""" Returns (bits, integer) for an IPv4 or IPv6 address string. IPv4-mapped IPv6 addresses (::ffff:1.2.3.4) come back as IPv4. """
+	address = address.strip()
+	if "%" in address: address = address.split("%")[0] # link-local zone index
+	if ":" not in address: return 32, parseQuad(address)
+	if "." in address: # trailing dotted quad, as in ::ffff:1.2.3.4
+		head, tail = address.rsplit(":", 1)
+		quad = parseQuad(tail)
+		address = "%s:%x:%x" % (head, quad >> 16, quad & 0xffff)
+	if address.count("::") > 1: invalid(address)
+	if "::" in address:
+		head, tail = address.split("::")
+		head = [group for group in head.split(":") if group]
+		tail = [group for group in tail.split(":") if group]
+		groups = head + ["0"] * (8 - len(head) - len(tail)) + tail
+	else:
+		groups = address.split(":")
+	if not len(groups) == 8: invalid(address)
+	value = 0
+	for group in groups:
+		if len(group) > 4: invalid(address)
+		value = (value << 16) | int(group, 16)
+	if value >> 32 == 0xffff: return 32, value & 0xffffffff
+	return 128, value
+def parseQuad(address):
+	if not address.count(".") == 3: invalid(address) # inet_aton would also take shorthands like "10.1"
+	try: return struct.unpack("!I", socket.inet_aton(address))[0]
+	except socket.error: invalid(address)
+def invalid(address):
+	raise ValueError("'%s' is not an IP address" % address)
+def parseNetwork(network):
+	""" Parses "1.2.3.4", "1.2.3.0/24", "2001:db8::/32" and so on into (bits, prefix, prefix length), with the prefix right-aligned. """
+	network = network.strip()
+	if "/" in network:
+		address, length = network.split("/", 1)
+		length = int(length)
+	else:
+		address, length = network, None
+	bits, value = parseAddress(address)
+	if length == None: length = bits
+	elif bits == 32 and ":" in address: length -= 96 # ::ffff:0:0/96 style prefixes of mapped IPv4
+	if length < 0 or length > bits: raise ValueError("'%s' has an invalid prefix length" % network)
+	return bits, value >> (bits - length), length
+def formatNetwork(bits, prefix, length):
+	""" The canonical string form of a range, used as its storage key. Whole addresses are written without a /32 or /128. """
+	value = prefix << (bits - length) if length else 0
+	if bits == 32: address = socket.inet_ntoa(struct.pack("!I", value))
+	else:
+		groups = ["%x" % ((value >> shift) & 0xffff) for shift in range(112, -16, -16)]
+		best, bestLength, start = None, 1, None # compress the longest run of zero groups (of at least two) to ::
+		for i, group in enumerate(groups + ["end"]):
+			if group == "0":
+				if start == None: start = i
+			elif not start == None:
+				if i - start > bestLength: best, bestLength = start, i - start
+				start = None
+		if best == None: address = ":".join(groups)
+		else: address = ":".join(groups[:best]) + "::" + ":".join(groups[best + bestLength:])
+	if length == bits: return address
+	return "%s/%d" % (address, length)
+def commonPrefix(a, aLength, b, bLength):
+	""" How many leading bits two right-aligned prefixes share. """
+	length = min(aLength, bLength)
+	difference = (a >> (aLength - length)) ^ (b >> (bLength - length))
+	return length - difference.bit_length()
+class RadixTree:
+	""" Binary radix tree with path compression over fixed-width integers. Nodes are lists: [prefix, length, value, child 0, child 1]. Only nodes
+	holding a value or with two children exist, so a tree of n ranges has fewer than 2n nodes and lookups hop at most once per branching point. """
+	def __init__(self, bits):
+		self.bits = bits
+		self.root = [0, 0, None, None, None]
+		self.size = 0
+	def insert(self, prefix, length, value):
+		node = self.root
+		while True:
+			if node[1] == length:
+				if node[2] == None: self.size += 1
+				node[2] = value
+				return
+			bit = (prefix >> (length - node[1] - 1)) & 1
+			child = node[3 + bit]
+			if child == None:
+				node[3 + bit] = [prefix, length, value, None, None]
+				self.size += 1
+				return
+			common = commonPrefix(child[0], child[1], prefix, length)
+			if common == child[1]:
+				node = child
+				continue
+			# the new range and the child part ways (or the new range sits above the child): put a node at the fork. It is fully built
+			# before being linked in, so a lookup on another thread never sees a half-done split
+			fork = [prefix >> (length - common), common, None, None, None]
+			fork[3 + ((child[0] >> (child[1] - common - 1)) & 1)] = child
+			if common == length: fork[2] = value
+			else: fork[3 + ((prefix >> (length - common - 1)) & 1)] = [prefix, length, value, None, None]
+			node[3 + bit] = fork
+			self.size += 1
+			return
+	def remove(self, prefix, length):
+		""" Removes a range, and the node holding it if that node is no longer needed. Returns the removed value, or None. """
+		parent, node = None, self.root
+		while True:
+			if node[1] == length:
+				if not node[0] == prefix: return None
+				break
+			if node[1] > length: return None
+			bit = (prefix >> (length - node[1] - 1)) & 1
+			child = node[3 + bit]
+			if child == None or child[1] > length or not (prefix >> (length - child[1])) == child[0]: return None
+			parent, node = node, child
+		value = node[2]
+		if value == None: return None
+		node[2] = None
+		self.size -= 1
+		if not parent == None and (node[3] == None or node[4] == None):
+			parent[3 + (parent[4] is node)] = node[3] or node[4] # splice out the node (or drop it, if it was a leaf)
+		return value
+	def lookup(self, address):
+		""" The value of the longest range containing the address, or None. """
+		node = self.root
+		best = node[2]
+		bits = self.bits
+		while node[1] < bits:
+			child = node[3 + ((address >> (bits - node[1] - 1)) & 1)]
+			if child == None or not (address >> (bits - child[1])) == child[0]: break
+			node = child
+			if not node[2] == None: best = node[2]
+		return best
+	def __len__(self):
+		return self.size
+class AddressIndex:
+	""" Bans and exemptions for both address families. Values in the trees are (BAN or ALLOW, canonical range string). """
+	def __init__(self):
+		self.trees = {32: RadixTree(32), 128: RadixTree(128)}
+		self.lock = threading.Lock() # writers only; lookups run unlocked on the accept thread
+	def add(self, network, kind=BAN):
+		""" Adds a range and returns its canonical string form. Raises ValueError for anything that isn't an address or range. """
+		bits, prefix, length = parseNetwork(network)
+		key = formatNetwork(bits, prefix, length)
+		with self.lock:
+			self.trees[bits].insert(prefix, length, (kind, key))
+		return key
+	def remove(self, network):
+		bits, prefix, length = parseNetwork(network)
+		with self.lock:
+			return self.trees[bits].remove(prefix, length)
+	def match(self, address):
+		""" Returns the (kind, range) entry that decides the address, or None if no range covers it. """
+		try: bits, value = parseAddress(address)
+		except ValueError: return None
+		return self.trees[bits].lookup(value)
+	def isBanned(self, address):
+		entry = self.match(address)
+		return not entry == None and entry[0] == BAN
+	def clear(self):
+		with self.lock:
+			self.trees = {32: RadixTree(32), 128: RadixTree(128)}
+	def __len__(self):
+		return len(self.trees[32]) + len(self.trees[128])
+def readBanList(path):
+	""" Reads a ban list file and returns its ranges. Understands a vanilla banned-ips.json and plain text lists with one address or CIDR range per
+	line, where anything after a # is a comment (as in most published blocklists). Lines that aren't addresses are skipped. """
+	with open(path, "r") as f:
+		data = f.read()
+	if data.lstrip().startswith("["):
+		return [entry["ip"] for entry in json.loads(data) if "ip" in entry]
+	networks = []
+	for line in data.splitlines():
+		line = line.split("#")[0].split(";")[0].strip()
+		if len(line) < 1: continue
+		network = line.split()[0]
+		try: parseNetwork(network)
+		except ValueError: continue
+		networks.append(network)
+	return networks
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# bot.py - headless Minecraft clients for load-testing the proxy (or a bare server). Bots reuse proxy.Packet, log in offline, walk around, chat and
+# run commands. A Swarm runs hundreds of them from one process and reports join latency, chat round-trip time and bytes per connection.
+# Only the 1.8 protocol (47) is spoken, and the target must be in offline mode (online-mode = False in the [Proxy] section, or in server.properties).
+#
+# Usage: python bot.py <host> <port> <bots> [seconds] [command ...]
+import socket, threading, time, random, sys, json, traceback, uuid
+from proxy import Packet
+import metrics
+class Bot:
+	""" One simulated player. Reading happens on the bot's own thread; walking, chatting and flushing are driven by Swarm.tick(). """
+	def __init__(self, username, host="localhost", port=25565, version=47, swarm=None):
+		self.username = username
+		self.host = host
+		self.port = port
+		self.version = version
+		self.swarm = swarm
+		if swarm: self.metrics = swarm.metrics
+		else: self.metrics = metrics.Metrics()
+
+		self.socket = None
+		self.packet = None
+		self.state = 0 # 0 = not connected, 2 = login, 3 = play
+		self.abort = False
+		self.isServer = False
+		self.error = None
+		self.eid = None
+		self.uuid = None
+
+		self.position = None # set by the server's first Player Position And Look
+		self.spawn = None
+		self.target = None
+		self.yaw = 0.0
+		self.pitch = 0.0
+
+		self.connectTime = None
+		self.joinTime = None # seconds from TCP connect to Join Game
+		self.lastChat = 0
+		self.pendingChats = {} # token -> time sent
+	def connect(self):
+		self.connectTime = time.time()
+		try:
+			self.socket = socket.create_connection((self.host, self.port), 10)
+			self.socket.settimeout(None)
+		except:
+			self.error = "Could not connect: %s" % traceback.format_exc().splitlines()[-1]
+			self.abort = True
+			self.metrics.increment("bot.connect_failures")
+			return False
+		self.packet = Packet(self.socket, self)
+		self.packet.version = self.version
+		self.send = self.packet.send
+		self.read = self.packet.read
+
+		self.send(0x00, "varint|string|ushort|varint", (self.version, self.host, self.port, 2)) # Handshake, next state login
+		self.send(0x00, "string", (self.username,)) # Login Start
+		self.packet.flush()
+		self.state = 2
+
+		t = threading.Thread(target=self.handle, args=())
+		t.daemon = True
+		t.start()
+		return True
+	def close(self, reason=None):
+		if self.abort: return
+		if reason and not self.error: self.error = reason
+		self.abort = True
+		if self.packet: self.packet.close()
+		try: self.socket.close()
+		except: pass
+	def handle(self):
+		while not self.abort:
+			try:
+				id, original = self.packet.grabPacket()
+			except EOFError:
+				self.close("Connection closed by the server")
+				break
+			except:
+				if self.abort: break # we closed the socket ourselves
+				self.close(traceback.format_exc().splitlines()[-1])
+				break
+			try:
+				self.parse(id, original)
+			except:
+				self.close("Error parsing packet %s: %s" % (hex(id), traceback.format_exc().splitlines()[-1]))
+	def parse(self, id, original):
+		if self.state == 2:
+			if id == 0x00: # Disconnect
+				self.close("Kicked during login: %s" % self.read("string:json")["json"])
+			if id == 0x01: # Encryption Request
+				self.close("The server is in online mode; bots can only join offline-mode servers")
+			if id == 0x02: # Login Success
+				data = self.read("string:uuid|string:username")
+				self.uuid = data["uuid"]
+				self.state = 3
+			if id == 0x03: # Set Compression
+				self.packet.compressThreshold = self.read("varint:threshold")["threshold"]
+			return
+		if id == 0x00: # Keep Alive
+			self.send(0x00, "varint", (self.read("varint:id")["id"],))
+		if id == 0x01: # Join Game
+			self.eid = self.read("int:eid")["eid"]
+			self.joinTime = time.time() - self.connectTime
+			self.metrics.observe("bot.join_latency", self.joinTime)
+			self.metrics.increment("bot.joined")
+		if id == 0x02: # Chat Message
+			if len(self.pendingChats) > 0:
+				message = self.read("string:json")["json"]
+				for token in self.pendingChats.keys():
+					if token in message:
+						self.metrics.observe("bot.chat_rtt", time.time() - self.pendingChats.pop(token))
+		if id == 0x08: # Player Position And Look
+			data = self.read("double:x|double:y|double:z|float:yaw|float:pitch|byte:flags")
+			position = [data["x"], data["y"], data["z"]]
+			if self.position:
+				for i in range(3):
+					if data["flags"] & (1 << i): position[i] += self.position[i]
+			self.position = tuple(position)
+			if self.spawn == None: self.spawn = self.position
+			self.target = None
+			self.send(0x06, "double|double|double|float|float|bool", (self.position[0], self.position[1], self.position[2], self.yaw, self.pitch, True))
+		if id == 0x40: # Disconnect
+			self.close("Kicked: %s" % self.read("string:json")["json"])
+		if id == 0x46: # Set Compression
+			self.packet.compressThreshold = self.read("varint:threshold")["threshold"]
+	def chat(self, message):
+		self.send(0x01, "string", (message[:100],))
+	def command(self, command):
+		self.chat("/" + command)
+	def ping(self):
+		""" Says a unique token in chat and times how long it takes to be echoed back, which is the chat round-trip time. """
+		token = uuid.uuid4().hex[:8]
+		if len(self.pendingChats) > 20: self.pendingChats = {} # the server isn't echoing chat (e.g. a plugin cancels it)
+		self.pendingChats[token] = time.time()
+		self.chat("ping %s" % token)
+	def walk(self, speed=0.2, radius=16):
+		""" Takes one step (one tick's worth) towards a random point near spawn. The server corrects us with 0x08 if we walk into something. """
+		if self.position == None: return
+		x, y, z = self.position
+		if self.target == None or (abs(self.target[0] - x) < speed and abs(self.target[1] - z) < speed):
+			self.target = (self.spawn[0] + random.uniform(-radius, radius), self.spawn[2] + random.uniform(-radius, radius))
+		dx, dz = self.target[0] - x, self.target[1] - z
+		distance = (dx * dx + dz * dz) ** 0.5
+		if distance > speed:
+			dx, dz = dx / distance * speed, dz / distance * speed
+		self.position = (x + dx, y, z + dz)
+		self.send(0x04, "double|double|double|bool", (self.position[0], self.position[1], self.position[2], True))
+	def tick(self, walk=True):
+		if self.state == 3 and self.position:
+			if walk: self.walk()
+			else: self.send(0x03, "bool", (True,)) # Player, so the server doesn't think we've timed out
+		self.packet.flush()
+	def getStats(self):
+		return {"username": self.username, "joined": self.joinTime is not None, "joinTime": self.joinTime, "error": self.error,
+			"bytesSent": self.packet.bytesSent if self.packet else 0, "bytesReceived": self.packet.bytesReceived if self.packet else 0}
+class Swarm:
+	""" Spawns and drives a group of bots. All bots share one ticking thread, so a few hundred bots cost a few hundred reader threads plus one. """
+	def __init__(self, host="localhost", port=25565, count=10, prefix="Bot", version=47, joinDelay=0.05, chatInterval=10, commands=[], walk=True):
+		self.host = host
+		self.port = port
+		self.count = count
+		self.prefix = prefix
+		self.version = version
+		self.joinDelay = joinDelay # seconds between bot logins, so we don't trip the server's connection throttle
+		self.chatInterval = chatInterval # seconds between each bot's chat pings / commands, 0 to never chat
+		self.commands = commands
+		self.walkEnabled = walk
+		self.metrics = metrics.Metrics()
+		self.bots = []
+		self.abort = False
+		self.started = None
+	def start(self):
+		self.started = time.time()
+		t = threading.Thread(target=self.tick, args=())
+		t.daemon = True
+		t.start()
+		for i in range(self.count):
+			if self.abort: break
+			bot = Bot("%s%d" % (self.prefix, i), self.host, self.port, self.version, self)
+			self.bots.append(bot)
+			bot.connect()
+			time.sleep(self.joinDelay)
+	def tick(self):
+		while not self.abort:
+			start = time.time()
+			for bot in list(self.bots):
+				if bot.abort or bot.packet == None: continue
+				try:
+					if self.chatInterval > 0 and bot.state == 3 and bot.position and start - bot.lastChat > self.chatInterval:
+						bot.lastChat = start + random.uniform(0, self.chatInterval) # spread the chatter out
+						if len(self.commands) > 0 and random.random() < 0.5: bot.command(random.choice(self.commands))
+						else: bot.ping()
+					bot.tick(self.walkEnabled)
+				except:
+					bot.close(traceback.format_exc().splitlines()[-1])
+			self.metrics.observe("bot.tick_time", time.time() - start)
+			time.sleep(max(0, 0.05 - (time.time() - start)))
+	def stop(self):
+		self.abort = True
+		for bot in self.bots:
+			bot.close()
+	def getReport(self):
+		""" Returns a JSON-friendly summary of the run. """
+		stats = [bot.getStats() for bot in self.bots]
+		errors = {}
+		for stat in stats:
+			if stat["error"]: errors[stat["error"]] = errors.get(stat["error"], 0) + 1
+		def summary(key):
+			values = [stat[key] for stat in stats]
+			if len(values) == 0: return {"total": 0, "avg": 0, "max": 0}
+			return {"total": sum(values), "avg": sum(values) / len(values), "max": max(values)}
+		return {"bots": len(stats), "joined": len([stat for stat in stats if stat["joined"]]),
+			"online": len([bot for bot in self.bots if not bot.abort]), "duration": time.time() - self.started if self.started else 0,
+			"joinLatency": self.metrics.getHistogram("bot.join_latency"), "chatRTT": self.metrics.getHistogram("bot.chat_rtt"),
+			"bytesSent": summary("bytesSent"), "bytesReceived": summary("bytesReceived"),
+			"errors": errors, "connections": stats}
+def printReport(report):
+	def ms(value):
+		if value == None: return "n/a"
+		return "%.1fms" % (value * 1000)
+	print "Bots: %d, joined: %d, still online: %d, ran for %.1fs" % (report["bots"], report["joined"], report["online"], report["duration"])
+	for name, key in (("Join latency", "joinLatency"), ("Chat RTT", "chatRTT")):
+		histogram = report[key]
+		if histogram == None: print "%s: no samples" % name
+		else: print "%s: avg %s, p50 <= %s, p99 <= %s, max %s (%d samples)" % (name, ms(histogram["avg"]), ms(histogram["p50"]), ms(histogram["p99"]), ms(histogram["max"]), histogram["count"])
+	for name, key in (("Sent", "bytesSent"), ("Received", "bytesReceived")):
+		print "%s: %d bytes total, %d per connection on average, %d max" % (name, report[key]["total"], report[key]["avg"], report[key]["max"])
+	for error in report["errors"]:
+		print "%d bot(s) disconnected: %s" % (report["errors"][error], error)
+if __name__ == "__main__":
+	if len(sys.argv) < 4:
+		print "Usage: python bot.py <host> <port> <bots> [seconds] [command ...]"
+		sys.exit(0)
+	seconds = 60
+	if len(sys.argv) > 4: seconds = float(sys.argv[4])
+	swarm = Swarm(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), commands=sys.argv[5:])
+	try:
+		swarm.start()
+		while time.time() - swarm.started < seconds:
+			time.sleep(0.5)
+	except KeyboardInterrupt:
+		pass
+	report = swarm.getReport()
+	swarm.stop()
+	printReport(report)
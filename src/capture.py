@@ -0,0 +1,60 @@
+# Packet capture files for the proxy. With capture-enabled on, each proxied player gets one file holding every play-state packet in both
+# directions, uncompressed and decrypted, so replay.py can push the same traffic through the proxy code again offline.
+#
+# Layout (big-endian): "WCAP", ubyte format version, int protocol version, int compression threshold, double start time, ushort + username,
+# then one record per packet: float seconds since start, ubyte direction, uint length, payload (packet ID varint + fields).
+import struct, threading, time, os
+MAGIC = "WCAP"
+FORMAT_VERSION = 1
+SERVERBOUND = 0 # client -> proxy -> server
+CLIENTBOUND = 1 # server -> proxy -> client
+RECORD = struct.Struct("!fBI")
+class CaptureWriter:
+	def __init__(self, path, username, version, threshold=-1):
+		self.path = path
+		self.file = open(path, "wb")
+		self.start = time.time()
+		self.lock = threading.Lock() # the client and server threads of a connection both write here
+		self.packets = 0
+		self.abort = False
+		self.file.write(MAGIC + struct.pack("!Biid", FORMAT_VERSION, version, threshold, self.start))
+		self.file.write(struct.pack("!H", len(username)) + username)
+	def write(self, direction, payload):
+		if self.abort: return
+		with self.lock:
+			if self.abort: return
+			self.file.write(RECORD.pack(time.time() - self.start, direction, len(payload)))
+			self.file.write(payload)
+			self.packets += 1
+	def close(self):
+		with self.lock:
+			if self.abort: return
+			self.abort = True
+			self.file.close()
+class CaptureReader:
+	""" Iterate over it for (seconds since start, direction, payload) tuples. """
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, "rb")
+		if not self.file.read(4) == MAGIC:
+			raise Exception("%s is not a packet capture" % path)
+		formatVersion, self.version, self.threshold, self.start = struct.unpack("!Biid", self.file.read(17))
+		if formatVersion > FORMAT_VERSION:
+			raise Exception("%s was written by a newer Wrapper.py (capture format %d)" % (path, formatVersion))
+		length = struct.unpack("!H", self.file.read(2))[0]
+		self.username = self.file.read(length)
+	def __iter__(self):
+		while True:
+			header = self.file.read(RECORD.size)
+			if len(header) < RECORD.size: break # end of file, or the wrapper died mid-record
+			offset, direction, length = RECORD.unpack(header)
+			payload = self.file.read(length)
+			if len(payload) < length: break
+			yield (offset, direction, payload)
+	def close(self):
+		self.file.close()
+def openCapture(directory, username, version, threshold=-1):
+	""" Starts a new capture file for a player in the given directory. """
+	if not os.path.exists(directory): os.makedirs(directory)
+	path = os.path.join(directory, "%s-%s.wcap" % (username, time.strftime("%Y%m%d-%H%M%S")))
+	return CaptureWriter(path, username, version, threshold)
@@ -13,6 +13,28 @@ timed-reboot-seconds = 86400
 timed-reboot-warning-minutes = 5 
 debug = False 
 shell-scripts = False
+;; Watchdog: a server that has gone quiet for watchdog-silence seconds (and anyway every 4 times that) is sent a "list", whose reply isn't ;;
+;; logged. If that isn't answered in watchdog-timeout seconds, it gets a SIGQUIT (the JVM prints a thread dump to the console) and is killed ;;
+;; if it still hasn't answered watchdog-kill-delay seconds later. A stop is only killed after watchdog-timeout seconds without console output, CPU or disk activity (a server still saving is left alone). ;;
+;; auto-restart then brings it back. watchdog-timeout = 0 disables it. ;;
+watchdog-timeout = 90
+watchdog-silence = 30
+watchdog-kill-delay = 20
+;; Tick health: server.lag fires when the estimated TPS over the last minute drops under lag-tps-threshold (and again when it recovers). ;;
+;; With lag-probe-interval above 0, a "list" command is sent that often (in seconds) and timed; an average reply time over the last minute ;;
+;; above lag-probe-threshold seconds also counts as lagging. ;;
+lag-tps-threshold = 18
+lag-probe-interval = 0
+lag-probe-threshold = 0.5
+;; How often (in seconds) the world folder's size is brought up to date, on a background thread. 0 disables it. ;;
+world-size-interval = 60
+;; How often (in seconds) the server process' memory, CPU, threads, disk I/O and open files are sampled from /proc (Linux only), ;;
+;; and how many samples to keep. The defaults keep an hour. ;;
+resource-sample-interval = 1
+resource-history-size = 3600
+;; Cap on console commands per second sent by plugins and the wrapper itself, to protect the server tick. Commands from the console, web ;;
+;; panel and IRC control are never held back. 0 disables the cap. ;;
+console-commands-per-second = 200
 
 [Backups]
 ;; Automatic backups with automatic backup pruning. Interval is in seconds. ;; 
@@ -48,6 +70,49 @@ proxy-bind = 0.0.0.0
 server-port = 25564
 online-mode = True
 max-players = 1024
+;; How often (in seconds) the proxy re-queries the backend's status, and how long to wait for an answer. ;;
+status-poll-interval = 10
+status-poll-timeout = 3
+;; EXPERIMENTAL: number of proxy processes sharing the proxy port (needs fork() and SO_REUSEPORT, i.e. Linux). 1 keeps everything in one process. ;;
+;; With more than one worker, plugins still get proxy events, but can't send packets to clients directly (player.client is None). Workers are forked ;;
+;; from the running wrapper, so files or sockets a plugin opened are inherited by them; a worker that dies takes its connections with it and is restarted. ;;
+proxy-workers = 1
+;; Per-player outbound bandwidth cap in bytes per second (measured before compression). Keep-alives, chat and position corrections are never held back. 0 disables the cap. ;;
+bandwidth-cap = 0
+;; Byte-identical packets (mostly chunks) sent to several players are compressed once and shared for compression-cache-ttl seconds. Size is in bytes, 0 disables. ;;
+compression-cache-size = 16777216
+compression-cache-ttl = 5
+;; Deliver plugin chat (player.message, broadcast) as chat packets from the proxy instead of tellraw commands on the server console. ;;
+direct-chat = True
+;; Answers repeated tab-complete requests from the proxy for this many seconds (0 disables). Plugin commands are always added to command completions. ;;
+tab-complete-cache-ttl = 2
+;; Compression threshold sent to clients. With adaptive-compression, each client's threshold and zlib level follow its keep-alive RTT (seconds): ;;
+;; below compression-lan-rtt the threshold goes up to compression-threshold-max at level 1, above compression-slow-rtt it drops to compression-threshold-min at level 9. ;;
+compression-threshold = 256
+adaptive-compression = False
+compression-threshold-min = 64
+compression-threshold-max = 2048
+compression-lan-rtt = 0.005
+compression-slow-rtt = 0.15
+;; Drop movement updates for entities further than entity-culling-distance blocks from the player. Distant entities still get a teleport every ;;
+;; entity-culling-interval seconds (0 = never), and always get one when they come back into range. ;;
+entity-culling = False
+entity-culling-distance = 48
+entity-culling-interval = 2
+;; Record every proxied player's play-state packets to capture-directory, for replaying with replay.py. Captures grow quickly; only turn this on while collecting traffic. ;;
+capture-enabled = False
+capture-directory = captures
+
+[Backends]
+;; Lets the proxy front several servers. Only used when proxy mode is enabled. The wrapper-managed server is always called 'local'. ;;
+;; routing-policy is one of: least-players, lowest-latency, sticky (keeps each UUID on the backend it last joined). ;;
+;; Backends whose status poll fails are taken out of rotation until they answer again. ;;
+backends-enabled = False
+backends = {'lobby2': ('localhost', 25566)}
+include-local = True
+routing-policy = least-players
+pool-size = 2
+pool-max-idle = 20
 
 [Web]
 ;; This is a web UI. ;;
@@ -57,6 +122,8 @@ web-port = 8070
 web-password = password
 web-allow-file-management = True
 public-stats = True
+;; Serve Prometheus-style metrics at /metrics. Unless public-metrics is on, the request needs ?key= with a web session key. ;;
+public-metrics = False
 """
 
 class Config:
@@ -76,7 +143,7 @@ class Config:
 		self.parser = ConfigParser.ConfigParser(allow_no_value = True)
 		self.parser.readfp(open("wrapper.properties"))
 
-		sections = ["General", "Backups", "IRC", "Proxy", "Web"]
+		sections = ["General", "Backups", "IRC", "Proxy", "Backends", "Web"]
 		defaults = {"General":{
 			"server-name": "Minecraft Server",
 			"command": "java -jar minecraft_server.1.8.jar",
@@ -88,7 +155,17 @@ class Config:
 			"timed-reboot": False,
 			"timed-reboot-seconds": 86400,
 			"timed-reboot-warning-minutes": 5,
-			"shell-scripts": False
+			"shell-scripts": False,
+			"console-commands-per-second": 200,
+			"world-size-interval": 60,
+			"resource-sample-interval": 1,
+			"resource-history-size": 3600,
+			"lag-tps-threshold": 18,
+			"lag-probe-interval": 0,
+			"lag-probe-threshold": 0.5,
+			"watchdog-timeout": 90,
+			"watchdog-silence": 30,
+			"watchdog-kill-delay": 20
 		},		
 		"IRC":{ 
 			"irc-enabled": False, 
@@ -118,7 +195,34 @@ class Config:
 			"proxy-port": 25565,
 			"proxy-bind": "0.0.0.0",
 			"online-mode": True,
-			"max-players": 1024
+			"max-players": 1024,
+			"status-poll-interval": 10,
+			"status-poll-timeout": 3,
+			"proxy-workers": 1,
+			"bandwidth-cap": 0,
+			"compression-cache-size": 16777216,
+			"compression-cache-ttl": 5,
+			"direct-chat": True,
+			"tab-complete-cache-ttl": 2,
+			"compression-threshold": 256,
+			"adaptive-compression": False,
+			"compression-threshold-min": 64,
+			"compression-threshold-max": 2048,
+			"compression-lan-rtt": 0.005,
+			"compression-slow-rtt": 0.15,
+			"entity-culling": False,
+			"entity-culling-distance": 48,
+			"entity-culling-interval": 2,
+			"capture-enabled": False,
+			"capture-directory": "captures"
+		},
+		"Backends":{
+			"backends-enabled": False,
+			"backends": {},
+			"include-local": True,
+			"routing-policy": "least-players",
+			"pool-size": 2,
+			"pool-max-idle": 20
 		},
 		"Web":{
 			"web-enabled": False,
@@ -126,7 +230,8 @@ class Config:
 			"web-port": 8070,
 			"web-password": "password",
 			"web-allow-file-management": False,
-			"public-stats": True
+			"public-stats": True,
+			"public-metrics": False
 		}}
 
 		for section in sections:
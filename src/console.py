@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# console.py - classifies server console lines. Each line is split once into its prefix (timestamp, thread, level) and message by a header regex
+# for the server flavour that printed it, and the message is matched against that flavour's table of precompiled patterns. Server.readConsole
+# turns the result into events.
+import re
+# Prefix formats, tried in this order, except that whichever matched the previous line is tried first. A line that matches none of them
+# (stack traces, mod banners and the like) isn't classified.
+HEADERS = (
+	("vanilla", r"\[\d\d:\d\d:\d\d\] \[[^\]]*/(?P<level>[A-Z]+)\]: (?P<message>.*)"), # [12:00:00] [Server thread/INFO]: ...
+	("forge", r"\[\d\d:\d\d:\d\d\] \[[^\]]*/(?P<level>[A-Z]+)\] \[(?P<source>[^\]]*)\]: (?P<message>.*)"), # [12:00:00] [Server thread/INFO] [FML]: ...
+	("spigot", r"\[\d\d:\d\d:\d\d (?P<level>[A-Z]+)\]: (?P<message>.*)"), # [12:00:00 INFO]: ...
+	("legacy", r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d \[(?P<level>[A-Z]+)\] (?P<message>.*)"), # 2013-09-01 12:00:00 [INFO] ... (pre-1.7)
+)
+DEATH_WORDS = ("fell", "was", "drowned", "blew", "walked", "went", "burned", "hit", "tried", "died", "got", "starved", "suffocated", "withered")
+# Message patterns, matched against the part after the prefix. The first match wins, so more specific patterns go first.
+MESSAGES = (
+	("started", r"Done \("),
+	("world", r'Preparing level "(?P<world>[^"]*)"'),
+	("overloaded", r"Can't keep up! .*?(?:Running (?P<behind>\d+)ms behind, skipping (?P<skipped>\d+) tick\(s\))?$"), # the numbers are 1.8+
+	("chat", r"<(?P<name>[^ ]*)>(?: (?P<text>.*))?$"),
+	("login", r"(?P<name>[^\s\[]+) ?\[(?P<address>[^\]]*)\] logged in"), # 1.7+ has no space before the [, older versions do
+	("logout", r"(?P<name>\S+) lost connection"),
+	("action", r"\* (?P<name>\S+)(?: (?P<text>.*))?$"),
+	("say", r"\[(?P<name>[^\]\s]+)\](?: (?P<text>.*))?$"),
+	("achievement", r"(?P<name>\S+) has \S+ \S+ \S+ achievement (?P<achievement>.*)"),
+	("death", r"(?P<name>\S+) (?P<death>(?:%s)(?: .*)?)$" % "|".join(DEATH_WORDS)),
+)
+FLAVOURS = {
+	"vanilla": MESSAGES,
+	"forge": MESSAGES,
+	"spigot": MESSAGES,
+	# pre-1.7 servers echo their own /say as [Server], which isn't anybody saying anything
+	"legacy": tuple(("say", r"\[(?!Server\])(?P<name>[^\]\s]+)\](?: (?P<text>.*))?$") if kind == "say" else (kind, pattern) for kind, pattern in MESSAGES),
+}
+class Classifier:
+	def __init__(self, legacy=False):
+		self.headers = [(flavour, re.compile(pattern)) for flavour, pattern in HEADERS]
+		if legacy: self.headers.sort(key=lambda header: not header[0] == "legacy")
+		self.tables = dict((flavour, compileTable(FLAVOURS[flavour])) for flavour in FLAVOURS)
+	def split(self, line):
+		""" Returns (flavour, prefix match) for the line, or (None, None) if it has no recognised prefix. """
+		headers = self.headers
+		for i, (flavour, header) in enumerate(headers):
+			match = header.match(line)
+			if match:
+				if i > 0: headers.insert(0, headers.pop(i)) # servers don't change format mid-run, so this is nearly always the first try
+				return flavour, match
+		return None, None
+	def classify(self, line):
+		""" Returns (flavour, kind, fields). kind is one of the MESSAGES kinds, or None if the message isn't one of them; fields holds the
+		pattern's named groups plus 'message' (the line minus its prefix), 'level' and 'source' (Forge only). flavour is None (and kind and
+		fields too) for lines without a recognised prefix. """
+		flavour, header = self.split(line)
+		if flavour == None: return None, None, None
+		fields = header.groupdict()
+		table, groups = self.tables[flavour]
+		match = table.match(fields["message"])
+		if match == None: return flavour, None, fields
+		kind = match.lastgroup
+		for group, name in groups[kind]: fields[name] = match.group(group)
+		return flavour, kind, fields
+def compileTable(patterns):
+	""" Compiles a message table into one alternation, (?P<chat>...)|(?P<login>...)|..., so a message is matched against every pattern in a
+	single pass and match.lastgroup names the kind. Named groups inside the patterns are renamed kind_group, since names must be unique
+	across the whole regex. Returns the regex and, per kind, the (renamed group, original name) pairs to copy out of a match. """
+	parts = []
+	groups = {}
+	for kind, pattern in patterns:
+		groups[kind] = [("%s_%s" % (kind, name), name) for name in re.compile(pattern).groupindex]
+		parts.append("(?P<%s>%s)" % (kind, re.sub(r"\(\?P<(\w+)>", lambda match: "(?P<%s_%s>" % (kind, match.group(1)), pattern)))
+	return re.compile("|".join(parts)), groups
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# consolebench.py - measures how fast the wrapper gets through server console output. Lines go through the real Server.readConsole and the real
+# Wrapper.callEvent, with no server process attached, either with no plugins loaded or with a set of plugins doing the kind of work common
+# plugins do (chat logging and filtering, join messages, death counters, console watchers). Reports lines per second overall, time and GC-tracked
+# allocations per kind of line, and time per event dispatch, so parser and event changes can be compared on numbers.
+#
+# Usage: python consolebench.py [log file ...] [--flavour vanilla|forge|spigot|legacy] [--lines N] [--plugins none|realistic|both] [--seed N]
+#        python consolebench.py --generate vanilla|forge|spigot|legacy [--lines N] > corpus.log
+# Without log files, a corpus is generated for each flavour (or just --flavour). Real logs (latest.log, or a concatenation of old ones) can be
+# given instead; they're streamed, so they can be bigger than memory. Run it from an empty directory - it writes a wrapper.properties and
+# per-player wrapper-data there, like a real wrapper would.
+import sys, os, time, gc, imp, random, re, collections, uuid
+import server, console, metrics, log, api
+from config import Config, DEFAULT_CONFIG
+wrapperMain = imp.load_source("wrappermain", os.path.join(os.path.dirname(os.path.abspath(__file__)), "__main__.py"))
+NAMES = ["Steve", "Alex", "Notch", "jeb_", "Dinnerbone", "Grumm", "xX_Sniper_Xx", "builder42", "RedstoneRita", "MinerMike",
+	"CreeperHugger", "LavaSurfer", "Herobrine", "PixelPete", "BlockBetty", "DiamondDan", "EnderElla", "NetherNick", "SkySam", "CaveCarl"]
+WORDS = ["hello", "anyone", "want", "to", "trade", "diamonds", "for", "iron", "lol", "where", "is", "spawn", "brb", "gg", "nice", "base",
+	"who", "took", "my", "chest", "tp", "me", "please", "creeper", "blew", "up", "house", "again", "lag", "server"]
+DEATHS = ["was slain by Zombie", "fell from a high place", "drowned", "blew up", "was shot by Skeleton", "burned to death",
+	"tried to swim in lava", "starved to death", "suffocated in a wall", "withered away", "hit the ground too hard", "went up in flames"]
+NOISE = ["Saving chunks for level 'world'/Overworld", "Saving chunks for level 'world'/Nether", "Saved the world",
+	"Can't keep up! Did the system time change, or is the server overloaded? Running 2500ms behind, skipping 50 tick(s)",
+	"There are %d/20 players online:", "Steve moved wrongly!", "Alex moved too quickly! -12.0,0.0,3.5"]
+MOD_NOISE = ["[FML]: Injecting itemstacks", "[journeymap]: Mapping chunk 12,-4", "[ic2]: Energy net tick took 3ms",
+	"[AE2:S]: Loaded grid cache", "[Mekanism]: Sent config to 'Steve'"]
+PLUGIN_NOISE = ["[WorldGuard] Loading region data for 'world'", "[Essentials] Steve issued server command: /home", "[dynmap] 20 tiles rendered",
+	"[LWC] Cache cleaned", "[CoreProtect] Database queue flushed"]
+HEADERS = {
+	"vanilla": lambda t: "[%s] [Server thread/INFO]: " % t,
+	"forge": lambda t: "[%s] [Server thread/INFO] [net.minecraft.server.dedicated.DedicatedServer]: " % t,
+	"spigot": lambda t: "[%s INFO]: " % t,
+	"legacy": lambda t: "2015-06-01 %s [INFO] " % t,
+}
+def generateCorpus(flavour="vanilla", lines=100000, seed=1):
+	""" Yields lines of a made-up but plausibly busy server log: mostly chat and noise, some deaths, actions and /says, and the odd reconnect.
+	The mix is fixed for a given seed, so runs are comparable. """
+	rand = random.Random(seed)
+	header = HEADERS[flavour]
+	online = set()
+	def stamp(i):
+		seconds = i / 20 # twenty lines a second
+		return "%02d:%02d:%02d" % (seconds / 3600 % 24, seconds / 60 % 60, seconds % 60)
+	def login(i, name):
+		online.add(name)
+		space = " " if flavour == "legacy" else ""
+		return header(stamp(i)) + "%s%s[/127.0.0.1:%d] logged in with entity id %d at (%.1f, 64.0, %.1f)" % (name, space, rand.randint(40000, 60000), i, rand.uniform(-500, 500), rand.uniform(-500, 500))
+	yield header(stamp(0)) + 'Preparing level "world"'
+	yield header(stamp(0)) + 'Done (4.213s)! For help, type "help" or "?"'
+	for i, name in enumerate(NAMES): yield login(i, name)
+	for i in range(len(NAMES) + 2, lines):
+		roll = rand.random()
+		name = rand.choice(NAMES)
+		if roll < 0.30:
+			yield header(stamp(i)) + "<%s> %s" % (name, " ".join(rand.choice(WORDS) for n in range(rand.randint(1, 12))))
+		elif roll < 0.34:
+			yield header(stamp(i)) + "%s %s" % (name, rand.choice(DEATHS))
+		elif roll < 0.36:
+			yield header(stamp(i)) + "* %s %s" % (name, " ".join(rand.choice(WORDS) for n in range(rand.randint(1, 6))))
+		elif roll < 0.37:
+			yield header(stamp(i)) + "[Server] %s" % " ".join(rand.choice(WORDS) for n in range(rand.randint(1, 8)))
+		elif roll < 0.372:
+			yield header(stamp(i)) + "%s has just earned the achievement [Taking Inventory]" % name
+		elif roll < 0.373: # a reconnect
+			yield header(stamp(i)) + "%s lost connection: Disconnected" % name
+			yield login(i, name)
+		elif roll < 0.60:
+			line = rand.choice(NOISE)
+			if "%d" in line: line = line % len(online)
+			yield header(stamp(i)) + line
+		elif roll < 0.97:
+			if flavour == "forge": yield "[%s] [Server thread/INFO] [%s]: %s" % (stamp(i), rand.choice(["FML", "journeymap", "ic2"]), rand.choice(MOD_NOISE).split(": ", 1)[1])
+			elif flavour == "spigot": yield header(stamp(i)) + rand.choice(PLUGIN_NOISE)
+			else: yield header(stamp(i)) + rand.choice(NOISE[:3])
+		else: # a stack trace, which has no prefix at all
+			yield "java.lang.NullPointerException"
+			yield "\tat net.minecraft.world.World.func_72939_s(World.java:1928)"
+			yield "\tat net.minecraft.server.MinecraftServer.func_71190_q(MinecraftServer.java:630)"
+def readLog(path):
+	with open(path, "r") as f:
+		for line in f:
+			line = line.rstrip("\n").replace("\r", "")
+			if len(line) > 0: yield line
+class NullOutput:
+	""" Swallows readConsole's print, so the terminal isn't what gets benchmarked. """
+	def write(self, data): pass
+	def flush(self): pass
+class Harness:
+	""" Just enough of a Wrapper for server.Server to parse console output headless, with the real Wrapper.callEvent. """
+	callEvent = wrapperMain.Wrapper.callEvent.im_func
+	playerCommand = wrapperMain.Wrapper.playerCommand.im_func
+	def __init__(self, legacy=False):
+		self.log = log.Log()
+		if not os.path.exists("wrapper.properties"):
+			with open("wrapper.properties", "w") as f: f.write(DEFAULT_CONFIG)
+		self.configManager = Config(self.log)
+		try: self.configManager.loadConfig()
+		except SystemExit: # keys were missing and have now been written out with their defaults, so the second load sticks
+			self.configManager = Config(self.log)
+			self.configManager.loadConfig()
+		self.config = self.configManager.config
+		self.config["General"]["pre-1.7-mode"] = legacy
+		self.metrics = metrics.Metrics()
+		self.storage = {"serverState": True}
+		self.permissions = {}
+		self.halt = False
+		self.proxy = False
+		self.listeners = []
+		self.commands = {}
+		self.events = {}
+		self.help = {}
+		self.consolePatterns = {}
+		self.server = None
+		self.server = server.Server(["true"], self.log, self.config, self)
+	def getUUID(self, name):
+		return str(uuid.uuid3(uuid.NAMESPACE_OID, "OfflinePlayer:%s" % name))
+class RealisticPlugins:
+	""" Stand-ins for what popular plugins hook into console-driven events. Each registers under its own plugin ID, like a loaded plugin. """
+	def __init__(self, wrapper):
+		self.wrapper = wrapper
+		self.chatLog = collections.deque(maxlen=1000)
+		self.badWords = re.compile(r"\b(?:damn|heck|noob|hacks?)\b", re.IGNORECASE)
+		self.deaths = {}
+		self.counts = {}
+		self.lagSpikes = 0
+		self.seen = {}
+		chat = api.API(wrapper, "ChatLogger")
+		chat.registerEvent("player.message", self.onChatLog)
+		chat.registerEvent("player.action", self.onCount)
+		chat.registerEvent("server.say", self.onCount)
+		filter = api.API(wrapper, "ChatFilter")
+		filter.registerEvent("player.message", self.onChatFilter)
+		joins = api.API(wrapper, "JoinMessages")
+		joins.registerEvent("player.login", self.onLogin)
+		joins.registerEvent("player.logout", self.onLogout)
+		deaths = api.API(wrapper, "DeathCounter")
+		deaths.registerEvent("player.death", self.onDeath)
+		deaths.registerEvent("player.achievement", self.onCount)
+		watcher = api.API(wrapper, "ConsoleWatcher")
+		watcher.registerEvent("server.consoleMessage", self.onConsoleMessage)
+		watcher.registerConsolePattern("watcher.lag", r"Running (?P<behind>\d+)ms behind, skipping (?P<ticks>\d+) tick")
+		watcher.registerEvent("watcher.lag", self.onLag)
+	def onChatLog(self, payload):
+		self.chatLog.append("[%s] <%s> %s" % (time.strftime("%H:%M:%S"), payload["player"], payload["message"]))
+	def onChatFilter(self, payload):
+		if self.badWords.search(payload["message"]): self.counts["filtered"] = self.counts.get("filtered", 0) + 1
+	def onLogin(self, payload):
+		player = payload["player"]
+		self.seen[str(player)] = time.time()
+		self.wrapper.server.broadcast("&e%s joined the game" % player)
+	def onLogout(self, payload):
+		self.wrapper.server.broadcast("&e%s left the game" % payload["player"])
+	def onDeath(self, payload):
+		name = str(payload["player"])
+		self.deaths[name] = self.deaths.get(name, 0) + 1
+	def onCount(self, payload):
+		self.counts["other"] = self.counts.get("other", 0) + 1
+	def onConsoleMessage(self, payload):
+		if "moved wrongly" in payload["message"] or "moved too quickly" in payload["message"]:
+			self.counts["movement"] = self.counts.get("movement", 0) + 1
+	def onLag(self, payload):
+		self.lagSpikes += int(payload["ticks"])
+class Benchmark:
+	def __init__(self, lines, plugins=False, legacy=False):
+		self.lines = lines
+		self.wrapper = Harness(legacy)
+		self.server = self.wrapper.server
+		if plugins: self.plugins = RealisticPlugins(self.wrapper)
+		self.kinds = {} # kind of line -> [lines, cpu seconds, gc-tracked allocations]
+		self.events = {} # event -> [dispatches, cpu seconds]
+		callEvent = self.wrapper.callEvent
+		def timedCallEvent(event, payload): # events fire from inside readConsole, so this time is also counted in the line's time
+			started = time.clock()
+			try: return callEvent(event, payload)
+			finally:
+				if event not in self.events: self.events[event] = [0, 0.0]
+				self.events[event][0] += 1
+				self.events[event][1] += time.clock() - started
+		self.wrapper.callEvent = timedCallEvent
+		self.classifier = console.Classifier(legacy) # a second classifier, only to label lines in the report
+	def run(self):
+		""" Feeds every line through readConsole on this thread. Returns the report dict. """
+		readConsole, classify = self.server.readConsole, self.classifier.classify
+		count = 0
+		stdout = sys.stdout
+		sys.stdout = NullOutput()
+		gc.collect()
+		gc.disable() # so the allocation counts aren't reset by collections mid-line
+		objectsBefore = len(gc.get_objects())
+		started = time.time()
+		cpuStarted = time.clock()
+		try:
+			for line in self.lines:
+				allocated = gc.get_count()[0]
+				cpu = time.clock()
+				readConsole(line, time.time())
+				cpu = time.clock() - cpu
+				allocated = gc.get_count()[0] - allocated
+				flavour, kind, fields = classify(line)
+				if flavour == None: kind = "unprefixed"
+				elif kind == None: kind = "other"
+				if kind not in self.kinds: self.kinds[kind] = [0, 0.0, 0]
+				stat = self.kinds[kind]
+				stat[0] += 1
+				stat[1] += cpu
+				stat[2] += allocated
+				count += 1
+		finally:
+			elapsed = time.time() - started
+			cpuElapsed = time.clock() - cpuStarted
+			objectsAfter = len(gc.get_objects())
+			gc.enable()
+			sys.stdout = stdout
+		for name in self.server.players.keys(): # log everyone out, so their tracking threads don't eat into the next run
+			self.server.logout(name)
+		lineCPU = sum(stat[1] for stat in self.kinds.values())
+		return {"lines": count, "time": elapsed, "cpu": cpuElapsed, "linesPerSecond": count / lineCPU if lineCPU > 0 else 0,
+			"objectsRetained": objectsAfter - objectsBefore, "latency": self.wrapper.metrics.getHistogram("console.line_latency"),
+			"kinds": [{"kind": kind, "lines": self.kinds[kind][0], "cpu": self.kinds[kind][1], "allocations": self.kinds[kind][2]}
+				for kind in sorted(self.kinds, key=lambda kind: -self.kinds[kind][1])],
+			"events": [{"event": event, "dispatches": self.events[event][0], "cpu": self.events[event][1]}
+				for event in sorted(self.events, key=lambda event: -self.events[event][1])]}
+def printReport(name, report):
+	print "== %s: %d lines, %.2fs wall, %.2fs CPU, %d lines/s (CPU time inside readConsole), %d objects still alive afterwards" % (
+		name, report["lines"], report["time"], report["cpu"], report["linesPerSecond"], report["objectsRetained"])
+	print "%-14s %9s %10s %10s %14s" % ("line kind", "lines", "CPU (ms)", "us/line", "net objs/line")
+	for entry in report["kinds"]:
+		print "%-14s %9d %10.1f %10.1f %14.2f" % (entry["kind"], entry["lines"], entry["cpu"] * 1000, entry["cpu"] * 1000000 / entry["lines"],
+			float(entry["allocations"]) / entry["lines"])
+	print "%-24s %10s %10s %13s" % ("event", "dispatches", "CPU (ms)", "us/dispatch")
+	for entry in report["events"]:
+		print "%-24s %10d %10.1f %13.1f" % (entry["event"], entry["dispatches"], entry["cpu"] * 1000, entry["cpu"] * 1000000 / entry["dispatches"])
+def parseOptions(argv):
+	""" Returns (options, positional arguments). """
+	options, paths = {}, []
+	i = 0
+	while i < len(argv):
+		if argv[i].startswith("--") and i + 1 < len(argv):
+			options[argv[i][2:]] = argv[i + 1]
+			i += 1
+		else: paths.append(argv[i])
+		i += 1
+	return options, paths
+if __name__ == "__main__":
+	options, paths = parseOptions(sys.argv[1:])
+	lines, seed = int(options.get("lines", 100000)), int(options.get("seed", 1))
+	if "generate" in options:
+		for line in generateCorpus(options["generate"], lines, seed): print line
+		sys.exit(0)
+	pluginSets = {"none": [False], "realistic": [True], "both": [False, True]}[options.get("plugins", "both")]
+	if len(paths) > 0: # real logs: the flavour is detected per line, --flavour legacy only puts the pre-1.7 format first
+		runs = [(path, lambda path=path: readLog(path), options.get("flavour") == "legacy") for path in paths]
+	else:
+		flavours = [options["flavour"]] if "flavour" in options else ["vanilla", "forge", "spigot"]
+		runs = [("generated %s" % flavour, lambda flavour=flavour: generateCorpus(flavour, lines, seed), flavour == "legacy") for flavour in flavours]
+	for name, source, legacy in runs:
+		for plugins in pluginSets:
+			report = Benchmark(source(), plugins, legacy).run()
+			printReport("%s, %s" % (name, "realistic plugins" if plugins else "no plugins"), report)
+	os._exit(0) # don't wait on the storage threads players started
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# inventory.py - the proxy's copy of what each player is holding. Fed from Set Slot / Window Items / Open Window / Close Window on the way to the
+# client and Click Window / Creative Inventory Action on the way to the server, so plugins can read inventories without asking the console.
+#
+# Items are dicts: {"id": item ID, "count": stack size, "damage": damage/metadata, "nbt": ItemNBT or None}. Empty slots are None.
+# Window slot numbers follow the protocol: window 0 is the player's own inventory (0 crafting output, 1-4 crafting grid, 5-8 armor, 9-35 main
+# inventory, 36-44 hotbar). Any other window has its own slots first, followed by the player's main inventory and hotbar.
+import StringIO, zlib, threading
+import nbt
+MAX_STACK = 64
+class ItemNBT:
+	""" An item's NBT tag, kept as the raw bytes off the wire and only decoded (with nbt.py) the first time something asks for it. """
+	def __init__(self, raw, compressed=False):
+		self.raw = raw
+		self.compressed = compressed # pre-1.8 clients send the tag gzipped
+		self.tag = None
+	def decode(self):
+		""" Returns the root nbt.TAG_Compound of the item's tag. """
+		if self.tag == None:
+			if self.compressed: self.tag = nbt.NBTFile(buffer=StringIO.StringIO(zlib.decompress(self.raw, 16 + zlib.MAX_WBITS)))
+			else: self.tag = nbt.NBTFile(buffer=StringIO.StringIO(self.raw))
+		return self.tag
+	def __getitem__(self, key):
+		return self.decode()[key]
+	def __contains__(self, key):
+		return key in self.decode()
+	def __eq__(self, other):
+		return isinstance(other, ItemNBT) and self.raw == other.raw
+	def __ne__(self, other):
+		return not self == other
+	def __len__(self):
+		return len(self.raw)
+def isSameItem(a, b):
+	""" If two stacks can be merged: same item, same damage value and same NBT tag. """
+	return a["id"] == b["id"] and a["damage"] == b["damage"] and a.get("nbt") == b.get("nbt")
+def copyItem(item, count):
+	if item == None or count < 1: return None
+	item = dict(item)
+	item["count"] = count
+	return item
+class Window:
+	""" A container window the client has open. Only the container's own slots live here; the player inventory part of it is read from and
+	written to the owning Inventory, so both views always agree. """
+	def __init__(self, id, type, title, size, entity=None):
+		self.id = id
+		self.type = type
+		self.title = title
+		self.size = size # slots belonging to the container itself, not counting the 36 player inventory slots after them
+		self.entity = entity # horse entity ID for EntityHorse windows
+		self.slots = [None] * size
+		self.properties = {}
+		self.stale = False
+	def toDict(self):
+		return {"id": self.id, "type": self.type, "title": self.title, "size": self.size, "entity": self.entity,
+			"slots": list(self.slots), "properties": dict(self.properties), "stale": self.stale}
+class Inventory:
+	""" One client's inventory, cursor, held slot and open window. The client and server threads both update it, hence the lock. """
+	def __init__(self, client):
+		self.client = client
+		self.slots = {}
+		for i in range(45): self.slots[i] = None
+		self.cursor = None
+		self.window = None
+		self.stale = False # set when a click did something we don't simulate (shift-click, dragging, double-click) and cleared by Window Items
+		self.lock = threading.RLock()
+	# -- Slot addressing -- #
+	def getSlot(self, wid, slot):
+		""" Returns the item in a slot of the given window (0 for the player inventory), or None. """
+		with self.lock:
+			index = self.resolve(wid, slot)
+			if index == None: return None
+			if index[0] == None: return self.slots[index[1]]
+			return index[0].slots[index[1]]
+	def setSlot(self, wid, slot, item):
+		with self.lock:
+			index = self.resolve(wid, slot)
+			if index == None: return
+			if index[0] == None: self.slots[index[1]] = item
+			else: index[0].slots[index[1]] = item
+	def resolve(self, wid, slot):
+		""" Maps a (window ID, slot) pair to (Window, index) for container slots or (None, index) for player inventory slots. """
+		if wid == 0:
+			if slot > -1 and slot < 45: return (None, slot)
+			return None
+		window = self.window
+		if window == None or not window.id == wid or slot < 0: return None
+		if slot < window.size: return (window, slot)
+		if slot < window.size + 36: return (None, slot - window.size + 9)
+		return None
+	def getHotbarSlot(self, wid, button):
+		""" The window slot number of hotbar slot 0-8 in the given window. """
+		if wid == 0 or self.window == None: return 36 + button
+		return self.window.size + 27 + button
+	# -- Clientbound -- #
+	def openWindow(self, wid, type, title, size, entity=None):
+		with self.lock:
+			self.window = Window(wid, type, title, size, entity)
+	def closeWindow(self, wid=None):
+		with self.lock:
+			self.window = None
+			self.cursor = None # vanilla throws the cursor stack back into the inventory or drops it, and the server resyncs either way
+	def setItems(self, wid, items):
+		""" Window Items: the full contents of a window, which also means anything we had marked as stale is accurate again. """
+		with self.lock:
+			for slot, item in enumerate(items):
+				self.setSlot(wid, slot, item)
+			if wid == 0: self.stale = False
+			elif self.window and self.window.id == wid: self.window.stale = self.stale = False
+	def setItem(self, wid, slot, item):
+		""" Set Slot. Window -1 slot -1 is the cursor. """
+		with self.lock:
+			if wid == -1 and slot == -1: self.cursor = item
+			else: self.setSlot(wid, slot, item)
+	def markStale(self, wid):
+		""" For inventory packets that couldn't be decoded: whatever they changed is unknown until the next Window Items. """
+		with self.lock:
+			self.stale = True
+			if self.window and (wid == -1 or self.window.id == wid): self.window.stale = True
+	def setProperty(self, wid, property, value):
+		with self.lock:
+			if self.window and self.window.id == wid: self.window.properties[property] = value
+	# -- Serverbound -- #
+	def click(self, wid, slot, button, mode):
+		""" Applies a Click Window the way the server will, for the modes that are simple to predict. The server doesn't echo successful
+		clicks, so for the rest we only mark the window stale until the next Window Items. """
+		with self.lock:
+			if mode == 0:
+				if slot == -999: # clicked outside the window
+					if self.cursor == None: return
+					if button == 0: self.cursor = None
+					else: self.cursor = copyItem(self.cursor, self.cursor["count"] - 1)
+					return
+				if self.resolve(wid, slot) == None: return
+				item = self.getSlot(wid, slot)
+				cursor = self.cursor
+				if button == 0: # left click: pick up, put down, merge or swap
+					if cursor and item and isSameItem(cursor, item):
+						moved = min(MAX_STACK - item["count"], cursor["count"])
+						self.setSlot(wid, slot, copyItem(item, item["count"] + moved))
+						self.cursor = copyItem(cursor, cursor["count"] - moved)
+					else:
+						self.setSlot(wid, slot, cursor)
+						self.cursor = item
+				elif button == 1: # right click: pick up half, put down one, or swap
+					if cursor == None:
+						if item == None: return
+						self.cursor = copyItem(item, item["count"] - item["count"] / 2)
+						self.setSlot(wid, slot, copyItem(item, item["count"] / 2))
+					elif item == None:
+						self.setSlot(wid, slot, copyItem(cursor, 1))
+						self.cursor = copyItem(cursor, cursor["count"] - 1)
+					elif isSameItem(cursor, item):
+						if item["count"] >= MAX_STACK: return
+						self.setSlot(wid, slot, copyItem(item, item["count"] + 1))
+						self.cursor = copyItem(cursor, cursor["count"] - 1)
+					else:
+						self.setSlot(wid, slot, cursor)
+						self.cursor = item
+			elif mode == 2: # number key: swap with a hotbar slot
+				if self.resolve(wid, slot) == None or button < 0 or button > 8: return
+				hotbar = self.getHotbarSlot(wid, button)
+				item = self.getSlot(wid, slot)
+				self.setSlot(wid, slot, self.getSlot(wid, hotbar))
+				self.setSlot(wid, hotbar, item)
+			elif mode == 3: # middle click: creative mode clones a full stack onto the cursor
+				item = self.getSlot(wid, slot)
+				if self.client.gamemode == 1 and self.cursor == None and item: self.cursor = copyItem(item, MAX_STACK)
+			elif mode == 4: # Q / ctrl+Q over a slot
+				if self.cursor or self.resolve(wid, slot) == None: return
+				item = self.getSlot(wid, slot)
+				if item == None: return
+				if button == 0: self.setSlot(wid, slot, copyItem(item, item["count"] - 1))
+				else: self.setSlot(wid, slot, None)
+			else: # shift-click, painting and double-click depend on stack limits and slot rules we don't model
+				self.stale = True
+				if self.window: self.window.stale = True
+	def creativeSet(self, slot, item):
+		""" Creative Inventory Action: a creative client setting a player inventory slot outright (slot -1 is dropping the item). """
+		with self.lock:
+			if slot > -1 and slot < 45: self.slots[slot] = item
+	# -- Reading it -- #
+	def getHotbar(self):
+		with self.lock:
+			return [self.slots[36 + i] for i in range(9)]
+	def getHeldItem(self):
+		return self.slots[36 + self.client.slot]
+	def getArmor(self):
+		""" Helmet, chestplate, leggings, boots. """
+		with self.lock:
+			return [self.slots[5 + i] for i in range(4)]
+	def findItems(self, id, damage=None):
+		""" Returns the player inventory slots holding the given item ID (and damage value, if given). """
+		with self.lock:
+			return [slot for slot in range(45) if self.slots[slot] and self.slots[slot]["id"] == id and (damage == None or self.slots[slot]["damage"] == damage)]
+	def countItem(self, id, damage=None):
+		with self.lock:
+			return sum(self.slots[slot]["count"] for slot in self.findItems(id, damage))
+	def getWindow(self):
+		""" The open container window as a dict, or None if only the player inventory is open. """
+		with self.lock:
+			if self.window == None: return None
+			return self.window.toDict()
+	def toDict(self):
+		with self.lock:
+			return {"slots": dict(self.slots), "cursor": self.cursor, "held": self.client.slot, "window": self.getWindow(), "stale": self.stale}
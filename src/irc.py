@@ -1,4 +1,5 @@
 import socket, traceback, time, threading, api, globals, random, math
+from server import COMMAND_ADMIN
 from config import Config
 class IRC:
 	def __init__(self, server, config, log, wrapper, address, port, nickname, channels):
@@ -281,16 +282,16 @@ class IRC:
 								msg('Usage: run [command]')
 							else:
 								command = " ".join(message.split(' ')[1:])
-								self.server.console(command)
+								self.server.console(command, COMMAND_ADMIN)
 						elif args(0) == 'halt':
 							self.wrapper.halt = True
-							self.server.console("stop")
+							self.server.console("stop", COMMAND_ADMIN)
 							self.server.changeState(3)
 						elif args(0) == 'restart':
 							self.server.restart("Restarting server from IRC remote")
 							self.server.changeState(3)
 						elif args(0) == 'stop':
-							self.server.console('stop')
+							self.server.console('stop', COMMAND_ADMIN)
 							self.server.stop("Stopped from IRC remote")
 							msg("Server stopping")
 						elif args(0) == 'start':
@@ -0,0 +1,151 @@
+import threading, time, bisect, re
+""" metrics.py holds the in-process counters, gauges and histograms that the proxy and server code record into. Everything here is cheap enough to be always-on. """
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000) # for histograms of sizes rather than seconds
+class Histogram:
+	""" Fixed-bucket histogram. Values are usually seconds. """
+	buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+	def __init__(self, buckets=None):
+		if buckets: self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1) # last slot is +Inf
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.total += value
+		if value > self.max: self.max = value
+	def merge(self, other):
+		""" Adds another histogram's observations into this one. Both must use the same buckets. """
+		for i, count in enumerate(other.counts): self.counts[i] += count
+		self.count += other.count
+		self.total += other.total
+		if other.max > self.max: self.max = other.max
+	def copy(self):
+		histogram = Histogram(self.buckets)
+		histogram.merge(self)
+		return histogram
+	def percentile(self, p):
+		""" Returns the upper bound of the bucket holding the p-th percentile (0-100), or None if empty. """
+		if self.count == 0: return None
+		target = self.count * p / 100.0
+		seen = 0
+		for i, count in enumerate(self.counts):
+			seen += count
+			if seen >= target:
+				if i < len(self.buckets): return self.buckets[i]
+				return self.max
+		return self.max
+	def toDict(self):
+		if self.count: average = self.total / self.count
+		else: average = None
+		return {"count": self.count, "sum": self.total, "max": self.max, "avg": average,
+			"p50": self.percentile(50), "p99": self.percentile(99),
+			"buckets": zip(list(self.buckets) + ["+Inf"], self.counts)}
+class Metrics:
+	""" Registry of named counters, gauges and histograms. Names are dotted strings, e.g. 'proxy.backend_latency.local'. """
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.gauges = {}
+		self.histograms = {}
+		self.remote = {} # source -> (counters, gauges, histograms) another process last reported, see report() and setRemote()
+		self.started = time.time()
+	def increment(self, name, value=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+	def set(self, name, value):
+		self.gauges[name] = value
+	def observe(self, name, value, buckets=None):
+		with self.lock:
+			if name not in self.histograms:
+				self.histograms[name] = Histogram(buckets)
+			self.histograms[name].observe(value)
+	def getCounter(self, name):
+		with self.lock:
+			return self.counters.get(name, 0) + sum(remote[0].get(name, 0) for remote in self.remote.values())
+	def getGauge(self, name):
+		return self.collect()[1].get(name)
+	def getHistogram(self, name):
+		""" Returns the histogram as a dict, or None if nothing was observed under that name yet. """
+		histograms = self.collect()[2]
+		if name not in histograms: return None
+		return histograms[name].toDict()
+	def snapshot(self):
+		""" Returns a JSON-friendly copy of every metric. """
+		counters, gauges, histograms = self.collect()
+		return {"uptime": time.time() - self.started,
+			"counters": counters,
+			"gauges": gauges,
+			"histograms": dict((name, histograms[name].toDict()) for name in histograms)}
+	def report(self):
+		""" This process' own metrics as picklable data, for another process' setRemote(). """
+		with self.lock:
+			return (dict(self.counters), dict(self.gauges), dict((name, self.histograms[name].copy()) for name in self.histograms))
+	def setRemote(self, source, report):
+		""" Replaces what 'source' (a proxy worker's pid) last reported. Its counters and histograms are added to ours wherever metrics are
+		read; its gauges only fill in names this process has no gauge for. """
+		with self.lock:
+			self.remote[source] = report
+	def retireRemote(self, source):
+		""" 'source' went away. Its counters and histograms are kept, added up with those of sources that went before it; its gauges go. """
+		with self.lock:
+			report = self.remote.pop(source, None)
+			if report == None: return
+			if "retired" not in self.remote: self.remote["retired"] = ({}, {}, {})
+			addReport(self.remote["retired"], (report[0], {}, report[2]))
+	def collect(self):
+		""" Our metrics with every remote report added in, as (counters, gauges, histograms). """
+		with self.lock:
+			merged = (dict(self.counters), {}, dict((name, self.histograms[name].copy()) for name in self.histograms))
+			for report in self.remote.values(): addReport(merged, report)
+			merged[1].update(self.gauges)
+		return merged
+def addReport(into, report):
+	""" Adds one (counters, gauges, histograms) report into another. Gauges already in 'into' win. Histograms in 'into' are changed in place,
+	so they must be copies. """
+	counters, gauges, histograms = report
+	for name in counters: into[0][name] = into[0].get(name, 0) + counters[name]
+	for name in gauges:
+		if name not in into[1]: into[1][name] = gauges[name]
+	for name in histograms:
+		if name in into[2]: into[2][name].merge(histograms[name])
+		else: into[2][name] = histograms[name].copy()
+def toPrometheus(snapshot, packetStats=None, prefix="wrapper"):
+	""" Renders a Metrics.snapshot() - and Proxy.getPacketStats(), if given - in the Prometheus text format, for the web server's /metrics. """
+	lines = []
+	def name(metric):
+		return prefix + "_" + re.sub("[^a-zA-Z0-9_]", "_", metric)
+	def histogram(metric, data, labels=""):
+		seen = 0
+		for bound, count in data["buckets"]:
+			seen += count
+			lines.append('%s_bucket{%sle="%s"} %d' % (metric, labels, bound, seen))
+		lines.append("%s_sum%s %f" % (metric, "{%s}" % labels.rstrip(",") if labels else "", data["sum"]))
+		lines.append("%s_count%s %d" % (metric, "{%s}" % labels.rstrip(",") if labels else "", data["count"]))
+	lines.append("# TYPE %s gauge" % name("uptime_seconds"))
+	lines.append("%s %f" % (name("uptime_seconds"), snapshot["uptime"]))
+	for metric in sorted(snapshot["counters"]):
+		lines.append("# TYPE %s counter" % name(metric))
+		lines.append("%s %s" % (name(metric), snapshot["counters"][metric]))
+	for metric in sorted(snapshot["gauges"]):
+		if not isinstance(snapshot["gauges"][metric], (int, long, float)): continue
+		lines.append("# TYPE %s gauge" % name(metric))
+		lines.append("%s %s" % (name(metric), snapshot["gauges"][metric]))
+	for metric in sorted(snapshot["histograms"]):
+		lines.append("# TYPE %s histogram" % name(metric))
+		histogram(name(metric), snapshot["histograms"][metric])
+	if packetStats:
+		fields = (("received", "proxy_packets_received_total"), ("sent", "proxy_packets_sent_total"),
+			("wireIn", "proxy_wire_bytes_received_total"), ("wireOut", "proxy_wire_bytes_sent_total"),
+			("bytesIn", "proxy_bytes_received_total"), ("bytesOut", "proxy_bytes_sent_total"),
+			("decodeTime", "proxy_decode_seconds_total"), ("handlerTime", "proxy_handler_seconds_total"))
+		for field, metric in fields:
+			lines.append("# TYPE %s counter" % name(metric))
+			for direction in ("clientbound", "serverbound"):
+				for id in sorted(packetStats[direction]):
+					lines.append('%s{direction="%s",id="0x%02x"} %s' % (name(metric), direction, id, packetStats[direction][id][field]))
+		lines.append("# TYPE %s histogram" % name("proxy_queue_seconds"))
+		for direction in sorted(packetStats["queueTime"]):
+			histogram(name("proxy_queue_seconds"), packetStats["queueTime"][direction], 'direction="%s",' % direction)
+	return "\n".join(lines) + "\n"
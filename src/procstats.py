@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# procstats.py - samples the server process' resource usage from /proc (so Linux only) into a fixed-size ring buffer. The sampler thread in
+# Server is the only thing that reads /proc; getMemoryUsage, the web UI, IRC and plugins all read the latest sample or the history instead.
+import os, time, threading
+# Samples are tuples in this order, to keep an hour of history small. rss is bytes, cpu is seconds of CPU time used so far, cpuPercent is
+# over the time since the previous sample (100 is one core), readBytes/writeBytes are bytes the process had read from/written to storage.
+# Any field /proc wouldn't give us (io and fd need the same user as the server) is None.
+FIELDS = ("time", "rss", "cpu", "cpuPercent", "threads", "readBytes", "writeBytes", "fds")
+try:
+	PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+	CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+except (AttributeError, ValueError, OSError): # Windows
+	PAGE_SIZE = CLOCK_TICKS = None
+def isSupported():
+	return not PAGE_SIZE == None and os.path.exists("/proc/self/stat")
+def readSample(pid, previous=None):
+	""" Reads one sample for a process. 'previous' is that process' last sample, for the CPU percentage. Raises IOError/OSError if the process
+	is gone. """
+	now = time.time()
+	with open("/proc/%d/stat" % pid, "r") as f:
+		stat = f.read()
+	fields = stat[stat.rindex(")") + 2:].split(" ") # the command name can contain spaces and parentheses, so split after it; fields[0] is field 3
+	cpu = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS) # utime + stime
+	threads = int(fields[17])
+	rss = int(fields[21]) * PAGE_SIZE
+	cpuPercent = None
+	if previous and now > previous[0]: cpuPercent = max(0.0, (cpu - previous[2]) / (now - previous[0]) * 100)
+	readBytes = writeBytes = None
+	try:
+		with open("/proc/%d/io" % pid, "r") as f:
+			for line in f:
+				key, value = line.split(":", 1)
+				if key == "read_bytes": readBytes = int(value)
+				elif key == "write_bytes": writeBytes = int(value)
+	except (IOError, OSError, ValueError): pass
+	try: fds = len(os.listdir("/proc/%d/fd" % pid))
+	except OSError: fds = None
+	return (now, rss, cpu, cpuPercent, threads, readBytes, writeBytes, fds)
+def toDict(sample):
+	if sample == None: return None
+	return dict(zip(FIELDS, sample))
+class RingBuffer:
+	""" The last 'size' samples. Appends come from the sampler thread only; readers take a copy under the lock. """
+	def __init__(self, size):
+		self.size = max(1, size)
+		self.samples = [None] * self.size
+		self.next = 0
+		self.count = 0
+		self.lock = threading.Lock()
+	def append(self, sample):
+		with self.lock:
+			self.samples[self.next] = sample
+			self.next = (self.next + 1) % self.size
+			self.count = min(self.count + 1, self.size)
+	def clear(self):
+		with self.lock:
+			self.samples = [None] * self.size
+			self.next = self.count = 0
+	def latest(self):
+		return self.samples[self.next - 1] if self.count else None
+	def history(self, since=None, points=None):
+		""" Samples oldest first, optionally only those taken after 'since'. With 'points', longer histories are cut into that many equal
+		runs of samples, each standing in for its run: the last sample of the run, with cpuPercent averaged over it so short spikes still
+		count. """
+		with self.lock:
+			start = self.next - self.count
+			samples = [self.samples[i % self.size] for i in range(start, self.next)]
+		if not since == None: samples = [sample for sample in samples if sample[0] > since]
+		if points == None or points < 1 or len(samples) <= points: return samples
+		downsampled = []
+		for i in range(points):
+			run = samples[len(samples) * i / points:len(samples) * (i + 1) / points]
+			percents = [sample[3] for sample in run if not sample[3] == None]
+			last = run[-1]
+			if percents: last = last[:3] + (sum(percents) / len(percents),) + last[4:]
+			downsampled.append(last)
+		return downsampled
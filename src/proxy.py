@@ -1,7 +1,7 @@
 # I'll probably split this file into more parts later on, like such: 
 # proxy folder: __init__.py (Proxy), client.py (Client), server.py (Server), network.py (Packet), bot.py (will contain Bot, for bot code)
 # this could definitely use some code-cleaning.  
-import socket, threading, struct, StringIO, time, traceback, json, random, hashlib, os, zlib, binascii, uuid, md5, storage
+import socket, threading, struct, StringIO, time, traceback, json, random, hashlib, os, zlib, binascii, uuid, md5, storage, backends, workers, capture, metrics, collections, inventory, bans
 from config import Config
 from api.entity import Entity
 from api.world import World
@@ -10,6 +10,7 @@ try: # Weird system for handling non-standard modules
 	IMPORT_SUCCESS = True
 except:
 	IMPORT_SUCCESS = False
+NO_BACKEND_MESSAGE = "No server is available right now. Please try connecting again in a few minutes"
 class Proxy:
 	def __init__(self, wrapper):
 		self.wrapper = wrapper
@@ -21,18 +22,54 @@ class Proxy:
 		self.skinTextures = {}
 		self.uuidTranslate = {}
 		self.storage = storage.Storage("proxy-data")
-		
+		self.status = {} # backend name -> cached status snapshot, kept fresh by pollStatus()
+		self.backends = backends.Backends(self)
+		self.workers = None # workers.Workers in the main process when proxy-workers > 1
+		self.worker = None # workers.WorkerChannel inside a forked worker process
+		self.remoteClients = {} # username -> info about clients that live in worker processes
+		self.packetTotals = {"clientbound": {}, "serverbound": {}} # packet stats of connections that have closed, see getPacketStats()
+		self.queueTimes = {"clientbound": metrics.Histogram(), "serverbound": metrics.Histogram()}
+		self.remotePacketStats = {} # worker pid -> (totals, queueTimes) it last reported, see workers.py
+		self.packetLock = threading.Lock()
+		self.tabCompleteCache = {} # (backend, username or None, text) -> (completions, time), see Client.completeTab()
+		compressionCache.maxBytes = self.wrapper.config["Proxy"]["compression-cache-size"]
+		compressionCache.ttl = self.wrapper.config["Proxy"]["compression-cache-ttl"]
+		self.privateKey = None
+		self.publicKey = None
+		self.addressIndex = bans.AddressIndex() # banned-address and allowed-address ranges, checked on every accept()
+		self.loadAddressIndex()
+	def host(self):
 		self.privateKey = encryption.generate_key_pair()
 		self.publicKey = encryption.encode_public_key(self.privateKey)
-	def host(self):
-		# get the protocol version from the server
-		while not self.wrapper.server.state == 2:
+		# get the protocol version from the server, or from the first other backend when the local one isn't in the pool
+		while "local" in self.getBackends() and not self.wrapper.server.state == 2:
 			time.sleep(.2)
-		self.pollServer()
+		self.updateStatus()
+		while not self.backends.getAlive() and not self.wrapper.halt:
+			time.sleep(1)
+			self.updateStatus()
+		t = threading.Thread(target=self.pollStatus, args=())
+		t.daemon = True
+		t.start()
+		if self.wrapper.config["Proxy"]["proxy-workers"] > 1:
+			if workers.isSupported():
+				self.workers = workers.Workers(self)
+				self.workers.start(self.wrapper.config["Proxy"]["proxy-workers"])
+				return
+			self.wrapper.log.warn("proxy-workers needs fork() and SO_REUSEPORT, which this system does not have - running a single proxy process")
+		if self.backends.isEnabled() and self.wrapper.config["Backends"]["pool-size"] > 0:
+			t = threading.Thread(target=self.backends.replenish, args=())
+			t.daemon = True
+			t.start()
+		self.bind()
+		self.listen()
+	def bind(self, reusePort=False):
 		while not self.socket:
 			try:
 				self.socket = socket.socket()
 				self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+				if reusePort: # every worker process binds its own socket to the same port and the kernel spreads connections between them
+					self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 				self.socket.bind((self.wrapper.config["Proxy"]["proxy-bind"], self.wrapper.config["Proxy"]["proxy-port"]))
 				self.socket.listen(5)
 			except:
@@ -40,44 +77,107 @@ class Proxy:
 				self.wrapper.log.debug(traceback.format_exc())
 				self.socket = False
 			time.sleep(5)
-	 	while not self.wrapper.halt:
-	 		try:
-		 		sock, addr = self.socket.accept()
-		 		client = Client(sock, addr, self.wrapper, self.publicKey, self.privateKey, self)
-		 		
-		 		t = threading.Thread(target=client.handle, args=())
-		 		t.daemon = True
-		 		t.start()
+	def listen(self):
+		while not self.wrapper.halt:
+			try:
+				sock, addr = self.socket.accept()
+				if self.addressIndex.isBanned(addr[0]):
+					self.wrapper.metrics.increment("proxy.banned_connections")
+					sock.close()
+					continue
+				client = Client(sock, addr, self.wrapper, self.publicKey, self.privateKey, self)
+				
+				t = threading.Thread(target=client.handle, args=())
+				t.daemon = True
+				t.start()
 
 				self.clients.append(client)
 
-		 		# remove stale clients
-		 		for i, client in enumerate(self.wrapper.proxy.clients):
+				# remove stale clients
+				for i, client in enumerate(self.wrapper.proxy.clients):
 					if client.abort:
 						del self.wrapper.proxy.clients[i]
-		 	except:
-		 		print traceback.print_exc()
-		 		try:
-		 			client.disconnect("Some error")
-		 		except:
-		 			pass
-	def pollServer(self):
+			except:
+				print traceback.print_exc()
+				try:
+					client.disconnect("Some error")
+				except:
+					pass
+	def getBackends(self):
+		""" Returns a dict of backend name -> (host, port) for every server the proxy can talk to. """
+		return self.backends.getBackends()
+	def pollStatus(self):
+		""" Background loop that keeps self.status fresh, so nothing else has to open sockets to learn the server's status """
+		while not self.wrapper.halt:
+			time.sleep(self.wrapper.config["Proxy"]["status-poll-interval"])
+			try:
+				self.updateStatus()
+			except:
+				self.wrapper.log.debug(traceback.format_exc())
+	def updateStatus(self):
+		backends = self.getBackends()
+		for name in backends:
+			host, port = backends[name]
+			try:
+				status = self.pollServer(host, port, self.wrapper.config["Proxy"]["status-poll-timeout"])
+				self.wrapper.metrics.observe("proxy.backend_latency.%s" % name, status["latency"])
+			except:
+				self.wrapper.log.debug("Status poll of backend '%s' failed:" % name)
+				self.wrapper.log.debug(traceback.format_exc())
+				self.wrapper.metrics.increment("proxy.backend_poll_failures.%s" % name)
+				if name in self.status: status = dict(self.status[name])
+				else: status = {"version": None, "protocol": -1, "players": 0, "maxPlayers": 0, "motd": None, "latency": None}
+				status["online"] = False
+				status["time"] = time.time()
+			self.status[name] = status
+		if "local" in backends: source = "local"
+		else: source = (self.backends.getAlive() or [None])[0]
+		if source and self.status[source]["online"]:
+			self.wrapper.server.protocolVersion = self.status[source]["protocol"]
+			self.wrapper.server.version = self.status[source]["version"]
+		if self.workers: self.workers.sync()
+	def getStatus(self, name="local"):
+		""" Returns the cached status snapshot of a backend, or None if it hasn't been polled yet. """
+		if name in self.status: return self.status[name]
+		return None
+	def pollServer(self, host="localhost", port=None, timeout=None):
+		""" Query a backend's status over the network. Returns a snapshot dict; raises on timeout or connection errors. """
+		if port == None: port = self.wrapper.config["Proxy"]["server-port"]
 		sock = socket.socket()
-		sock.connect(("localhost", self.wrapper.config["Proxy"]["server-port"]))
-		packet = Packet(sock, self)
-		
-		packet.send(0x00, "varint|string|ushort|varint", (5, "localhost", self.wrapper.config["Proxy"]["server-port"], 1))
-		packet.send(0x00, "", ())
-		packet.flush()
-		
-		while True:
-			id, original = packet.grabPacket()
-			if id == 0x00:
-				data = json.loads(packet.read("string:response")["response"])
-				self.wrapper.server.protocolVersion = data["version"]["protocol"]
-				self.wrapper.server.version = data["version"]["name"]
-				break
-		sock.close()
+		sock.settimeout(timeout)
+		try:
+			sock.connect((host, port))
+			packet = Packet(sock, self)
+			
+			packet.send(0x00, "varint|string|ushort|varint", (5, host, port, 1))
+			packet.send(0x00, "", ())
+			packet.flush()
+			
+			while True:
+				id, original = packet.grabPacket()
+				if id == 0x00:
+					data = json.loads(packet.read("string:response")["response"])
+					break
+			start = time.time()
+			packet.send(0x01, "long", (int(start * 1000),))
+			packet.flush()
+			while True:
+				id, original = packet.grabPacket()
+				if id == 0x01: break
+			latency = time.time() - start
+		finally:
+			sock.close()
+		try: players, maxPlayers = data["players"]["online"], data["players"]["max"]
+		except: players, maxPlayers = 0, 0
+		return {"online": True, "version": data["version"]["name"], "protocol": data["version"]["protocol"],
+			"players": players, "maxPlayers": maxPlayers, "motd": data.get("description"),
+			"latency": latency, "time": time.time()}
+	def broadcast(self, message):
+		""" Sends a JSON chat message to every client in the game. Returns the usernames it reached. """
+		delivered = []
+		for client in list(self.clients):
+			if client.sendChat(message): delivered.append(client.username)
+		return delivered
 	def getClientByServerUUID(self, id):
 		for client in self.clients:
 			if str(client.serverUUID) == str(id):
@@ -86,6 +186,7 @@ class Proxy:
 		if str(id) in self.uuidTranslate:
 			return uuid.UUID(hex=self.uuidTranslate[str(id)])
 	def lookupUUID(self, uuid):
+		if self.worker: return self.worker.call("lookupUUID", uuid)
 		#if not self.storage.key("uuid-cache"):
 #			self.storage.key("uuid-cache", {})
 		if "uuid-cache" not in self.storage:
@@ -99,6 +200,7 @@ class Proxy:
 		#		return i
 		return None
 	def lookupUsername(self, username):
+		if self.worker: return self.worker.call("lookupUsername", username)
 		if "uuid-cache" not in self.storage:
 			self.storage["uuid-cache"] = {}
 		for uuid in self.storage["uuid-cache"]:
@@ -111,27 +213,162 @@ class Proxy:
 	def formatUUID(self, name):
 		return uuid.UUID(bytes=name.decode("hex")).hex
 	def setUUID(self, uuid, name):
+		if self.worker: return self.worker.call("setUUID", uuid, name)
 		if not self.storage.key("uuid-cache"):
 			self.storage.key("uuid-cache", {})
 		self.storage.key("uuid-cache")[str(uuid)] = {"uuid": str(uuid), "name": name, "expiresOn": time.strftime("%Y-%m-%d %H:%M:%S %z")}
 	def banUUID(self, uuid, reason="Banned by an operator", source="Server"):
+		if self.worker: return self.worker.call("banUUID", uuid, reason, source)
 		if not self.storage.key("banned-uuid"):
 			self.storage.key("banned-uuid", {})
 		self.storage.key("banned-uuid")[str(uuid)] = {"reason": reason, "source": source, "created": time.time(), "name": self.lookupUUID(uuid)["name"]}
 	def isUUIDBanned(self, uuid): # Check if the UUID of the user is banned
+		if self.worker: return self.worker.call("isUUIDBanned", uuid)
 		if not self.storage.key("banned-uuid"):
 			self.storage.key("banned-uuid", {})
 		if uuid in self.storage.key("banned-uuid"):
 			return True
 		else:
 			return False
-	def isAddressBanned(self, address): # Check if the IP address is banned
-		if not self.storage.key("banned-address"):
-			self.storage.key("banned-address", {})
-		if address in self.storage.key("banned-address"):
-			return True
-		else:
-			return False
+	def isAddressBanned(self, address): # Check if the IP address is banned, either on its own or by a banned range that it isn't allowed out of
+		return self.addressIndex.isBanned(address)
+	def loadAddressIndex(self):
+		""" Builds the address index from the banned-address and allowed-address storage. Entries saved before ranges were supported are plain addresses, which parse as /32 (or /128) ranges. """
+		for key, kind in (("banned-address", bans.BAN), ("allowed-address", bans.ALLOW)):
+			if not self.storage.key(key):
+				self.storage.key(key, {})
+			for network in self.storage.key(key):
+				try: self.addressIndex.add(network, kind)
+				except ValueError: self.wrapper.log.warn("Ignoring invalid entry '%s' in %s" % (network, key))
+	def banAddress(self, network, reason="Banned by an operator", source="Server"):
+		""" Bans an IP address or CIDR range (e.g. 1.2.3.4, 1.2.3.0/24, 2001:db8::/32). Returns the range as stored. """
+		return self.setAddressRanges([network], bans.BAN, reason, source)[0]
+	def allowAddress(self, network, reason="Allowed by an operator", source="Server"):
+		""" Exempts an address or range from any wider banned range it falls in. """
+		return self.setAddressRanges([network], bans.ALLOW, reason, source)[0]
+	def pardonAddress(self, network):
+		""" Removes a ban or exemption for exactly this address or range. Returns False if there wasn't one. """
+		if self.worker: return self.worker.call("pardonAddress", network)
+		entry = self.addressIndex.remove(network)
+		if entry == None: return False
+		kind, key = entry
+		if kind == bans.BAN: del self.storage.key("banned-address")[key]
+		else: del self.storage.key("allowed-address")[key]
+		if self.workers: self.workers.syncAddresses([("remove", key, kind)])
+		return True
+	def importAddressBans(self, path, reason="Imported ban list", source="Server"):
+		""" Bans every address and range in a ban list file (see bans.readBanList for the formats). Returns how many were imported. """
+		if self.worker: return self.worker.call("importAddressBans", path, reason, source)
+		networks = bans.readBanList(path)
+		self.setAddressRanges(networks, bans.BAN, reason, source)
+		return len(networks)
+	def setAddressRanges(self, networks, kind, reason, source):
+		if self.worker: return self.worker.call("setAddressRanges", networks, kind, reason, source)
+		if kind == bans.BAN: key, other = "banned-address", "allowed-address"
+		else: key, other = "allowed-address", "banned-address"
+		if not self.storage.key(key):
+			self.storage.key(key, {})
+		entries, opposite = self.storage.key(key), self.storage.key(other) or {}
+		added = []
+		created = time.time()
+		for network in networks:
+			network = self.addressIndex.add(network, kind) # canonical form, so 1.2.3.4/32 and 1.2.3.4 are the same entry
+			if network in opposite: del opposite[network] # banning an allowed range (or the reverse) replaces it
+			entries[network] = {"reason": reason, "source": source, "created": created}
+			added.append(network)
+		if self.workers: self.workers.syncAddresses([("add", network, kind) for network in added])
+		return added
+	def getCompressionStats(self):
+		""" Aggregates CPU time against bytes saved for every connected client, grouped by zlib level. """
+		levels = {}
+		for client in self.clients:
+			packet = client.packet
+			if packet.compressLevel not in levels:
+				levels[packet.compressLevel] = {"clients": 0, "bytesIn": 0, "bytesOut": 0, "time": 0.0, "rtt": []}
+			level = levels[packet.compressLevel]
+			level["clients"] += 1
+			level["bytesIn"] += packet.compressBytesIn
+			level["bytesOut"] += packet.compressBytesOut
+			level["time"] += packet.compressTime
+			if client.rtt is not None: level["rtt"].append(client.rtt)
+		for id in levels:
+			level = levels[id]
+			if level["bytesIn"]: level["ratio"] = float(level["bytesOut"]) / level["bytesIn"]
+			else: level["ratio"] = None
+			if level["rtt"]: level["rtt"] = sum(level["rtt"]) / len(level["rtt"])
+			else: level["rtt"] = None
+		return levels
+	def mergePacketStats(self, totals, queueTimes, packet):
+		""" Adds one Packet's counters into totals. A Server's Packet receives clientbound and sends serverbound packets, a Client's the other way round. """
+		if packet.obj.isServer: received, sent = "clientbound", "serverbound"
+		else: received, sent = "serverbound", "clientbound"
+		for id, stats in packet.recvStats.items():
+			if id not in totals[received]: totals[received][id] = {"received": 0, "wireIn": 0, "bytesIn": 0, "decodeTime": 0.0, "handlerTime": 0.0, "sent": 0, "wireOut": 0, "bytesOut": 0}
+			entry = totals[received][id]
+			entry["received"] += stats[0]
+			entry["wireIn"] += stats[1]
+			entry["bytesIn"] += stats[2]
+			entry["decodeTime"] += stats[3]
+			entry["handlerTime"] += stats[4]
+		for id, stats in packet.sendStats.items():
+			if id not in totals[sent]: totals[sent][id] = {"received": 0, "wireIn": 0, "bytesIn": 0, "decodeTime": 0.0, "handlerTime": 0.0, "sent": 0, "wireOut": 0, "bytesOut": 0}
+			entry = totals[sent][id]
+			entry["sent"] += stats[0]
+			entry["wireOut"] += stats[1]
+			entry["bytesOut"] += stats[2]
+		queueTimes[sent].merge(packet.queueTime)
+	def retirePacketStats(self, packet):
+		""" Folds a closing connection's counters into the proxy-wide totals, once. """
+		with self.packetLock:
+			if packet.retired: return
+			packet.retired = True
+			self.mergePacketStats(self.packetTotals, self.queueTimes, packet)
+	def addPacketTotals(self, totals, queueTimes, otherTotals, otherQueueTimes):
+		for direction in otherTotals:
+			for id, entry in otherTotals[direction].items():
+				if id not in totals[direction]: totals[direction][id] = dict(entry)
+				else:
+					for field in entry: totals[direction][id][field] += entry[field]
+			queueTimes[direction].merge(otherQueueTimes[direction])
+	def collectPacketStats(self):
+		""" The raw (totals, queueTimes) behind getPacketStats(): closed connections, open ones, and what proxy workers last reported. """
+		with self.packetLock:
+			totals = {"clientbound": {}, "serverbound": {}}
+			queueTimes = {"clientbound": metrics.Histogram(), "serverbound": metrics.Histogram()}
+			self.addPacketTotals(totals, queueTimes, self.packetTotals, self.queueTimes)
+			for client in list(self.clients):
+				for packet in (client.packet, client.server.packet if client.server else None):
+					if packet and not packet.retired: self.mergePacketStats(totals, queueTimes, packet)
+			for remoteTotals, remoteQueueTimes in self.remotePacketStats.values():
+				self.addPacketTotals(totals, queueTimes, remoteTotals, remoteQueueTimes)
+		return totals, queueTimes
+	def setRemotePacketStats(self, pid, stats):
+		""" A worker's collectPacketStats(), replacing the one it sent before. """
+		with self.packetLock:
+			self.remotePacketStats[pid] = stats
+	def retireRemotePacketStats(self, pid):
+		""" A worker exited: what it last reported becomes part of the closed-connection totals. """
+		with self.packetLock:
+			stats = self.remotePacketStats.pop(pid, None)
+			if stats: self.addPacketTotals(self.packetTotals, self.queueTimes, *stats)
+	def getPacketStats(self):
+		""" Returns proxy-wide packet counters since startup, by direction ('clientbound'/'serverbound') and packet ID: packets, wire bytes (after
+		compression) and bytes (uncompressed) as received and as sent, plus seconds spent decoding and in parse(). 'queueTime' holds a histogram per
+		direction of how long packets waited in the send queue. """
+		totals, queueTimes = self.collectPacketStats()
+		return {"clientbound": totals["clientbound"], "serverbound": totals["serverbound"],
+			"queueTime": dict((direction, queueTimes[direction].toDict()) for direction in queueTimes)}
+	def getStickyBackend(self, uuid):
+		""" The backend a UUID was last connected to, for the sticky routing policy, or None. """
+		if self.worker: return self.worker.call("getStickyBackend", uuid)
+		return (self.storage.getKey("backend-sticky") or {}).get(str(uuid))
+	def setStickyBackend(self, uuid, name):
+		if self.worker: return self.worker.call("setStickyBackend", uuid, name)
+		if "backend-sticky" not in self.storage: self.storage["backend-sticky"] = {}
+		self.storage["backend-sticky"][str(uuid)] = name
+	def setSkin(self, uuid, skinBlob):
+		if self.worker: return self.worker.call("setSkin", uuid, skinBlob)
+		self.skins[str(uuid)] = skinBlob
 	def getSkinTexture(self, uuid):
 		if uuid not in self.skins: return False
 		if uuid in self.skinTextures:
@@ -154,6 +391,7 @@ class Client: # handle client/game connection
 		self.abort = False
 		self.log = wrapper.log
 		self.tPing = time.time()
+		self.rtt = None # smoothed keep-alive round trip time in seconds
 		self.server = None
 		self.isServer = False
 		self.isLocal = True
@@ -162,10 +400,14 @@ class Client: # handle client/game connection
 		self.server = None
 		self.address = None
 		self.handshake = False
+		self.backend = None # name of the backend from the [Backends] pool this client is on
+		self.capture = None # capture.CaptureWriter when capture-enabled is on
+		self.tabCompletes = collections.deque() # texts of tab-complete requests forwarded to the server, oldest first
 		
 		self.state = 0 # 0 = init, 1 = motd, 2 = login, 3 = active, 4 = authorizing
 		
 		self.packet = Packet(self.socket, self)
+		self.packet.bandwidthCap = self.config["Proxy"]["bandwidth-cap"]
 		self.send = self.packet.send
 		self.read = self.packet.read
 		self.sendRaw = self.packet.sendRaw
@@ -174,12 +416,12 @@ class Client: # handle client/game connection
 		self.gamemode = 0
 		self.dimension = 0
 		self.position = (0, 0, 0)
-		self.inventory = {}
+		self.playerInventory = inventory.Inventory(self) # see inventory.py
+		self.inventory = self.playerInventory.slots
 		self.slot = 0
 		self.riding = None
 		self.windowCounter = 2
 		self.properties = {}
-		for i in range(45): self.inventory[i] = None
 	def connect(self, ip=None, port=None):
 		if not self.server == None:
 			self.address = (ip, port)
@@ -187,22 +429,34 @@ class Client: # handle client/game connection
 			self.server_temp = Server(self, self.wrapper, ip, port)
 			try:
 				self.server_temp.connect()
-				self.server.close(kill_client=False)
+				if self.server: self.server.close(kill_client=False)
 				self.server = self.server_temp
 			except:
 				self.server_temp.close(kill_client=False)
 				self.server_temp = None	
+				if self.server == None and not "local" in self.proxy.getBackends():
+					self.log.warn("Could not connect %s to %s:%d" % (self.username, ip, port))
+					self.disconnect(NO_BACKEND_MESSAGE)
+					return
+				if self.server == None: # routing on login failed - fall back to the wrapper-managed server
+					self.log.warn("Could not connect %s to %s:%d - sending them to the local server instead" % (self.username, ip, port))
+					self.connect()
+					return
 				self.send(0x02, "string|byte", ("{text:'Could not connect to that server!', color:red, bold:true}", 0))
 				self.address = None
 				return
+			self.backend = self.proxy.backends.getNameByAddress(ip, port)
 		else:
+			self.backend = "local"
 			self.server = Server(self, self.wrapper, ip, port)
 			self.server.connect()
+		self.proxy.backends.remember(self)
 		t = threading.Thread(target=self.server.handle, args=())
 		t.daemon = True
 		t.start()
 		
-		self.server.send(0x00, "varint|string|ushort|varint", (self.version, "localhost", self.config["Proxy"]["server-port"], 2))
+		if ip == None: ip, port = "localhost", self.config["Proxy"]["server-port"]
+		self.server.send(0x00, "varint|string|ushort|varint", (self.version, ip, port, 2))
 		self.server.send(0x00, "string", (self.username,))
 #		self.server.send(0x46, "varint", (-1,))
 #		self.server.packet.compression = True
@@ -214,12 +468,63 @@ class Client: # handle client/game connection
 			self.socket.close()
 		except:
 			pass
+		if self.capture:
+			self.capture.close()
+		self.proxy.retirePacketStats(self.packet)
 		if self.server:
 			self.server.abort = True
 			self.server.close()
 		for i, client in enumerate(self.wrapper.proxy.clients):
 			if client.username == self.username:
 				del self.wrapper.proxy.clients[i]
+		if self.proxy.worker and self.state == 3:
+			try: self.proxy.worker.call("clientLeft", self.username)
+			except: pass
+	def startCapture(self):
+		if not self.config["Proxy"]["capture-enabled"]: return
+		try:
+			self.capture = capture.openCapture(self.config["Proxy"]["capture-directory"], self.username, self.version, self.packet.compressThreshold)
+			self.log.debug("Capturing %s's packets to %s" % (self.username, self.capture.path))
+		except:
+			self.log.error("Could not start a packet capture for %s:" % self.username)
+			self.log.getTraceback()
+	def getTabCompleteKey(self, text):
+		""" Chat completions (player names) are the same for everyone on a backend; command completions can depend on the player's permissions. """
+		if text.startswith("/"): return (self.backend, self.username, text)
+		return (self.backend, None, text)
+	def completeTab(self, matches):
+		""" Called by Server.parse with the server's answer to the oldest forwarded tab-complete request. """
+		try: text = self.tabCompletes.popleft()
+		except IndexError: text = None
+		if text == None:
+			self.sendTabComplete(None, matches)
+			return
+		cache = self.proxy.tabCompleteCache
+		if self.config["Proxy"]["tab-complete-cache-ttl"] > 0:
+			if len(cache) > 1000: # drop everything that has expired
+				for key, value in cache.items():
+					if time.time() - value[1] >= self.config["Proxy"]["tab-complete-cache-ttl"]: cache.pop(key, None)
+			cache[self.getTabCompleteKey(text)] = (matches, time.time())
+		self.sendTabComplete(text, matches)
+	def sendTabComplete(self, text, matches):
+		""" Sends completions to the client, adding the wrapper's plugin commands when the player is completing a command name. """
+		if text and text.startswith("/") and " " not in text:
+			matches = list(matches)
+			player = self.getPlayerObject()
+			for pluginID in self.wrapper.commands:
+				for name, command in self.wrapper.commands[pluginID].items():
+					if not ("/" + name).startswith(text.lower()) or "/" + name in matches: continue
+					if command["permission"] and not self.mayComplete(player, command["permission"]): continue
+					matches.append("/" + name)
+			matches.sort()
+		self.send(0x3a, "varint|raw", (len(matches), "".join(self.packet.send_string(match) for match in matches)))
+	def mayComplete(self, player, permission):
+		""" Whether to offer a permissioned plugin command in tab completion. Errors deny it rather than ending the connection. """
+		if not player: return False
+		try: return player.hasPermission(permission)
+		except:
+			self.log.debug("Couldn't check permission '%s' for %s: %s" % (permission, self.username, traceback.format_exc().splitlines()[-1]))
+			return False
 	def disconnect(self, message):
 		try: 
 			message = json.loads(message["string"])
@@ -234,6 +539,21 @@ class Client: # handle client/game connection
 		while not self.abort:
 			self.packet.flush()
 			time.sleep(0.05)
+	def adaptCompression(self):
+		""" Picks this client's compression threshold and zlib level from its keep-alive RTT: LAN clients barely get compressed, slow links get small frames. """
+		config = self.config["Proxy"]
+		if not config["adaptive-compression"] or self.rtt == None: return
+		if self.packet.compressThreshold == -1: return # compression was never turned on for this client
+		if self.rtt < config["compression-lan-rtt"]:
+			threshold, level = config["compression-threshold-max"], 1
+		elif self.rtt > config["compression-slow-rtt"]:
+			threshold, level = config["compression-threshold-min"], 9
+		else:
+			threshold, level = config["compression-threshold"], 6
+		self.packet.compressLevel = level
+		if not threshold == self.packet.compressThreshold and self.version > 26 and self.version < 48: # Set Compression only exists in the play state on 1.8
+			self.log.debug("Changing compression threshold for %s to %d (RTT: %.1fms)" % (self.username, threshold, self.rtt * 1000))
+			self.packet.setCompression(threshold, id=0x46)
 	# UUID operations
 	def UUIDIntToHex(self, uuid):
 		uuid = uuid.encode("hex")
@@ -257,6 +577,14 @@ class Client: # handle client/game connection
 		return False
 	def message(self, string):
 		self.server.send(0x01, "string", (string,))
+	def sendChat(self, message, position=0):
+		""" Queues a JSON chat message (already serialized) for this client. Returns False if the client isn't in the game. """
+		if self.abort or not self.state == 3 or self.server == None or not self.server.safe: return False
+		if self.version > 10:
+			self.send(0x02, "string|byte", (message, position))
+		else:
+			self.send(0x02, "string", (message,))
+		return True
 	def parse(self, id):
 		if id == 0x00:
 			if self.state == 0:
@@ -266,7 +594,7 @@ class Client: # handle client/game connection
 				if not self.wrapper.server.protocolVersion == self.version and data["state"] == 2:
 					self.disconnect("You're not running the same Minecraft version as the server!")
 					return
-				if not self.wrapper.server.state == 2:
+				if "local" in self.proxy.getBackends() and not self.wrapper.server.state == 2:
 					self.disconnect("Server has not finished booting. Please try connecting again in a few seconds")
 					return
 				if data["state"] in (1, 2):
@@ -305,14 +633,26 @@ class Client: # handle client/game connection
 					else:
 						self.send(0x01, "string|bytearray|bytearray", (self.serverID, self.publicKey, self.verifyToken))
 				else:
-					self.connect()
 					self.uuid = uuid.uuid3(uuid.NAMESPACE_OID, "OfflinePlayer: %s" % self.username)
 					self.serverUUID = self.UUIDFromName("OfflinePlayer:" + self.username)
+					self.startCapture()
+					address = self.proxy.backends.route(self)
+					if address == None:
+						self.disconnect(NO_BACKEND_MESSAGE)
+						return False
+					self.connect(*address)
 					self.send(0x02, "string|string", (str(self.uuid), self.username))
 					self.state = 3
 					self.log.info("%s logged in (IP: %s)" % (self.username, self.addr[0]))
+					if self.proxy.worker: self.proxy.worker.call("clientJoined", self.username, self.uuid, self.serverUUID, self.addr[0], os.getpid())
 				return False
-			elif self.state == 3:
+			elif self.state == 3: # Keep Alive response to one of ours
+				sentAt = self.packet.keepAlives.pop(self.original, None)
+				if sentAt:
+					rtt = time.time() - sentAt
+					if self.rtt == None: self.rtt = rtt
+					else: self.rtt = self.rtt * 0.8 + rtt * 0.2
+					self.adaptCompression()
 				return False
 		if id == 0x01:
 			if self.state == 3: # chat packet
@@ -364,7 +704,7 @@ class Client: # handle client/game connection
 					for property in data["properties"]:
 						if property["name"] == "textures":
 							self.skinBlob = property["value"]
-							self.wrapper.proxy.skins[str(self.uuid)] = self.skinBlob
+							self.proxy.setSkin(self.uuid, self.skinBlob)
 					self.properties = data["properties"]
 				except:
 					self.disconnect("Session Server Error")
@@ -375,7 +715,7 @@ class Client: # handle client/game connection
 				self.serverUUID = self.UUIDFromName("OfflinePlayer:" + self.username)
 				
 				if self.version > 26:
-					self.packet.setCompression(256)
+					self.packet.setCompression(self.config["Proxy"]["compression-threshold"])
 					
 				# Ban code should go here
 
@@ -385,22 +725,45 @@ class Client: # handle client/game connection
 
 				self.send(0x02, "string|string", (str(self.uuid), self.username))
 				self.state = 3
-				self.connect()
+				self.startCapture()
+				address = self.proxy.backends.route(self)
+				if address == None:
+					self.disconnect(NO_BACKEND_MESSAGE)
+					return False
+				self.connect(*address)
 				
 				self.log.info("%s logged in (UUID: %s | IP: %s)" % (self.username, self.uuid, self.addr[0]))
 				self.proxy.setUUID(self.uuid, self.username)
+				if self.proxy.worker: self.proxy.worker.call("clientJoined", self.username, self.uuid, self.serverUUID, self.addr[0], os.getpid())
 				
 				return False
 			elif self.state == 5: # ping packet during status request
 				keepAlive = self.read("long:keepAlive")["keepAlive"]
 				self.send(0x01, "long", (keepAlive,))
+		if id == 0x14: # Tab-Complete
+			if self.state is not 3 or not self.server: return True
+			if self.version > 46: data = self.read("string:text|bool:has_position")
+			else: data = self.read("string:text")
+			if data["text"] == None: return True
+			if data.get("has_position"): # completing a block position - depends on what the player is looking at, so don't cache or touch it
+				self.tabCompletes.append(None)
+				return True
+			cached = self.proxy.tabCompleteCache.get(self.getTabCompleteKey(data["text"]))
+			if cached and time.time() - cached[1] < self.config["Proxy"]["tab-complete-cache-ttl"]:
+				self.wrapper.metrics.increment("proxy.tab_complete_hits")
+				self.sendTabComplete(data["text"], cached[0])
+				return False
+			self.wrapper.metrics.increment("proxy.tab_complete_misses")
+			self.tabCompletes.append(data["text"])
 		if id == 0x04:
 			data = self.read("double:x|double:y|double:z|bool:on_ground")
 			self.position = (data["x"], data["y"], data["z"])
+			if self.server and self.server.culled: self.server.resyncCulled()
 		if id == 0x06:
 			data = self.read("double:x|double:y|double:z|float:yaw|float:pitch|bool:on_ground")
 			#objection = self.wrapper.callEvent("player.move", {"player": self.username, "xyz": (data["x"], data["y"], data["z"]), "on_ground": data["on_ground"]})
 			self.position = (data["x"], data["y"], data["z"])
+			if self.server and self.server.culled: self.server.resyncCulled()
 			if self.server.state is not 3: return False
 		if id == 0x07: # Player Block Dig
 			if not self.isLocal == True: return True
@@ -448,10 +811,22 @@ class Client: # handle client/game connection
 			if self.server.state is not 3: return False
 		if id == 0x09: # Held Item Change
 			slot = self.read("short:short")["short"]
-			if self.slot > -1 and self.slot < 9:
+			if slot > -1 and slot < 9:
 				self.slot = slot
 			else:
 				return False
+		if id == 0x0d: # Close Window
+			self.playerInventory.closeWindow(self.read("ubyte:wid")["wid"])
+		if id == 0x0e: # Click Window
+			data = self.read("ubyte:wid|short:slot|byte:button|short:action|byte:mode")
+			self.playerInventory.click(data["wid"], data["slot"], data["button"], data["mode"])
+		if id == 0x10: # Creative Inventory Action
+			slot = self.read("short:slot")["slot"]
+			try: item = self.packet.read_slot()
+			except:
+				self.log.debug("Couldn't decode an item from %s: %s" % (self.username, traceback.format_exc().splitlines()[-1]))
+				self.playerInventory.markStale(0)
+			else: self.playerInventory.creativeSet(slot, item)
 		return True
 	def handle(self):
 		t = threading.Thread(target=self.flush, args=())
@@ -462,6 +837,7 @@ class Client: # handle client/game connection
 				try:
 					id, original = self.packet.grabPacket()
 					self.original = original
+					if self.capture and self.state == 3: self.capture.write(capture.SERVERBOUND, original)
 				except EOFError:
 					self.close()
 					break
@@ -477,9 +853,11 @@ class Client: # handle client/game connection
 					else:
 						self.send(0x00, "int", (random.randrange(0, 99999),))
 					self.tPing = time.time()
+				start = time.time()
 				if self.parse(id) and self.server:
 					if self.server.state == 3:
 						self.server.sendRaw(original)
+				self.packet.addHandlerTime(id, time.time() - start)
 		except:
 			print "Error in the Client->Server method:"
 			print traceback.format_exc()
@@ -492,19 +870,25 @@ class Server: # Handle Server Connection
 		self.abort = False
 		self.isServer = True
 		self.proxy = wrapper.proxy
-		self.lastPacketIDs = []
+		self.lastPacketIDs = collections.deque(maxlen=10)
 		
 		self.state = 0 # 0 = init, 1 = motd, 2 = login, 3 = active, 4 = authorizing
 		self.packet = None
 		self.version = self.wrapper.server.protocolVersion
 		self.log = wrapper.log
 		self.safe = False
+		
+		# entity-culling state. Positions are kept per connection (the shared world.entities is fed by every player's connection) and in the protocol's fixed-point units
+		self.entityPositions = {} # eid -> [x, y, z, yaw, pitch, on_ground]
+		self.culled = {} # eid -> time of the last teleport sent while out of range
+		self.eid = None
+		self.vehicle = None
+		self.lastResync = 0
 	def connect(self):
-		self.socket = socket.socket()
 		if self.ip == None:
-			self.socket.connect(("localhost", self.wrapper.config["Proxy"]["server-port"]))
+			self.socket = self.proxy.backends.getConnection("localhost", self.wrapper.config["Proxy"]["server-port"])
 		else:
-			self.socket.connect((self.ip, self.port))
+			self.socket = self.proxy.backends.getConnection(self.ip, self.port)
 			self.client.isLocal = False
 		
 		self.packet = Packet(self.socket, self)
@@ -521,8 +905,9 @@ class Server: # Handle Server Connection
 	def close(self, reason="Disconnected", kill_client=True):
 		if Config.debug:
 			print "Last packet IDs (Server->Client) before disconnection:"
-			print self.lastPacketIDs
+			print list(self.lastPacketIDs)
 		self.abort = True
+		if self.packet: self.proxy.retirePacketStats(self.packet)
 		self.packet = None
 		try:
 			self.socket.close()
@@ -560,6 +945,50 @@ class Server: # Handle Server Connection
 #				self.close()
 #				break
 			time.sleep(0.05)
+	def isCulling(self):
+		return self.wrapper.config["Proxy"]["entity-culling"] and self.client.version > 46 and self.state == 3
+	def isInRange(self, eid):
+		position = self.entityPositions.get(eid)
+		if position == None or self.client.position == (0, 0, 0): return True
+		distance = self.wrapper.config["Proxy"]["entity-culling-distance"]
+		x, y, z = self.client.position
+		dx, dy, dz = position[0] / 32.0 - x, position[1] / 32.0 - y, position[2] / 32.0 - z
+		return dx * dx + dy * dy + dz * dz <= distance * distance
+	def inventoryError(self, wid):
+		""" An item in an inventory packet couldn't be decoded (a malformed slot, or NBT we don't understand). The packet is still relayed;
+		our copy of the window just can't be trusted until the next Window Items. """
+		self.log.debug("Couldn't decode an item for %s: %s" % (self.client.username, traceback.format_exc().splitlines()[-1]))
+		self.client.playerInventory.markStale(wid)
+	def sendEntityTeleport(self, eid):
+		x, y, z, yaw, pitch, onGround = self.entityPositions[eid]
+		self.client.send(0x18, "varint|int|int|int|byte|byte|bool", (eid, x, y, z, yaw, pitch, onGround))
+	def cullMovement(self, eid, absolute=False):
+		""" Returns True if a movement packet for eid should be forwarded as-is. Distant entities are either dropped or sent as a teleport every
+		entity-culling-interval seconds; an entity coming back into range gets a teleport in place of the relative move the client can't apply. """
+		if eid == self.eid or eid == self.vehicle: return True
+		if self.isInRange(eid):
+			if eid not in self.culled: return True
+			del self.culled[eid]
+			if absolute: return True
+			self.sendEntityTeleport(eid)
+			return False
+		interval = self.wrapper.config["Proxy"]["entity-culling-interval"]
+		last = self.culled.get(eid, 0)
+		if interval > 0 and time.time() - last >= interval and eid in self.entityPositions:
+			self.culled[eid] = time.time()
+			self.sendEntityTeleport(eid)
+		else:
+			self.culled[eid] = last
+			self.wrapper.metrics.increment("proxy.culled_packets")
+		return False
+	def resyncCulled(self):
+		""" Called as the player moves: culled entities that the player walked up to (rather than the other way round) are teleported into place. """
+		if time.time() - self.lastResync < 0.5: return
+		self.lastResync = time.time()
+		for eid in self.culled.keys():
+			if eid in self.entityPositions and self.isInRange(eid):
+				self.culled.pop(eid, None)
+				self.sendEntityTeleport(eid)
 	def parse(self, id, original):
 		if id == 0x00:
 			if self.state < 3:
@@ -578,6 +1007,7 @@ class Server: # Handle Server Connection
 				data = self.read("int:eid|ubyte:gamemode|byte:dimension|ubyte:difficulty|ubyte:max_players|string:level_type")
 				self.client.gamemode = data["gamemode"]
 				self.client.dimension = data["dimension"]
+				self.client.packet.schedule = True
 				self.eid = data["eid"]  # This is the EID of the player on this particular server - not always the EID that the client is aware of 
 				if self.client.handshake:
 					self.client.send(0x07, "int|ubyte|ubyte|string", (self.client.dimension, data["difficulty"], data["gamemode"], data["level_type"]))
@@ -620,12 +1050,18 @@ class Server: # Handle Server Connection
 			data = self.read("int:dimension|ubyte:difficulty|ubyte:gamemode|level_type:string")
 			self.client.gamemode = data["gamemode"]
 			self.client.dimension = data["dimension"]
+			self.entityPositions = {}
+			self.culled = {}
 		if id == 0x08: # Player Position and Look
 			data = self.read("double:x|double:y|double:z|float:yaw|float:pitch")
 			x, y, z, yaw, pitch = data["x"], data["y"], data["z"], data["yaw"], data["pitch"]
 			self.client.position = (x, y, z)
+		if id == 0x09: # Held Item Change
+			slot = self.read("byte:slot")["slot"]
+			if slot > -1 and slot < 9: self.client.slot = slot
 		if id == 0x0c: # Spawn Player
 			data = self.read("varint:eid|uuid:uuid|int:x|int:y|int:z|byte:yaw|byte:pitch|short:item|rest:metadata")
+			if self.isCulling(): self.entityPositions[data["eid"]] = [data["x"], data["y"], data["z"], data["yaw"], data["pitch"], True]
 			if self.proxy.getClientByServerUUID(data["uuid"]):
 				self.client.send(0x0c, "varint|uuid|int|int|int|byte|byte|short|raw", (
 					data["eid"],
@@ -642,22 +1078,70 @@ class Server: # Handle Server Connection
 			data = self.read("varint:eid|byte:type|int:x|int:y|int:z|byte:pitch|byte:yaw")
 			eid, type, x, y, z, pitch, yaw = data["eid"], data["type"], data["x"], data["y"], data["z"], data["pitch"], data["yaw"]
 			self.wrapper.server.world.entities[data["eid"]] = Entity(eid, type, (x, y, z), (pitch, yaw), True)
+			if self.isCulling(): self.entityPositions[eid] = [x, y, z, yaw, pitch, True]
 		if id == 0x0f: # Spawn Mob
 			data = self.read("varint:eid|ubyte:type|int:x|int:y|int:z|byte:pitch|byte:yaw|byte:head_pitch")
 			eid, type, x, y, z, pitch, yaw, head_pitch = data["eid"], data["type"], data["x"], data["y"], data["z"], data["pitch"], data["yaw"], data["head_pitch"]
 			self.wrapper.server.world.entities[data["eid"]] = Entity(eid, type, (x, y, z), (pitch, yaw, head_pitch), False)
+			if self.isCulling(): self.entityPositions[eid] = [x, y, z, yaw, pitch, True]
+		if id == 0x11: # Spawn Experience Orb
+			if self.isCulling():
+				data = self.read("varint:eid|int:x|int:y|int:z")
+				self.entityPositions[data["eid"]] = [data["x"], data["y"], data["z"], 0, 0, True]
+		if id == 0x12: # Entity Velocity
+			if self.isCulling():
+				if not self.cullMovement(self.read("varint:eid")["eid"]): return False
+		if id == 0x13: # Destroy Entities
+			if self.entityPositions or self.culled: # pruned even with culling off, in case it was turned off mid-session
+				count = self.read("varint:count")["count"]
+				for i in range(count):
+					eid = self.read("varint:eid")["eid"]
+					self.entityPositions.pop(eid, None)
+					self.culled.pop(eid, None)
 	#	if id == 0x21: # Chunk Data
 #			if self.client.packet.compressThreshold == -1:
 #				print "CLIENT COMPRESSION ENABLED"
 #				self.client.packet.setCompression(256)
 		if id == 0x15: # Entity Relative Move
-			data = self.read("varint:eid|byte:dx|byte:dy|byte:dz")
+			data = self.read("varint:eid|byte:dx|byte:dy|byte:dz|bool:on_ground")
 			if not self.wrapper.server.world.getEntityByEID(data["eid"]) == None:
 				self.wrapper.server.world.getEntityByEID(data["eid"]).moveRelative((data["dx"], data["dy"], data["dz"]))
+			if data["eid"] in self.entityPositions:
+				position = self.entityPositions[data["eid"]]
+				position[0] += data["dx"]; position[1] += data["dy"]; position[2] += data["dz"]; position[5] = data["on_ground"]
+			if self.isCulling() and not self.cullMovement(data["eid"]): return False
+		if id == 0x16: # Entity Look
+			if self.isCulling():
+				data = self.read("varint:eid|byte:yaw|byte:pitch|bool:on_ground")
+				if data["eid"] in self.entityPositions:
+					self.entityPositions[data["eid"]][3:6] = [data["yaw"], data["pitch"], data["on_ground"]]
+				if not self.cullMovement(data["eid"]): return False
+		if id == 0x17: # Entity Look and Relative Move
+			if self.isCulling():
+				data = self.read("varint:eid|byte:dx|byte:dy|byte:dz|byte:yaw|byte:pitch|bool:on_ground")
+				if data["eid"] in self.entityPositions:
+					position = self.entityPositions[data["eid"]]
+					position[0] += data["dx"]; position[1] += data["dy"]; position[2] += data["dz"]
+					position[3:6] = [data["yaw"], data["pitch"], data["on_ground"]]
+				if not self.cullMovement(data["eid"]): return False
 		if id == 0x18: # Entity Teleport
-			data = self.read("varint:eid|int:x|int:y|int:z|byte:yaw|byte:pitch")
+			data = self.read("varint:eid|int:x|int:y|int:z|byte:yaw|byte:pitch|bool:on_ground")
 			if not self.wrapper.server.world.getEntityByEID(data["eid"]) == None:
 				self.wrapper.server.world.getEntityByEID(data["eid"]).teleport((data["x"], data["y"], data["z"]))
+			if self.isCulling():
+				self.entityPositions[data["eid"]] = [data["x"], data["y"], data["z"], data["yaw"], data["pitch"], data["on_ground"]]
+				if not self.cullMovement(data["eid"], absolute=True): return False
+		if id == 0x19: # Entity Head Look
+			if self.isCulling():
+				if not self.cullMovement(self.read("varint:eid")["eid"]): return False
+		if id == 0x3a: # Tab-Complete
+			if self.state == 3:
+				count = self.read("varint:count")["count"]
+				matches = []
+				for i in range(count):
+					matches.append(self.read("string:match")["match"].decode("utf8"))
+				self.client.completeTab(matches)
+				return False
 		if id == 0x1b: # Attach Entity
 			data = self.read("int:eid|int:vid|bool:leash")
 			eid, vid, leash = data["eid"], data["vid"], data["leash"]
@@ -667,9 +1151,11 @@ class Server: # Handle Server Connection
 				if vid == -1:
 					self.wrapper.callEvent("player.unmount", {"player": player})
 					self.client.riding = None
+					self.vehicle = None
 				else:
 					self.wrapper.callEvent("player.mount", {"player": player, "vehicle_id": vid, "leash": leash})
 					self.client.riding = self.wrapper.server.world.getEntityByEID(vid)
+					self.vehicle = vid
 					self.wrapper.server.world.getEntityByEID(vid).rodeBy = self.client
 		if id == 0x26: # Map Chunk Bulk
 			data = self.read("bool:skylight|varint:chunks")
@@ -699,10 +1185,31 @@ class Server: # Handle Server Connection
 			data = self.read("ubyte:reason|float:value")
 			if data["reason"] == 3:
 				self.client.gamemode = data["value"]
-		if id == 0x2f:
-			data = self.read("byte:wid|short:slot|slot:data")
-			if data["wid"] == 0:
-				self.client.inventory[data["slot"]] = data["data"]
+		if id == 0x2d: # Open Window
+			if self.client.version > 10:
+				data = self.read("ubyte:wid|string:type|json:title|ubyte:slots")
+				if data["type"] == "EntityHorse": entity = self.read("int:eid")["eid"]
+				else: entity = None
+			else:
+				data = self.read("ubyte:wid|ubyte:type|string:title|ubyte:slots|bool:custom")
+				if data["type"] == 11: entity = self.read("int:eid")["eid"]
+				else: entity = None
+			self.client.playerInventory.openWindow(data["wid"], data["type"], data["title"], data["slots"], entity)
+		if id == 0x2e: # Close Window
+			self.client.playerInventory.closeWindow(self.read("ubyte:wid")["wid"])
+		if id == 0x2f: # Set Slot
+			data = self.read("byte:wid|short:slot")
+			try: item = self.packet.read_slot()
+			except: self.inventoryError(data["wid"])
+			else: self.client.playerInventory.setItem(data["wid"], data["slot"], item)
+		if id == 0x30: # Window Items
+			data = self.read("ubyte:wid|short:count")
+			try: items = [self.packet.read_slot() for i in range(data["count"])]
+			except: self.inventoryError(data["wid"])
+			else: self.client.playerInventory.setItems(data["wid"], items)
+		if id == 0x31: # Window Property
+			data = self.read("ubyte:wid|short:property|short:value")
+			self.client.playerInventory.setProperty(data["wid"], data["property"], data["value"])
 		if id == 0x40:
 			message = self.read("json:json")["json"]
 			self.log.info("Disconnected from server: %s" % message)
@@ -762,11 +1269,8 @@ class Server: # Handle Server Connection
 			while not self.abort:
 				try:
 					id, original = self.packet.grabPacket()
+					if self.client.capture and self.state == 3: self.client.capture.write(capture.CLIENTBOUND, original)
 					self.lastPacketIDs.append((hex(id), len(original)))
-					if len(self.lastPacketIDs) > 10:
-						for i,v in enumerate(self.lastPacketIDs):
-							del self.lastPacketIDs[i]
-							break
 				except EOFError:
 					print traceback.format_exc()
 					self.close()
@@ -780,15 +1284,75 @@ class Server: # Handle Server Connection
 				if self.client.abort:
 					self.close()
 					break
+				start = time.time()
 				if self.parse(id, original) and self.safe:
 					self.client.sendRaw(original)
+				if self.packet: self.packet.addHandlerTime(id, time.time() - start)
 		except:
 			if Config.debug:
 				print "Error in the Server->Client method:"
 				print traceback.format_exc()
 
 
+class CompressionCache:
+	""" Shares zlib output between connections that send byte-identical packets - e.g. the same spawn chunks going to everyone in a join wave. Entries are keyed by a hash of the uncompressed payload and the compression level, and expire after a few seconds. """
+	def __init__(self, maxBytes=16 * 1024 * 1024, ttl=5, minSize=1024):
+		self.maxBytes = maxBytes
+		self.ttl = ttl
+		self.minSize = minSize # hashing small packets costs about as much as compressing them
+		self.entries = collections.OrderedDict() # key -> (compressed, created), oldest first
+		self.size = 0
+		self.lock = threading.Lock()
+		
+		self.hits = 0
+		self.misses = 0
+		self.bytesIn = 0 # uncompressed bytes that went through zlib
+		self.compressTime = 0.0 # seconds spent in zlib on misses
+		self.hashTime = 0.0 # seconds spent hashing payloads, the price of the cache
+		self.savedBytes = 0 # uncompressed bytes served from the cache instead of zlib
+	def compress(self, payload, level=6):
+		if self.maxBytes < 1 or len(payload) < self.minSize:
+			return zlib.compress(payload, level)
+		start = time.time()
+		key = (hashlib.sha1(payload).digest(), level)
+		self.hashTime += time.time() - start
+		with self.lock:
+			if key in self.entries:
+				compressed, created = self.entries[key]
+				if time.time() - created < self.ttl:
+					self.hits += 1
+					self.savedBytes += len(payload)
+					return compressed
+				del self.entries[key]
+				self.size -= len(compressed)
+		start = time.time()
+		compressed = zlib.compress(payload, level)
+		elapsed = time.time() - start
+		with self.lock:
+			self.misses += 1
+			self.bytesIn += len(payload)
+			self.compressTime += elapsed
+			if key not in self.entries:
+				self.entries[key] = (compressed, time.time())
+				self.size += len(compressed)
+			while self.size > self.maxBytes and len(self.entries) > 0:
+				oldKey, oldEntry = self.entries.popitem(last=False)
+				self.size -= len(oldEntry[0])
+		return compressed
+	def getStats(self):
+		""" Hit rate plus an estimate of the zlib time saved, based on the measured cost per byte of misses. """
+		lookups = self.hits + self.misses
+		if lookups: hitRate = float(self.hits) / lookups
+		else: hitRate = None
+		if self.bytesIn: timeSaved = self.compressTime / self.bytesIn * self.savedBytes
+		else: timeSaved = 0.0
+		return {"hits": self.hits, "misses": self.misses, "hitRate": hitRate, "entries": len(self.entries), "size": self.size,
+			"compressTime": self.compressTime, "hashTime": self.hashTime, "timeSaved": timeSaved, "savedBytes": self.savedBytes}
+compressionCache = CompressionCache()
+NBT_SIZES = {1: 1, 2: 2, 3: 4, 4: 8, 5: 4, 6: 8} # payload sizes of the fixed-width NBT tag types, for skipping over them
 class Packet: # PACKET PARSING CODE
+	PRIORITY_PACKETS = (0x00, 0x02, 0x08) # Keep Alive, Chat, Player Position And Look - allowed to skip ahead of bulk data going to the client
+	BARRIER_PACKETS = (0x01, 0x07, 0x46) # Join Game, Respawn, Set Compression - nothing gets reordered across these
 	def __init__(self, socket, obj):
 		self.socket = socket
 		
@@ -803,6 +1367,25 @@ class Packet: # PACKET PARSING CODE
 		
 		self.buffer = StringIO.StringIO()
 		self.queue = []
+		self.queueLock = threading.Lock()
+		
+		# Bandwidth accounting and outbound scheduling. schedule is switched on once the client has joined the game.
+		self.schedule = False
+		self.bandwidthCap = 0 # bytes per second, 0 for unlimited
+		self.budget = 0
+		self.lastFlush = time.time()
+		self.sendStats = {} # packet ID -> [packets, wire bytes, uncompressed bytes]
+		self.recvStats = {} # packet ID -> [packets, wire bytes, uncompressed bytes, seconds decoding, seconds in parse()]
+		self.queueTime = metrics.Histogram() # seconds between sendRaw() and the packet going out
+		self.retired = False # counters already folded into Proxy.packetTotals
+		self.bytesSent = 0
+		self.bytesReceived = 0
+		
+		self.compressLevel = 6
+		self.compressTime = 0.0 # seconds spent compressing outbound packets
+		self.compressBytesIn = 0 # bytes handed to zlib...
+		self.compressBytesOut = 0 # ...and what came out
+		self.keepAlives = {} # Keep Alive payload -> time it actually went out, for RTT measurement
 	def close(self):
 		self.abort = True
 	def hexdigest(self, sh):
@@ -812,6 +1395,7 @@ class Packet: # PACKET PARSING CODE
 		return "%x" % d
 	def grabPacket(self):
 		length = self.unpack_varInt()
+		frameLength = length
 #		if length == 0: return None
 #		if length > 256:
 #			print "Length: %d" % length
@@ -820,11 +1404,21 @@ class Packet: # PACKET PARSING CODE
 			dataLength = self.unpack_varInt()
 			length = length - len(self.pack_varInt(dataLength))
 		payload = self.recv(length)
+		start = time.time()
 		if dataLength > 0:
 			payload = zlib.decompress(payload)
 		self.buffer = StringIO.StringIO(payload)
 		id = self.read_varInt()
+		if id not in self.recvStats: self.recvStats[id] = [0, 0, 0, 0.0, 0.0]
+		stats = self.recvStats[id]
+		stats[0] += 1
+		stats[1] += frameLength
+		stats[2] += len(payload)
+		stats[3] += time.time() - start
+		self.bytesReceived += frameLength
 		return (id, payload)
+	def addHandlerTime(self, id, seconds):
+		if id in self.recvStats: self.recvStats[id][4] += seconds
 	def pack_varInt(self, val):
 		total = b''
 		if val < 0:
@@ -847,34 +1441,92 @@ class Packet: # PACKET PARSING CODE
 		if total&(1<<31):
 			total = total - (1<<32)
 		return total
-	def setCompression(self, threshold):
+	def setCompression(self, threshold, id=0x03):
 #		self.sendRaw("\x03\x80\x02")
-		self.send(0x03, "varint", (threshold,))
+		self.send(id, "varint", (threshold,))
 		self.compressThreshold = threshold
 		#time.sleep(1.5)
+	def scheduleQueue(self, queue):
+		""" Orders a client-bound queue so that PRIORITY_PACKETS go ahead of everything else, and holds back bulk data above the bandwidth cap. Returns (send, keep). """
+		now = time.time()
+		cap = self.bandwidthCap
+		if cap > 0:
+			self.budget = min(cap, self.budget + cap * (now - self.lastFlush))
+		self.lastFlush = now
+		send, keep, high, normal = [], [], [], []
+		threshold = queue[0][0]
+		for i, p in enumerate(queue):
+			id = ord(p[1][0])
+			if id in self.BARRIER_PACKETS or not p[0] == threshold:
+				threshold = p[0]
+				send += high + normal
+				high, normal = [], []
+				if len(keep) > 0: # something earlier is held back, so this and everything after it waits too
+					keep += queue[i:]
+					break
+				send.append(p)
+				self.budget -= len(p[1])
+			elif id in self.PRIORITY_PACKETS:
+				high.append(p)
+			elif cap > 0 and (self.budget <= 0 or len(keep) > 0):
+				keep.append(p)
+			else:
+				normal.append(p)
+				self.budget -= len(p[1])
+		send += high + normal
+		return (send, keep)
 	def flush(self):
-		for p in self.queue:
+		with self.queueLock:
+			queue, self.queue = self.queue, []
+		if len(queue) == 0: return
+		if self.schedule:
+			queue, keep = self.scheduleQueue(queue)
+			if len(keep) > 0:
+				with self.queueLock:
+					self.queue = keep + self.queue
+		now = time.time()
+		for p in queue:
 			packet = p[1]
 			id = struct.unpack("B", packet[0])[0]
+			self.queueTime.observe(now - p[2])
 			if p[0] > -1: #  p[0] > -1:
-				if len(packet) > self.compressThreshold:
-					packetCompressed = self.pack_varInt(len(packet)) + zlib.compress(packet)
+				if len(packet) > p[0]:
+					start = time.time()
+					packetCompressed = self.pack_varInt(len(packet)) + compressionCache.compress(packet, self.compressLevel)
+					self.compressTime += time.time() - start
+					self.compressBytesIn += len(packet)
+					self.compressBytesOut += len(packetCompressed)
 					packet = self.pack_varInt(len(packetCompressed)) + packetCompressed
 				else:
 					packet = self.pack_varInt(0) + packet
 					packet = self.pack_varInt(len(packet)) + packet
 			else:
 				packet = self.pack_varInt(len(packet)) + packet
+			if id == 0x00 and self.schedule:
+				if len(self.keepAlives) > 20: self.keepAlives = {} # client never answered these
+				self.keepAlives[p[1]] = time.time()
 		#	if not self.obj.isServer:
 #				print packet.encode("hex")
+			if id not in self.sendStats: self.sendStats[id] = [0, 0, 0]
+			stats = self.sendStats[id]
+			stats[0] += 1
+			stats[1] += len(packet)
+			stats[2] += len(p[1])
+			self.bytesSent += len(packet)
 			if self.sendCipher is None:
 				self.socket.send(packet)
 			else:
 				self.socket.send(self.sendCipher.encrypt(packet))
-		self.queue = []
+	def getStats(self):
+		""" Returns bytes and packets per packet ID in both directions. 'sent' is what went out of this socket ([packets, wire bytes, uncompressed bytes]),
+		'received' what came in ([packets, wire bytes, uncompressed bytes, seconds decoding, seconds in parse()]). """
+		return {"bytesSent": self.bytesSent, "bytesReceived": self.bytesReceived, "queued": len(self.queue),
+			"sent": dict((id, list(self.sendStats[id])) for id in self.sendStats),
+			"received": dict((id, list(self.recvStats[id])) for id in self.recvStats)}
 	def sendRaw(self, payload):
 		if not self.abort:
-			self.queue.append((self.compressThreshold, payload))
+			with self.queueLock:
+				self.queue.append((self.compressThreshold, payload, time.time()))
 	# -- SENDING AND PARSING PACKETS -- #
 	def read(self, expression):
 		result = {}
@@ -1033,8 +1685,7 @@ class Packet: # PACKET PARSING CODE
 	def read_double(self):
 		return struct.unpack(">d", self.read_data(8))[0]
 	def read_bool(self):
-		if self.read_data(1) == 0x01: return True
-		else: return False
+		return self.read_data(1) == "\x01"
 	def read_short(self):
 		return struct.unpack(">h", self.read_data(2))[0]
 	def read_ushort(self):
@@ -1055,11 +1706,43 @@ class Packet: # PACKET PARSING CODE
 		if not id == -1:
 			count = self.read_ubyte()
 			damage = self.read_short()
-			return {"id": id, "count": count, "damage": damage}
-#				nbtLength = self.read_short()
-#				print count ,damage, nbtLength
-#				if nbtLength > 0: nbt = self.read_data(nbtLength)
-#				else: nbt = ""
+			if self.version > 46:
+				raw = self.read_nbt()
+				if raw: tag = inventory.ItemNBT(raw)
+				else: tag = None
+			else: # 1.7 sends a short length and a gzipped tag
+				length = self.read_short()
+				if length > 0: tag = inventory.ItemNBT(self.read_data(length), compressed=True)
+				else: tag = None
+			return {"id": id, "count": count, "damage": damage, "nbt": tag}
+	def read_nbt(self):
+		""" Returns the raw bytes of the NBT tag at the current position, or None for an empty (TAG_End) one. The tag is only walked to find
+		where it ends; decoding it is left to inventory.ItemNBT, since most slots pass through without anyone looking at their tags. """
+		start = self.buffer.tell()
+		if self.read_byte() == 0: return None
+		self.buffer.seek(self.read_ushort(), 1) # root tag name
+		self.skip_nbt(10)
+		end = self.buffer.tell()
+		self.buffer.seek(start)
+		return self.read_data(end - start)
+	def skip_nbt(self, type):
+		if type in NBT_SIZES: self.buffer.seek(NBT_SIZES[type], 1)
+		elif type == 7: self.buffer.seek(self.read_int(), 1) # TAG_Byte_Array
+		elif type == 8: self.buffer.seek(self.read_ushort(), 1) # TAG_String
+		elif type == 9: # TAG_List
+			type = self.read_byte()
+			length = self.read_int()
+			if type in NBT_SIZES: self.buffer.seek(NBT_SIZES[type] * length, 1)
+			else:
+				for i in range(length): self.skip_nbt(type)
+		elif type == 10: # TAG_Compound
+			while True:
+				type = self.read_byte()
+				if type == 0: break
+				self.buffer.seek(self.read_ushort(), 1)
+				self.skip_nbt(type)
+		elif type == 11: self.buffer.seek(self.read_int() * 4, 1) # TAG_Int_Array
+		else: raise Exception("Unknown NBT tag type %d" % type)
 	def read_varInt(self):
 		total = 0
 		shift = 0
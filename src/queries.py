@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# queries.py - running a console command and reading its reply. Console output carries no request IDs, but the server runs console commands
+# one at a time in the order they were written, so replies come back in that order too. A query only starts looking at lines read after its
+# command was written, and each line goes to the oldest waiting query whose matcher accepts it. Two "list" queries in flight therefore get
+# one reply each, and queries whose matchers include their arguments (testforblock coordinates, player names) can't take each other's replies.
+import threading, time, re
+class QueryTimeout(Exception):
+	pass
+class Query:
+	""" A command waiting for its reply. Works as a future: result() blocks until the reply is in, and addCallback() runs a function when
+	it is, for callers that don't want to hold a thread per query. """
+	def __init__(self, command, matcher, timeout=5, follow=0, consoleThread=None, quiet=False):
+		self.command = command
+		self.quiet = quiet # the reply stays out of the console output and events, for the wrapper's own periodic probes
+		self.consoleThread = consoleThread # the thread that reads the reply, which must never wait for it
+		if isinstance(matcher, basestring): matcher = re.compile(matcher)
+		if hasattr(matcher, "search"): self.check = matcher.search
+		else: self.check = matcher
+		self.follow = follow # lines to take after the matching one, e.g. the names after 1.8's "There are 1/20 players online:"
+		self.deadline = time.time() + timeout
+		self.sent = None # when the command was written to the server
+		self.lines = None
+		self.match = None # what the matcher returned for the first line: a match object for regular expressions
+		self.error = None
+		self.callbacks = []
+		self.finished = threading.Event()
+		self.lock = threading.Lock()
+	def done(self):
+		return self.finished.is_set()
+	def result(self, timeout=None):
+		""" Returns the reply's lines (without the timestamp/level prefix), the matching one first. Raises QueryTimeout if the server didn't
+		answer in time or the command couldn't be sent. 'timeout' only limits this wait; the query's own deadline still applies.
+		Raises QueryTimeout right away if called on the console thread (i.e. from a console event handler) before the reply is in: that
+		thread would be waiting for a line only it can read. Use addCallback() there instead. """
+		if not self.done() and threading.current_thread() is self.consoleThread:
+			raise QueryTimeout("Can't wait for the reply to '%s' on the console thread, which is the one that reads it - use addCallback()" % self.command)
+		if timeout == None: timeout = max(0, self.deadline - time.time())
+		self.finished.wait(timeout + 0.1) # allow for expiry being checked about once a second
+		if not self.done(): raise QueryTimeout("No reply to '%s' yet" % self.command)
+		if self.error: raise QueryTimeout(self.error)
+		return self.lines
+	def addCallback(self, callback):
+		""" Calls callback(query) when the query finishes, right away if it already has. Callbacks run on the console thread, so they should
+		be quick. Check query.error before using query.lines. """
+		with self.lock:
+			if not self.done():
+				self.callbacks.append(callback)
+				return
+		self.runCallbacks([callback])
+	def finish(self, error=None):
+		with self.lock:
+			self.error = error
+			self.finished.set()
+			callbacks, self.callbacks = self.callbacks, []
+		self.runCallbacks(callbacks)
+	def runCallbacks(self, callbacks):
+		for callback in callbacks:
+			try: callback(self)
+			except: pass
+class QueryManager:
+	""" Matches console lines to the queries waiting for them. Server.readConsole feeds it every line while any query is pending. """
+	def __init__(self):
+		self.pending = [] # in the order their commands were written
+		self.consoleThread = None # set by Server to the thread that reads console output and calls feed()
+		self.lock = threading.Lock()
+	def sent(self, query, sent):
+		""" The command writer's callback: sent is the time just before the command was written, or None if it was dropped. """
+		if sent == None:
+			with self.lock:
+				if query in self.pending: self.pending.remove(query)
+			query.finish("'%s' couldn't be sent; the server isn't running" % query.command)
+			return
+		query.sent = sent
+		with self.lock:
+			self.pending.append(query)
+	def feed(self, message, received):
+		""" Hands a console line to the first pending query that wants it. Returns the query that took it, or None. """
+		finished = None
+		with self.lock:
+			for query in self.pending:
+				if received < query.sent: continue # read before the command was written, so it can't be the reply
+				if query.lines: # the line after a match: taken unseen
+					query.lines.append(message)
+				else:
+					match = query.check(message)
+					if not match: continue
+					query.match = match
+					query.lines = [message]
+				if len(query.lines) > query.follow:
+					self.pending.remove(query)
+					finished = query
+				break
+			else: return None
+		if finished: finished.finish()
+		return query
+	def expire(self, now=None):
+		""" Fails queries that are past their deadline. """
+		if now == None: now = time.time()
+		with self.lock:
+			expired = [query for query in self.pending if query.deadline < now]
+			for query in expired: self.pending.remove(query)
+		for query in expired: query.finish("No reply to '%s' within the timeout" % query.command)
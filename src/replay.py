@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# replay.py - pushes a packet capture (see capture.py and capture-enabled in wrapper.properties) back through the proxy's Client and Server
+# parse/forward/flush pipeline, with no Minecraft server or client attached, and reports packets per second, CPU time per packet ID and
+# GC-tracked allocations per packet ID. Replaying the same capture before and after a proxy change gives comparable numbers.
+#
+# Usage: python replay.py <capture file> [--realtime]
+# Run it from an empty directory (it writes a wrapper.properties and wrapper-data there), or from a wrapper directory to replay with that configuration.
+import sys, os, time, gc, socket, threading, StringIO
+import proxy, capture, metrics, log
+from config import Config, DEFAULT_CONFIG
+from api.world import World
+class HarnessServer:
+	""" Stands in for server.Server: the bits of server state the proxy reads while parsing play packets. """
+	def __init__(self, version):
+		self.state = 2
+		self.protocolVersion = version
+		self.version = "replay"
+		self.motd = "Replay"
+		self.maxPlayers = 20
+		self.players = {}
+		self.spawnPoint = None
+		self.world = World("world", self)
+class Harness:
+	""" Just enough of a Wrapper for proxy.Client and proxy.Server to run headless. Every event is allowed and counted. """
+	def __init__(self, version):
+		self.log = log.Log()
+		if not os.path.exists("wrapper.properties"):
+			with open("wrapper.properties", "w") as f: f.write(DEFAULT_CONFIG)
+		self.configManager = Config(self.log)
+		try: self.configManager.loadConfig()
+		except SystemExit: # keys were missing and have now been written out with their defaults, so the second load sticks
+			self.configManager = Config(self.log)
+			self.configManager.loadConfig()
+		self.config = self.configManager.config
+		self.config["Proxy"]["capture-enabled"] = False
+		self.metrics = metrics.Metrics()
+		self.halt = False
+		self.events = {}
+		self.server = HarnessServer(version)
+		self.proxy = proxy.Proxy(self)
+	def callEvent(self, event, payload):
+		self.events[event] = self.events.get(event, 0) + 1
+		return True
+	def getUUID(self, username):
+		return None
+class Sink:
+	""" The far end of a socket pair, read and thrown away on its own thread - the stub client and stub backend. """
+	def __init__(self, sock):
+		self.socket = sock
+		self.bytes = 0
+		t = threading.Thread(target=self.drain, args=())
+		t.daemon = True
+		t.start()
+	def drain(self):
+		while True:
+			try: data = self.socket.recv(65536)
+			except: break
+			if len(data) == 0: break
+			self.bytes += len(data)
+class Replay:
+	def __init__(self, path, realtime=False):
+		self.reader = capture.CaptureReader(path)
+		self.realtime = realtime
+		self.wrapper = Harness(self.reader.version)
+		self.stats = {} # (direction, packet ID) -> [packets, cpu seconds, net gc-tracked objects, bytes]
+
+		clientSocket, clientSink = socket.socketpair()
+		serverSocket, serverSink = socket.socketpair()
+		self.clientSink = Sink(clientSink)
+		self.serverSink = Sink(serverSink)
+
+		# the same state Client and Server are in right after a real login, minus the sockets to a real client and backend
+		self.client = proxy.Client(clientSocket, ("127.0.0.1", 0), self.wrapper, None, None, self.wrapper.proxy)
+		self.client.username = self.reader.username
+		self.client.version = self.reader.version
+		self.client.state = 3
+		self.client.packet.version = self.reader.version
+		self.client.packet.compressThreshold = self.reader.threshold
+		self.wrapper.proxy.clients.append(self.client)
+
+		self.server = proxy.Server(self.client, self.wrapper)
+		self.server.socket = serverSocket
+		self.server.packet = proxy.Packet(serverSocket, self.server)
+		self.server.packet.version = self.reader.version
+		self.server.username = self.reader.username
+		self.server.send = self.server.packet.send
+		self.server.read = self.server.packet.read
+		self.server.sendRaw = self.server.packet.sendRaw
+		self.server.state = 3
+		self.client.server = self.server
+	def run(self):
+		""" Replays the whole capture on this thread. Returns the report dict. """
+		client, server = self.client, self.server
+		packets = 0
+		gc.collect()
+		gc.disable() # so the allocation counts aren't reset by collections mid-packet
+		objectsBefore = len(gc.get_objects())
+		started = time.time()
+		cpuStarted = time.clock()
+		try:
+			for offset, direction, payload in self.reader:
+				if self.realtime:
+					delay = started + offset - time.time()
+					if delay > 0: time.sleep(delay)
+				if direction == capture.SERVERBOUND: packet = client.packet
+				else: packet = server.packet
+				packet.buffer = StringIO.StringIO(payload)
+				id = packet.read_varInt()
+				allocated = gc.get_count()[0]
+				cpu = time.clock()
+				if direction == capture.SERVERBOUND:
+					client.original = payload
+					if client.parse(id) and server.state == 3: server.sendRaw(payload)
+				else:
+					if server.parse(id, payload) and server.safe: client.sendRaw(payload)
+				client.packet.flush()
+				server.packet.flush()
+				cpu = time.clock() - cpu
+				allocated = gc.get_count()[0] - allocated
+				key = (direction, id)
+				if key not in self.stats: self.stats[key] = [0, 0.0, 0, 0]
+				stat = self.stats[key]
+				stat[0] += 1
+				stat[1] += cpu
+				stat[2] += allocated
+				stat[3] += len(payload)
+				packets += 1
+		finally:
+			elapsed = time.time() - started
+			cpuElapsed = time.clock() - cpuStarted
+			objectsAfter = len(gc.get_objects())
+			gc.enable()
+			self.reader.close()
+		return {"capture": self.reader.path, "username": self.reader.username, "version": self.reader.version,
+			"packets": packets, "time": elapsed, "cpu": cpuElapsed, "packetsPerSecond": packets / elapsed if elapsed > 0 else 0,
+			"objectsRetained": objectsAfter - objectsBefore, "events": dict(self.wrapper.events),
+			"bytesToClient": client.packet.bytesSent, "bytesToServer": server.packet.bytesSent,
+			"packetIDs": [{"direction": "serverbound" if key[0] == capture.SERVERBOUND else "clientbound", "id": key[1],
+				"packets": self.stats[key][0], "cpu": self.stats[key][1], "allocations": self.stats[key][2], "bytes": self.stats[key][3]}
+				for key in sorted(self.stats, key=lambda key: -self.stats[key][1])]}
+def printReport(report):
+	print "Replayed %d packets from %s (%s, protocol %d)" % (report["packets"], report["capture"], report["username"], report["version"])
+	print "%.2fs wall, %.2fs CPU, %d packets/s" % (report["time"], report["cpu"], report["packetsPerSecond"])
+	print "Sent %d bytes to the client and %d bytes to the server; %d objects still alive afterwards" % (report["bytesToClient"], report["bytesToServer"], report["objectsRetained"])
+	print "%-12s %-6s %9s %10s %12s %12s %12s" % ("direction", "id", "packets", "CPU (ms)", "us/packet", "allocs/pkt", "bytes")
+	for entry in report["packetIDs"]:
+		print "%-12s %-6s %9d %10.1f %12.1f %12.1f %12d" % (entry["direction"], hex(entry["id"]), entry["packets"], entry["cpu"] * 1000,
+			entry["cpu"] * 1000000 / entry["packets"], float(entry["allocations"]) / entry["packets"], entry["bytes"])
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print "Usage: python replay.py <capture file> [--realtime]"
+		sys.exit(0)
+	replay = Replay(sys.argv[1], realtime="--realtime" in sys.argv[2:])
+	printReport(replay.run())
+	os._exit(0) # don't wait on the storage threads the harness started
@@ -1,10 +1,51 @@
-import socket, datetime, time, sys, threading, random, subprocess, os, json, signal, traceback, api, StringIO, ConfigParser, backups, sys, codecs, ctypes, platform
-try: 
-	import resource
-	IMPORT_RESOURCE_SUCCESS = True
-except: IMPORT_RESOURCE_SUCCESS = False
+import socket, datetime, time, sys, threading, random, subprocess, os, json, signal, traceback, api, StringIO, ConfigParser, backups, sys, codecs, ctypes, platform, Queue, metrics, console, re, collections, heapq, queries, worldsize, procstats, tickmonitor
 from api.player import Player
 from api.world import World
+COLOR_CODE_TOKENS = re.compile(r"([^&]+)|&(.?)", re.S) # a run of text, or an & and the code after it
+FORMATTING_CODES = {"k": "obfuscated", "l": "bold", "m": "strikethrough", "n": "underlined", "o": "italic"}
+# Console command priorities: lower goes first, and commands of the same priority keep their order
+COMMAND_ADMIN = 0 # typed by an operator (console, web panel, IRC control) or part of stopping the server; never held back by the rate cap
+COMMAND_NORMAL = 1
+COMMAND_BULK = 2 # for plugins sending lots of commands at once (fills, mass setblocks) that can wait behind everything else
+COMMAND_BATCH = 100 # most commands written to the server's stdin in one go
+LAG_PROBE_REPLY = r"^There are \d+/\d+ players online" # the reply to "list", which every version has
+LAG_PROBE_FOLLOW = 1 # the line of player names after it
+COLOR_CODE_CACHE_SIZE = 512 # MOTDs, help pages and join messages repeat; chat mostly doesn't, so this stays small
+def formatColorCodes(message):
+	""" Turns a string with & codes into a JSON chat object: &0-&f colors, &k-&o formatting, &r resets, && is a literal &, and &@ toggles
+	whether the next segment is a clickable URL (until a space). Formatting that's off isn't written out, to keep the JSON small. """
+	if isinstance(message, str): message = message.decode("utf-8", "ignore")
+	message = message.encode("ascii", "ignore")
+	extras = []
+	style = {}
+	color = "white"
+	url = False
+	current = ""
+	for text, code in COLOR_CODE_TOKENS.findall(message):
+		if text:
+			if url and " " in text: url = False
+			current += text
+			continue
+		if current: # every & ends the segment before it
+			segment = {"text": current, "color": color}
+			segment.update(style)
+			if url: segment["clickEvent"] = {"action": "open_url", "value": current}
+			extras.append(segment)
+		current = ""
+		if code and code in "abcdef0123456789": color = api.API.colorCodes[code]
+		elif code in FORMATTING_CODES: style[FORMATTING_CODES[code]] = True
+		elif code == "&": current = "&"
+		elif code == "@": url = not url
+		elif code == "r":
+			style = {}
+			url = False
+			color = "white"
+	if current:
+		segment = {"text": current, "color": color}
+		segment.update(style)
+		extras.append(segment)
+	if len(extras) == 0: return '{"text":""}' # an empty extra list is an error to the client
+	return json.dumps({"text": "", "extra": extras}, separators=(",", ":"))
 class Server:
 	def __init__(self, args, log, config, wrapper):
 		self.log = log
@@ -22,8 +63,20 @@ class Server:
 		self.boot = self.wrapper.storage["serverState"]
 		self.proc = False
 		self.rebootWarnings = 0
-		self.pollSize = 0
-		self.data = []
+		self.colorCodeCache = collections.OrderedDict() # message -> JSON, see processColorCodes
+		self.colorCodeLock = threading.Lock()
+		self.consoleQueue = None # (time read, "stdout"/"stderr", line) from the reader threads of the current server process
+		self.commandQueue = [] # heap of (priority, sequence, time queued, command, callback) waiting for the command writer thread
+		self.commandCondition = threading.Condition()
+		self.commandSequence = 0
+		self.commandsPending = 0 # queued or being written; flushConsole waits for this to reach 0
+		self.queries = queries.QueryManager()
+		self.resources = procstats.RingBuffer(self.config["General"]["resource-history-size"]) # filled by the resource sampler thread
+		self.tickMonitor = tickmonitor.TickMonitor()
+		self.lastOutput = time.time() # when the server last printed anything, for the watchdog
+		self.stateChanged = time.time()
+		self.lastLagProbe = 0
+		self.lagProbing = False
 		
 		if not self.wrapper.storage["serverState"]:
 			self.log.warn("NOTE: Server was in 'STOP' state last time Wrapper.py was running. To start the server, run /start.")
@@ -31,7 +84,7 @@ class Server:
 		
 		# Server Information 
 		self.worldName = None
-		self.worldSize = 0
+		self.worldSize = 0 # kept up to date by the world size thread, see trackWorldSize
 		self.protocolVersion = -1 # -1 until proxy mode checks the server's MOTD on boot
 		self.version = None
 		self.world = None
@@ -39,6 +92,11 @@ class Server:
 		
 		self.reloadProperties()
 		
+		self.classifier = console.Classifier(legacy=self.config["General"]["pre-1.7-mode"])
+		self.consoleHandlers = {"started": self.onConsoleStarted, "world": self.onConsoleWorld, "chat": self.onConsoleChat,
+			"login": self.onConsoleLogin, "logout": self.onConsoleLogout, "action": self.onConsoleAction, "say": self.onConsoleSay,
+			"achievement": self.onConsoleAchievement, "death": self.onConsoleDeath, "overloaded": self.onConsoleOverloaded}
+		
 		self.api.registerEvent("irc.message", self.onChannelMessage)
 		self.api.registerEvent("irc.action", self.onChannelAction)
 		self.api.registerEvent("irc.join", self.onChannelJoin)
@@ -46,13 +104,12 @@ class Server:
 		self.api.registerEvent("irc.quit", self.onChannelQuit)
 		self.api.registerEvent("timer.second", self.onTick)
 	def init(self):
-		""" Start up the listen threads for reading server console output """
-		captureThread = threading.Thread(target=self.__stdout__, args=())
-		captureThread.daemon = True
-		captureThread.start()
-		captureThread = threading.Thread(target=self.__stderr__, args=())
-		captureThread.daemon = True
-		captureThread.start()
+		""" Called once before the server first boots. Starts the console command writer, the world size thread, the resource sampler and
+		the watchdog; the console reader threads are started per server process, in __handle_server__ """
+		for target in (self.writeCommands, self.trackWorldSize, self.sampleResources, self.watchServer):
+			t = threading.Thread(target=target, args=())
+			t.daemon = True
+			t.start()
 	def start(self, save=True):
 		""" Start the Minecraft server """
 		self.boot = True
@@ -63,8 +120,9 @@ class Server:
 		self.log.info("Restarting Minecraft server with reason: %s" % reason)
 		self.changeState(3, reason)
 		for player in self.players:
-			self.console("kick %s %s" % (player, reason))
-		self.console("stop")
+			self.console("kick %s %s" % (player, reason), COMMAND_ADMIN)
+		self.console("stop", COMMAND_ADMIN)
+		self.flushConsole()
 	def stop(self, reason="Stopping Server", save=True):
 		""" Stop the Minecraft server, prevent it from auto-restarting and kick people with the specified reason """
 		self.log.info("Stopping Minecraft server with reason: %s" % reason)
@@ -73,8 +131,9 @@ class Server:
 		if save:
 			self.wrapper.storage["serverState"] = False
 		for player in self.players:
-			self.console("kick %s %s" % (player, reason))
-		self.console("stop")
+			self.console("kick %s %s" % (player, reason), COMMAND_ADMIN)
+		self.console("stop", COMMAND_ADMIN)
+		self.flushConsole()
 	def kill(self, reason="Killing Server"):
 		""" Forcefully kill the server. It will auto-restart if set in the configuration file """
 		self.log.info("Killing Minecraft server with reason: %s" % reason)
@@ -104,12 +163,23 @@ class Server:
 			if self.config["General"]["pre-1.7-mode"]:
 				self.console("say %s" % self.chatToColorCodes(message))
 			else:
-				self.console("tellraw @a %s" % json.dumps(message))
+				self.broadcastJSON(json.dumps(message))
 		else:
 			if self.config["General"]["pre-1.7-mode"]:
 				self.console("say %s" % self.chatToColorCodes(json.loads(self.processColorCodes(message))))
 			else:
-				self.console("tellraw @a %s" % self.processColorCodes(message))
+				self.broadcastJSON(self.processColorCodes(message))
+	def broadcastJSON(self, message):
+		""" Internally-used: delivers a JSON chat message through the proxy where possible, and with tellraw to anyone the proxy doesn't handle. """
+		if not self.wrapper.proxy or not self.config["Proxy"]["direct-chat"]:
+			self.console("tellraw @a %s" % message)
+			return
+		delivered = self.wrapper.proxy.broadcast(message)
+		if len(delivered) == 0:
+			self.console("tellraw @a %s" % message)
+			return
+		for name in self.players.keys():
+			if name not in delivered: self.console("tellraw %s %s" % (name, message))
 	def chatToColorCodes(self, json):
 		total = ""
 		def getColorCode(i):
@@ -130,51 +200,16 @@ class Server:
 		return total
 	def processColorCodes(self, message):
 		""" Used internally to process old-style color-codes with the & symbol, and returns a JSON chat object. """
-		message = message.encode('ascii', 'ignore')
-		extras = []
-		bold = False
-		italic = False
-		underline = False
-		obfuscated = False
-		strikethrough = False
-		url = False
-		color = "white"
-		current = ""; it = iter(xrange(len(message)))
-		for i in it:
-			char = message[i]
-			if char is not "&":
-				if char == " ": url = False
-				current += char
-			else:
-				if url: clickEvent = {"action": "open_url", "value": current}
-				else: clickEvent = {}
-				extras.append({"text": current, "color": color, "obfuscated": obfuscated, 
-					"underlined": underline, "bold": bold, "italic": italic, "strikethrough": strikethrough, "clickEvent": clickEvent})
-				current = ""
-				try: code = message[i+1]
-				except: break
-				if code in "abcdef0123456789":
-					try: color = api.API.colorCodes[code]
-					except: color = "white"
-				if code == "k": obfuscated = True
-				elif code == "l": bold = True
-				elif code == "m": strikethrough = True
-				elif code == "n": underline = True
-				elif code == "o": italic = True
-				elif code == "&": current += "&"
-				elif code == "@": url = not url
-				elif code == "r":
-					bold = False
-					italic = False
-					underline = False
-					obfuscated = False
-					strikethrough = False
-					url = False
-					color = "white"
-				it.next()
-		extras.append({"text": current, "color": color, "obfuscated": obfuscated, 
-			"underlined": underline, "bold": bold, "italic": italic, "strikethrough": strikethrough})
-		return json.dumps({"text": "", "extra": extras})
+		with self.colorCodeLock:
+			if message in self.colorCodeCache:
+				result = self.colorCodeCache.pop(message)
+				self.colorCodeCache[message] = result # most recently used goes last
+				return result
+		result = formatColorCodes(message)
+		with self.colorCodeLock:
+			self.colorCodeCache[message] = result
+			if len(self.colorCodeCache) > COLOR_CODE_CACHE_SIZE: self.colorCodeCache.popitem(last=False)
+		return result
 	def login(self, username):
 		""" Called when a player logs in """
 		try:
@@ -191,6 +226,8 @@ class Server:
 				uuid = self.players[username].uuid
 		if username in self.players:
 			self.players[username].abort = True
+			self.players[username].data.abort = True # stop the player's storage save thread, which would otherwise outlive them
+			self.players[username].data.save()
 			del self.players[username]
 	def getPlayer(self, username):
 		""" Returns a player object with the specified name, or False if the user is not logged in/doesn't exist """
@@ -212,40 +249,116 @@ class Server:
 				self.maxPlayers = int(self.properties.get("main", "max-players"))
 			except:
 				self.log.getTraceback()
-	def console(self, command):
-		""" Execute a console command on the server """
-		try: self.proc.stdin.write("%s\n" % command)
-		except: pass #self.log.getTraceback()
+	def console(self, command, priority=COMMAND_NORMAL, callback=None):
+		""" Execute a console command on the server. The command is queued and written by the command writer thread, so this never blocks;
+		use flushConsole() to wait until it has reached the server. callback, if given, is called with the time just before the command is
+		written, or with None if it's dropped because the server isn't running. """
+		with self.commandCondition:
+			heapq.heappush(self.commandQueue, (priority, self.commandSequence, time.time(), command, callback))
+			self.commandSequence += 1
+			self.commandsPending += 1
+			self.wrapper.metrics.set("console.command_queue", len(self.commandQueue))
+			self.commandCondition.notify_all()
+	def flushConsole(self, timeout=5):
+		""" Waits until every command queued so far has been written to the server (or dropped, if it isn't running). Returns False if that
+		took longer than timeout seconds. """
+		deadline = time.time() + timeout
+		with self.commandCondition:
+			while self.commandsPending > 0:
+				remaining = deadline - time.time()
+				if remaining <= 0: return False
+				self.commandCondition.wait(remaining)
+		return True
+	def writeCommands(self):
+		""" The command writer thread. Takes commands off the queue in priority order and writes them to the server's stdin in batches, one
+		write and flush per batch. Apart from COMMAND_ADMIN ones, commands are capped at console-commands-per-second (with up to a second's
+		worth in a burst), so a plugin flooding the console can't eat the server's tick. """
+		tokens = 0.0
+		last = time.time()
+		while True:
+			rate = self.config["General"]["console-commands-per-second"]
+			batch = []
+			with self.commandCondition:
+				while len(self.commandQueue) == 0: self.commandCondition.wait()
+				now = time.time()
+				if rate > 0: tokens = min(rate, tokens + (now - last) * rate)
+				last = now
+				while len(self.commandQueue) > 0 and len(batch) < COMMAND_BATCH:
+					if rate > 0 and self.commandQueue[0][0] > COMMAND_ADMIN:
+						if tokens < 1: break
+						tokens -= 1
+					batch.append(heapq.heappop(self.commandQueue))
+				self.wrapper.metrics.set("console.command_queue", len(self.commandQueue))
+			if len(batch) == 0: # out of tokens; wait for the next one
+				time.sleep((1 - tokens) / rate)
+				continue
+			self.writeBatch(batch)
+			with self.commandCondition:
+				self.commandsPending -= len(batch)
+				self.commandCondition.notify_all()
+	def writeBatch(self, batch):
+		""" Writes (priority, sequence, time queued, command, callback) entries to the server's stdin. Commands for a server that isn't
+		running are dropped, as they always were. """
+		lines = []
+		for priority, sequence, queued, command, callback in batch:
+			if isinstance(command, unicode): command = command.encode("utf-8")
+			lines.append("%s\n" % command)
+		proc = self.proc
+		started = time.time()
+		self.runCommandCallbacks(batch, started) # before writing, so a query is already waiting when its reply comes in
+		try:
+			proc.stdin.write("".join(lines))
+			proc.stdin.flush()
+		except:
+			if proc: self.log.debug("Couldn't write %d command(s) to the server: %s" % (len(batch), traceback.format_exc().splitlines()[-1]))
+			self.wrapper.metrics.increment("console.commands_dropped", len(batch))
+			self.runCommandCallbacks(batch, None)
+			return
+		now = time.time()
+		for priority, sequence, queued, command, callback in batch:
+			self.wrapper.metrics.observe("console.command_latency", now - queued)
+		self.wrapper.metrics.increment("console.commands_written", len(batch))
+		self.wrapper.metrics.observe("console.command_batch_size", len(batch), metrics.COUNT_BUCKETS)
+	def runCommandCallbacks(self, batch, sent):
+		for priority, sequence, queued, command, callback in batch:
+			if callback == None: continue
+			try: callback(sent)
+			except: self.log.getTraceback()
+	def query(self, command, matcher, timeout=5, follow=0, priority=COMMAND_NORMAL, quiet=False):
+		""" Runs a command and returns a queries.Query for its reply: the first console line after the command was written that the matcher
+		(a regular expression, or a function taking the line and returning something true) accepts, plus 'follow' lines after it. Console
+		event handlers run on the thread that reads the reply, so they must use the query's addCallback() rather than result(). A quiet
+		query's reply isn't printed, doesn't reach server.consoleMessage (and so the web console), and doesn't count as output for the
+		watchdog. """
+		query = queries.Query(command, matcher, timeout, follow, self.queries.consoleThread, quiet)
+		self.console(command, priority, lambda sent: self.queries.sent(query, sent))
+		return query
 	def changeState(self, state, reason=None):
 		""" Change the boot state of the server, with a reason message """
 		self.state = state
+		self.stateChanged = time.time()
 		if self.state == 0: self.wrapper.callEvent("server.stopped", {"reason": reason})
 		if self.state == 1: self.wrapper.callEvent("server.starting", {"reason": reason})
 		if self.state == 2: self.wrapper.callEvent("server.started", {"reason": reason})
 		if self.state == 3: self.wrapper.callEvent("server.stopping", {"reason": reason})
 		self.wrapper.callEvent("server.state", {"state": state, "reason": reason})
-	def __stdout__(self):
-		while not self.wrapper.halt:
-			try:
-				data = self.proc.stdout.readline()
-				for line in data.split("\n"):
-					if len(line) < 1: continue
-					self.data.append(line)
-			except:
-				time.sleep(0.1)
-				continue
-	def __stderr__(self):
-		while not self.wrapper.halt:
-			try:
-				data = self.proc.stderr.readline()
-				if len(data) > 0:
-					for line in data.split("\n"):
-						self.data.append(line.replace("\r", ""))
-			except:
-				time.sleep(0.1)
-				continue
+	def readStream(self, queue, stream, name):
+		""" Reads one of the server process' output pipes until it closes, queueing each line with the time it was read. Blocking reads
+		and a blocking queue mean a line reaches readConsole as soon as the handler thread can take it, and nothing is dropped. """
+		while True:
+			try: data = stream.readline()
+			except: break
+			if len(data) < 1: break
+			line = data.rstrip("\n").replace("\r", "")
+			if name == "stdout" and len(line) < 1: continue
+			queue.put((time.time(), name, line))
+		queue.put((time.time(), name, None))
+	def waitForExit(self, queue, proc):
+		proc.wait()
+		queue.put((time.time(), "exit", None))
 	def __handle_server__(self):
 		""" Internally-used function that handles booting the server, parsing console output, and etc. """
+		self.queries.consoleThread = threading.current_thread()
 		while not self.wrapper.halt:
 			self.proc = False
 			if not self.boot:
@@ -255,29 +368,74 @@ class Server:
 			self.log.info("Starting server...")
 			self.reloadProperties()
 			self.proc = subprocess.Popen(self.args, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-			self.players = {}	
-			while True:
-				time.sleep(0.1)
-				if self.proc.poll() is not None:
-					self.changeState(0)
-					if not self.config["General"]["auto-restart"]:
-						self.wrapper.halt = True
-					self.log.info("Server stopped")
-					break
-				for line in self.data:
-					try: self.readConsole(line.replace("\r", ""))
+			self.players = {}
+			# stdout and stderr feed one queue, so lines keep the order they were read in across both pipes. Each server process gets
+			# its own queue, so a previous process' end-of-stream markers can't be mistaken for this one's
+			queue = self.consoleQueue = Queue.Queue()
+			for name, stream in (("stdout", self.proc.stdout), ("stderr", self.proc.stderr)):
+				t = threading.Thread(target=self.readStream, args=(queue, stream, name))
+				t.daemon = True
+				t.start()
+			t = threading.Thread(target=self.waitForExit, args=(queue, self.proc))
+			t.daemon = True
+			t.start()
+			self.lastOutput = time.time()
+			streams = 2
+			exited = None
+			while streams > 0 or exited == None:
+				if exited == None: item = queue.get()
+				else: # the server has exited; give it a few seconds to finish its output in case something it started is still holding the pipes
+					try: item = queue.get(timeout=max(0, exited + 5 - time.time()))
+					except Queue.Empty: break
+				batch = [item]
+				while len(batch) < 1000: # under load, take whatever has piled up in one go
+					try: batch.append(queue.get_nowait())
+					except Queue.Empty: break
+				self.wrapper.metrics.observe("console.batch_size", len(batch), metrics.COUNT_BUCKETS)
+				for received, name, line in batch:
+					if line == None:
+						if name == "exit": exited = received
+						else: streams -= 1
+						continue
+					try: self.readConsole(line, received)
 					except: self.log.getTraceback()
-				self.data = []
+			self.changeState(0)
+			if not self.config["General"]["auto-restart"]:
+				self.wrapper.halt = True
+			self.log.info("Server stopped")
 	def getMemoryUsage(self):
-		""" Returns allocated memory in bytes """
-		if not IMPORT_RESOURCE_SUCCESS: return None
-		if not os.name == "posix": return None
+		""" Returns allocated memory in bytes, as of the resource sampler's latest sample """
+		sample = self.getResourceUsage()
+		if sample == None: return None
+		return sample["rss"]
+	def getResourceUsage(self):
+		""" Returns the latest resource sample of the server process as a dict (see procstats.FIELDS), or None if the server isn't running
+		or this isn't Linux """
 		if self.proc == False: return None
-		try:
-			with open("/proc/%d/statm" % self.proc.pid, "r") as f:
-				bytes = int(f.read().split(" ")[1]) * resource.getpagesize()
-		except: return None
-		return bytes
+		return procstats.toDict(self.resources.latest())
+	def getResourceHistory(self, since=None, points=None):
+		""" Returns resource samples, oldest first, optionally only those after 'since' and downsampled to at most 'points' samples """
+		return [procstats.toDict(sample) for sample in self.resources.history(since, points)]
+	def sampleResources(self):
+		""" The resource sampler thread: reads the server process' memory, CPU, thread, I/O and file descriptor figures from /proc every
+		resource-sample-interval seconds. Nothing else touches /proc for them. """
+		if not procstats.isSupported(): return
+		pid = None
+		previous = None
+		while not self.wrapper.halt:
+			proc = self.proc
+			if proc:
+				if not proc.pid == pid: # a new server process; its CPU time starts from zero
+					pid, previous = proc.pid, None
+				try:
+					previous = procstats.readSample(pid, previous)
+					self.resources.append(previous)
+					self.wrapper.metrics.set("server.rss", previous[1])
+					self.wrapper.metrics.set("server.threads", previous[4])
+					if not previous[3] == None: self.wrapper.metrics.set("server.cpu_percent", previous[3])
+				except (IOError, OSError): # exited between samples
+					previous = None
+			time.sleep(max(0.1, self.config["General"]["resource-sample-interval"]))
 	def getStorageAvailable(self, folder):
 		""" Returns the disk space for the working directory in bytes """
 		if platform.system() == "Windows":
@@ -287,9 +445,136 @@ class Server:
 		else:
 			st = os.statvfs(folder)
 			return st.f_bavail * st.f_frsize
+	def getTickStats(self):
+		""" Returns the tick health estimate: 'tps' for the last 1m, 5m and 15m, and for the last minute the number of "Can't keep up!"
+		warnings, ticks skipped, most ms behind and the average and worst lag probe reply time in seconds, plus whether the server is
+		currently considered lagging. See tickmonitor.py """
+		return self.tickMonitor.getStats()
+	def checkLag(self):
+		""" Sends a lag probe if one is due, and fires server.lag when the server starts or stops lagging (see lag-tps-threshold and
+		lag-probe-threshold). Runs every second and after every "Can't keep up!" """
+		if not self.state == 2: return
+		general = self.config["General"]
+		if general["lag-probe-interval"] > 0 and not self.lagProbing and time.time() - self.lastLagProbe >= general["lag-probe-interval"]:
+			self.probeLag()
+		stats = self.tickMonitor.check(general["lag-tps-threshold"], general["lag-probe-threshold"])
+		tps = self.tickMonitor.getTPS(60)
+		if not tps == None: self.wrapper.metrics.set("server.tps", tps)
+		if stats == None: return
+		if stats["lagging"]: self.log.warn("Server is lagging: %.1f TPS over the last minute" % stats["tps"]["1m"])
+		else: self.log.info("Server has stopped lagging: %.1f TPS over the last minute" % stats["tps"]["1m"])
+		self.wrapper.callEvent("server.lag", stats)
+	def probeLag(self):
+		""" Times how long the server takes to answer a "list". It runs console commands at the start of a tick, so this is about how late
+		the next tick is. A probe that never gets an answer still counts, as taking at least until it timed out. """
+		self.lagProbing = True
+		self.lastLagProbe = time.time()
+		def answered(query):
+			self.lagProbing = False
+			if query.sent == None: return # never sent
+			latency = time.time() - query.sent
+			self.tickMonitor.probe(latency)
+			self.wrapper.metrics.observe("server.lag_probe", latency)
+		self.query("list", LAG_PROBE_REPLY, timeout=30, follow=LAG_PROBE_FOLLOW, quiet=True).addCallback(answered)
+	def watchServer(self):
+		""" The watchdog thread. Once the server has gone quiet for watchdog-silence seconds after printing something (or anyway every four
+		times that, since its other threads can keep printing while the main thread is stuck) it's sent a "list", which only the main thread
+		answers. The replies are kept out of the console and don't count as output, so an idle server is only probed by the backstop. No answer
+		within watchdog-timeout seconds means it's hung: it gets a SIGQUIT, which makes the JVM print a thread dump to the console (and so
+		to the log), and one more watchdog-kill-delay seconds to answer a second probe before it's killed. A stop is only killed once it has
+		gone on for more than watchdog-timeout seconds with no console output and no progress (see isMakingProgress) over that time, since
+		killing a server that is still saving can corrupt the world. Killing goes through kill(), so auto-restart brings the server back as
+		after a crash. """
+		probe = None
+		probed = answered = time.time()
+		dumped = None
+		pid = None
+		while not self.wrapper.halt:
+			time.sleep(1)
+			self.queries.expire() # normally done by onTick, but that runs on the timer thread, which plugins can hold up
+			general = self.config["General"]
+			timeout = general["watchdog-timeout"]
+			proc = self.proc
+			if timeout <= 0 or not proc or not self.state in (2, 3) or not proc.pid == pid:
+				probe = dumped = None # nothing to watch, or a new server process
+				probed = answered = time.time()
+				if proc: pid = proc.pid
+				continue
+			now = time.time()
+			if self.state == 3:
+				if now - self.stateChanged > timeout and now - self.lastOutput > timeout and self.isMakingProgress(now - timeout) == False:
+					self.log.error("Server has been stopping for %d seconds, with no output, CPU or disk activity in the last %d" % (now - self.stateChanged, timeout))
+					self.killHung(proc, "Server hung while stopping")
+				continue
+			if probe == None:
+				silence = general["watchdog-silence"]
+				if (now - self.lastOutput >= silence and self.lastOutput > probed) or now - answered >= silence * 4:
+					probe = self.query("list", LAG_PROBE_REPLY, timeout, LAG_PROBE_FOLLOW, COMMAND_ADMIN, quiet=True)
+					probed = now
+				continue
+			if not probe.done(): continue
+			if not probe.error:
+				if dumped: self.log.info("Server is responding again")
+				probe = dumped = None
+				answered = now
+				continue
+			if probe.sent == None: # couldn't be written, so the server is on its way out anyway
+				probe = None
+				continue
+			if dumped == None:
+				cpu = [sample["cpuPercent"] for sample in self.getResourceHistory(since=now - timeout) if not sample["cpuPercent"] == None]
+				cpu = sum(cpu) / len(cpu) if cpu else None
+				if cpu == None: kind = "unresponsive"
+				elif cpu >= 90: kind = "spinning" # busy in a loop it won't come out of
+				else: kind = "deadlocked"
+				self.log.error("Server hasn't answered the watchdog for %d seconds and looks %s (CPU: %s)" % (now - probe.sent, kind,
+					"unknown" if cpu == None else "%d%%" % cpu))
+				self.wrapper.metrics.increment("server.watchdog_hangs")
+				self.wrapper.callEvent("server.hung", {"kind": kind, "cpuPercent": cpu, "silence": now - self.lastOutput})
+				if hasattr(signal, "SIGQUIT"):
+					self.log.error("Sending SIGQUIT for a thread dump; the server will be killed if it doesn't answer within %d seconds" % general["watchdog-kill-delay"])
+					try: os.kill(proc.pid, signal.SIGQUIT)
+					except OSError: pass
+				dumped = now
+				probe = self.query("list", LAG_PROBE_REPLY, general["watchdog-kill-delay"], LAG_PROBE_FOLLOW, COMMAND_ADMIN, quiet=True)
+				continue
+			self.killHung(proc, "Server stopped responding")
+			probe = dumped = None
+	def isMakingProgress(self, since):
+		""" Whether the server process did anything since 'since', going by the resource sampler: read or wrote storage, or used more than
+		a sliver of CPU (a deadlocked JVM still uses a little). None if there aren't enough samples to tell, e.g. off Linux. """
+		samples = self.resources.history(since=since)
+		if len(samples) < 2: return None
+		first, last = samples[0], samples[-1]
+		for field in (5, 6): # readBytes, writeBytes
+			if not first[field] == None and not last[field] == None and last[field] > first[field]: return True
+		return last[2] - first[2] > (last[0] - first[0]) * 0.05 # CPU seconds used against 5% of one core
+	def killHung(self, proc, reason):
+		if not self.proc is proc: return # already gone
+		self.wrapper.metrics.increment("server.watchdog_kills")
+		try: self.kill(reason)
+		except OSError: pass
 	def getWorldSize(self):
 		""" Returns the size of the currently used world folder in bytes """
 		return self.worldSize
+	def trackWorldSize(self):
+		""" The world size thread. Every world-size-interval seconds it brings self.worldSize up to date, re-listing only the directories
+		that changed since the last pass (see worldsize.py). """
+		tracker = None
+		while not self.wrapper.halt:
+			interval = self.config["General"]["world-size-interval"]
+			if self.worldName == None or interval <= 0:
+				time.sleep(1)
+				continue
+			if tracker == None or not tracker.root == self.worldName: tracker = worldsize.SizeTracker(self.worldName)
+			started = time.time()
+			try:
+				self.worldSize = tracker.update()
+				self.wrapper.metrics.observe("server.world_size_scan", time.time() - started)
+				self.wrapper.metrics.set("server.world_size", self.worldSize)
+			except:
+				self.log.getTraceback()
+			time.sleep(interval)
 	def stripSpecial(self, text):
 		a = ""; it = iter(xrange(len(text)))
 		for i in it:
@@ -303,94 +588,64 @@ class Server:
 			else: 
 				a += char
 		return a
-	def readConsole(self, line):
-		""" Internally-use function that parses a particular console line """
-		def args(i):
-			try: return line.split(" ")[i]
-			except: return ""
-		def argsAfter(i):
-			try: return " ".join(line.split(" ")[i:])
-			except: return ""
-		if not self.wrapper.callEvent("server.consoleMessage", {"message": line}): return False
+	def readConsole(self, line, received=None):
+		""" Internally-use function that parses a particular console line. 'received' is when the line was read from the server, for latency accounting """
+		if received: self.wrapper.metrics.observe("console.line_latency", time.time() - received)
+		flavour, kind, fields = self.classifier.classify(line)
+		if len(self.queries.pending) > 0:
+			if flavour == None: query = self.queries.feed(line, received or time.time())
+			else: query = self.queries.feed(fields["message"], received or time.time())
+			if query and query.quiet: return # a watchdog or lag probe reply; these come every few seconds on a quiet server
+		self.lastOutput = time.time()
+		if not self.wrapper.callEvent("server.consoleMessage", {"message": line, "received": received}): return False
 		print line
-		deathPrefixes = ["fell", "was", "drowned", "blew", "walked", "went", "burned", "hit", "tried", 
-			"died", "got", "starved", "suffocated", "withered"]
-		if not self.config["General"]["pre-1.7-mode"]:
-			if len(args(3)) < 1: return
-			if args(3) == "Done": # Confirmation that the server finished booting
-				self.changeState(2)
-				self.log.info("Server started")
-				self.bootTime = time.time()
-			elif args(3) == "Preparing" and args(4) == "level": # Getting world name
-				self.worldName = args(5).replace('"', "")
-				self.world = World(self.worldName, self)
-			elif args(3)[0] == "<": # Player Message
-				name = self.stripSpecial(args(3)[1:-1])
-				message = self.stripSpecial(argsAfter(4))
-				original = argsAfter(3)
-				self.wrapper.callEvent("player.message", {"player": self.getPlayer(name), "message": message, "original": original})
-			elif args(4) == "logged": # Player Login
-				name = self.stripSpecial(args(3)[0:args(3).find("[")])
-				self.login(name)
-			elif args(4) == "lost": # Player Logout
-				name = args(3)
-				self.logout(name)
-			elif args(3) == "*":
-				name = self.stripSpecial(args(4))
-				message = self.stripSpecial(argsAfter(5))
-				self.wrapper.callEvent("player.action", {"player": self.getPlayer(name), "action": message})
-			elif args(3)[0] == "[" and args(3)[-1] == "]": # /say command
-				name = self.stripSpecial(args(3)[1:-1])
-				message = self.stripSpecial(argsAfter(4))
-				original = argsAfter(3)
-				self.wrapper.callEvent("server.say", {"player": name, "message": message, "original": original})
-			elif args(4) == "has" and args(8) == "achievement": # Player Achievement
-				name = self.stripSpecial(args(3))
-				achievement = argsAfter(9)
-				self.wrapper.callEvent("player.achievement", {"player": name, "achievement": achievement})
-			elif args(4) in deathPrefixes: # Player Death
-				name = self.stripSpecial(args(3))
-				self.wrapper.callEvent("player.death", {"player": self.getPlayer(name), "death": argsAfter(4)})
-		else:
-			if len(args(3)) < 1: return
-			if args(3) == "Done": # Confirmation that the server finished booting
-				self.changeState(2)
-				self.log.info("Server started")
-				self.bootTime = time.time()
-			elif args(3) == "Preparing" and args(4) == "level": # Getting world name
-				self.worldName = args(5).replace('"', "")
-				self.world = World(self.worldName)
-			elif args(3)[0] == "<": # Player Message
-				name = self.stripSpecial(args(3)[1:-1])
-				message = self.stripSpecial(argsAfter(4))
-				original = argsAfter(3)
-				self.wrapper.callEvent("player.message", {"player": self.getPlayer(name), "message": message, "original": original})
-			elif args(4) == "logged": # Player Login
-				name = self.stripSpecial(args(3)[0:args(3).find("[")])
-				self.login(name)
-			elif args(4) == "lost": # Player Logout
-				name = args(3)
-				self.logout(name)
-			elif args(3) == "*":
-				name = self.stripSpecial(args(4))
-				message = self.stripSpecial(argsAfter(5))
-				self.wrapper.callEvent("player.action", {"player": self.getPlayer(name), "action": message})
-			elif args(3)[0] == "[" and args(3)[-1] == "]": # /say command
-				name = self.stripSpecial(args(3)[1:-1])
-				message = self.stripSpecial(argsAfter(4))
-				original = argsAfter(3)
-				if name == "Server": return
-				self.wrapper.callEvent("server.say", {"player": name, "message": message, "original": original})
-			elif args(4) == "has" and args(8) == "achievement": # Player Achievement
-				name = self.stripSpecial(args(3))
-				achievement = argsAfter(9)
-				self.wrapper.callEvent("player.achievement", {"player": name, "achievement": achievement})
-			elif args(4) in deathPrefixes: # Player Death
-				name = self.stripSpecial(args(3))
-				deathMessage = self.config["Death"]["death-kick-messages"][random.randrange(0, len(self.config["Death"]["death-kick-messages"]))]
-				if self.config["Death"]["kick-on-death"] and name in self.config["Death"]["users-to-kick"]:
-					self.console("kick %s %s" % (name, deathMessage))
-				self.wrapper.callEvent("player.death", {"player": self.getPlayer(name), "death": argsAfter(4)})
+		if flavour == None: return
+		if kind: self.consoleHandlers[kind](fields)
+		for pluginID in self.wrapper.consolePatterns.keys():
+			for event, pattern in self.wrapper.consolePatterns.get(pluginID, ()):
+				match = pattern.search(fields["message"])
+				if match:
+					payload = match.groupdict()
+					payload.update({"message": fields["message"], "line": line, "flavour": flavour})
+					self.wrapper.callEvent(event, payload)
+	# Console line handlers, see console.py for the patterns that produce them
+	def onConsoleStarted(self, fields): # Confirmation that the server finished booting
+		self.changeState(2)
+		self.log.info("Server started")
+		self.bootTime = time.time()
+		self.tickMonitor.reset()
+	def onConsoleWorld(self, fields): # Getting world name
+		self.worldName = fields["world"]
+		self.world = World(self.worldName, self)
+	def onConsoleChat(self, fields):
+		name = self.stripSpecial(fields["name"])
+		message = self.stripSpecial(fields["text"] or "")
+		self.wrapper.callEvent("player.message", {"player": self.getPlayer(name), "message": message, "original": fields["message"]})
+	def onConsoleLogin(self, fields):
+		self.login(self.stripSpecial(fields["name"]))
+	def onConsoleLogout(self, fields):
+		self.logout(fields["name"])
+	def onConsoleAction(self, fields):
+		name = self.stripSpecial(fields["name"])
+		message = self.stripSpecial(fields["text"] or "")
+		self.wrapper.callEvent("player.action", {"player": self.getPlayer(name), "action": message})
+	def onConsoleSay(self, fields): # /say command
+		name = self.stripSpecial(fields["name"])
+		message = self.stripSpecial(fields["text"] or "")
+		self.wrapper.callEvent("server.say", {"player": name, "message": message, "original": fields["message"]})
+	def onConsoleAchievement(self, fields):
+		self.wrapper.callEvent("player.achievement", {"player": self.stripSpecial(fields["name"]), "achievement": fields["achievement"]})
+	def onConsoleDeath(self, fields):
+		name = self.stripSpecial(fields["name"])
+		self.wrapper.callEvent("player.death", {"player": self.getPlayer(name), "death": fields["death"]})
+	def onConsoleOverloaded(self, fields): # "Can't keep up!"
+		behind = int(fields["behind"]) if fields["behind"] else None
+		skipped = int(fields["skipped"]) if fields["skipped"] else None
+		self.tickMonitor.overloaded(behind, skipped)
+		self.wrapper.metrics.increment("server.lag_warnings")
+		if skipped: self.wrapper.metrics.increment("server.skipped_ticks", skipped)
+		if behind: self.wrapper.metrics.observe("server.tick_lag", behind / 1000.0)
+		self.checkLag()
 	# Event Handlers
 	def messageFromChannel(self, channel, message):
 		if self.config["IRC"]["show-channel-server"]:
@@ -421,6 +676,8 @@ class Server:
 		self.messageFromChannel(channel, "&a%s &rquit: %s" % (nick, message))
 	def onTick(self, payload):
 		""" Called every second, and used for handling cron-like jobs """
+		self.queries.expire()
+		self.checkLag()
 		if self.config["General"]["timed-reboot"]:
 			if time.time() - self.bootTime > self.config["General"]["timed-reboot-seconds"]:
 				if self.config["General"]["timed-reboot-warning-minutes"] > 0:
@@ -433,12 +690,4 @@ class Server:
 						return
 				self.restart("Server is conducting a scheduled reboot. The server will be back momentarily!")
 				self.bootTime = time.time()
-				self.rebootWarnings = 0
-		if time.time() - self.pollSize > 120:
-			if self.worldName == None: return True
-			self.pollSize = time.time()
-			size = 0
-			for i in os.walk(self.worldName):
-				for f in os.listdir(i[0]):
-					size += os.path.getsize(os.path.join(i[0], f))
-			self.worldSize = size
\ No newline at end of file
+				self.rebootWarnings = 0
\ No newline at end of file
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# stubserver.py - a small stand-in for the Minecraft server, for testing and benchmarking Wrapper.py without Java. It prints vanilla-looking console
+# lines (boot, logins, chat, deaths, list, save-all, testforblock), speaks the 1.8 (protocol 47) status/login/play subset over TCP in offline mode, sends a flat
+# chunk grid and a herd of wandering mobs to every player, and takes console commands on stdin.
+#
+# Use it as the server command in wrapper.properties, e.g.: command = python /path/to/src/stubserver.py --entities 100 --chunks 7
+# The port, motd and max-players come from server.properties in the working directory, like the real server. Options:
+#   --port N, --motd TEXT, --max-players N   override server.properties
+#   --chunks N        send an N x N grid of chunks on join (default 5)
+#   --entities N      mobs spawned around spawn, moving every tick (default 20)
+#   --compression N   compression threshold, -1 to disable (default 256)
+#   --boot-time S     seconds to spend "preparing spawn area" (default 1)
+import sys, os, time, socket, threading, random, json, hashlib, uuid, struct, traceback
+from proxy import Packet
+DEATHS = ("fell from a high place", "was slain by Zombie", "drowned", "blew up", "burned to death", "tried to swim in lava", "starved to death", "fell out of the world")
+class Player:
+	""" One connection to the stub. Reads on its own thread; the server's tick thread sends entity traffic and does all the flushing. """
+	def __init__(self, server, sock, addr):
+		self.server = server
+		self.socket = sock
+		self.addr = addr
+		self.packet = Packet(sock, self)
+		self.packet.version = 47
+		self.send = self.packet.send
+		self.read = self.packet.read
+		self.isServer = True
+		self.state = 0
+		self.abort = False
+		self.username = None
+		self.uuid = None
+		self.eid = None
+		self.position = (0.5, 64.0, 0.5)
+		self.lastKeepAlive = time.time()
+	def handle(self):
+		try:
+			while not self.abort:
+				id, original = self.packet.grabPacket()
+				self.parse(id)
+		except (EOFError, socket.error):
+			pass
+		except:
+			if not self.abort: self.server.log("Exception handling a connection from %s: %s" % (self.addr[0], traceback.format_exc().splitlines()[-1]), "WARN")
+		self.close("Disconnected")
+	def close(self, reason="Disconnected"):
+		if self.abort: return
+		self.abort = True
+		try: self.socket.close()
+		except: pass
+		if self.state == 3: self.server.logout(self, reason)
+	def kick(self, reason):
+		if self.state == 3: self.send(0x40, "json", ({"text": reason},))
+		else: self.send(0x00, "json", ({"text": reason},))
+		try: self.packet.flush()
+		except: pass
+		self.close(reason)
+	def parse(self, id):
+		if self.state == 0:
+			if id == 0x00: # Handshake
+				data = self.read("varint:version|string:address|ushort:port|varint:state")
+				self.state = data["state"]
+				if self.state == 2 and not data["version"] == 47:
+					self.kick("Outdated client! I'm still on 1.8")
+			return
+		if self.state == 1: # Status
+			if id == 0x00:
+				self.send(0x00, "string", (json.dumps(self.server.getStatus()),))
+			if id == 0x01:
+				self.send(0x01, "long", (self.read("long:time")["time"],))
+			return
+		if self.state == 2: # Login
+			if id == 0x00:
+				self.username = self.read("string:username")["username"]
+				self.uuid = self.server.offlineUUID(self.username)
+				if len(self.server.players) >= self.server.maxPlayers:
+					self.kick("The server is full!")
+					return
+				if self.server.compression > -1:
+					self.packet.setCompression(self.server.compression)
+				self.send(0x02, "string|string", (str(self.uuid), self.username))
+				self.state = 3
+				self.server.login(self)
+			return
+		if id == 0x00: # Keep Alive
+			self.read("varint:id")
+		if id == 0x01: # Chat Message
+			message = self.read("string:message")["message"]
+			if message.startswith("/"):
+				self.server.command(message[1:], self)
+			else:
+				self.server.log("<%s> %s" % (self.username, message))
+				self.server.broadcast({"translate": "chat.type.text", "with": [self.username, message]})
+		if id in (0x04, 0x06): # Player Position (And Look)
+			data = self.read("double:x|double:y|double:z")
+			self.position = (data["x"], data["y"], data["z"])
+class StubServer:
+	def __init__(self, options):
+		self.properties = self.loadProperties()
+		self.port = int(options.get("port", self.properties.get("server-port", 25565)))
+		self.motd = options.get("motd", self.properties.get("motd", "A Minecraft Server"))
+		self.maxPlayers = int(options.get("max-players", self.properties.get("max-players", 20)))
+		self.levelName = self.properties.get("level-name", "world")
+		self.chunks = int(options.get("chunks", 5))
+		self.entityCount = int(options.get("entities", 20))
+		self.compression = int(options.get("compression", 256))
+		self.bootTime = float(options.get("boot-time", 1))
+
+		self.players = {} # username -> Player
+		self.connections = []
+		self.lock = threading.Lock()
+		self.nextEID = 1
+		self.entities = {} # eid -> [x, y, z] in fixed-point (1/32 block) units
+		self.chunkData = self.buildChunk()
+		self.halt = False
+		self.socket = None
+	def loadProperties(self):
+		properties = {}
+		if not os.path.exists("server.properties"): return properties
+		for line in open("server.properties", "r").read().split("\n"):
+			if line.startswith("#") or "=" not in line: continue
+			key, value = line.split("=", 1)
+			properties[key.strip()] = value.strip()
+		return properties
+	def log(self, message, level="INFO", thread="Server thread"):
+		sys.stdout.write("[%s] [%s/%s]: %s\n" % (time.strftime("%H:%M:%S"), thread, level, message))
+		sys.stdout.flush()
+	def newEID(self):
+		with self.lock:
+			eid = self.nextEID
+			self.nextEID += 1
+			return eid
+	def offlineUUID(self, username):
+		d = bytearray(hashlib.md5("OfflinePlayer:" + username).digest())
+		d[6] = d[6] & 0x0f | 0x30
+		d[8] = d[8] & 0x3f | 0x80
+		return uuid.UUID(bytes=str(d))
+	def getStatus(self):
+		return {"version": {"name": "1.8", "protocol": 47}, "description": {"text": self.motd},
+			"players": {"max": self.maxPlayers, "online": len(self.players),
+				"sample": [{"name": name, "id": str(self.players[name].uuid)} for name in self.players.keys()[:12]]}}
+	def buildChunk(self):
+		""" One 16x16x16 section: four layers of stone, then air, full light, plains biome. The same bytes are sent for every chunk, like a superflat world. """
+		blocks = ("\x10\x00" * 256) * 4 + ("\x00\x00" * 256) * 12
+		return blocks + "\xff" * 2048 + "\xff" * 2048 + "\x01" * 256
+	def start(self):
+		self.log("Starting minecraft server version 1.8")
+		self.log("Loading properties")
+		self.log("Default game type: SURVIVAL")
+		self.log("Generating keypair")
+		self.log("Starting Minecraft server on *:%d" % self.port)
+		try:
+			self.socket = socket.socket()
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.socket.bind(("", self.port))
+			self.socket.listen(50)
+		except:
+			self.log("**** FAILED TO BIND TO PORT!", "WARN")
+			self.log("The exception was: %s" % traceback.format_exc().splitlines()[-1], "WARN")
+			self.log("Perhaps a server is already running on that port?", "WARN")
+			sys.exit(1)
+		self.log("Preparing level \"%s\"" % self.levelName)
+		started = time.time()
+		self.log("Preparing start region for level 0")
+		for percent in (24, 58, 91):
+			time.sleep(self.bootTime / 3)
+			self.log("Preparing spawn area: %d%%" % percent)
+		for i in range(self.entityCount):
+			self.entities[self.newEID()] = [int(random.uniform(-24, 24) * 32), 68 * 32, int(random.uniform(-24, 24) * 32)]
+		self.log("Done (%.3fs)! For help, type \"help\" or \"?\"" % (time.time() - started))
+		for target in (self.listen, self.tick):
+			t = threading.Thread(target=target, args=())
+			t.daemon = True
+			t.start()
+		self.readConsole()
+	def listen(self):
+		while not self.halt:
+			try: sock, addr = self.socket.accept()
+			except: continue
+			player = Player(self, sock, addr)
+			with self.lock: self.connections.append(player)
+			t = threading.Thread(target=player.handle, args=())
+			t.daemon = True
+			t.start()
+	def tick(self):
+		""" 20 ticks per second: mobs wander, keep-alives go out every few seconds, and every connection is flushed. """
+		while not self.halt:
+			start = time.time()
+			moves = []
+			for eid in self.entities:
+				position = self.entities[eid]
+				dx, dz = random.randint(-4, 4), random.randint(-4, 4)
+				position[0] += dx
+				position[2] += dz
+				moves.append((eid, dx, dz))
+			with self.lock:
+				self.connections = [player for player in self.connections if not player.abort]
+				connections = list(self.connections)
+			for player in connections:
+				try:
+					if player.state == 3:
+						for eid, dx, dz in moves:
+							player.send(0x15, "varint|byte|byte|byte|bool", (eid, dx, 0, dz, True))
+						if time.time() - player.lastKeepAlive > 5:
+							player.send(0x00, "varint", (random.randrange(0, 99999),))
+							player.lastKeepAlive = time.time()
+					player.packet.flush()
+				except:
+					player.close("Internal exception: %s" % traceback.format_exc().splitlines()[-1])
+			time.sleep(max(0, 0.05 - (time.time() - start)))
+	def login(self, player):
+		if player.username in self.players:
+			self.players[player.username].kick("You logged in from another location")
+		player.eid = self.newEID()
+		self.log("UUID of player %s is %s" % (player.username, player.uuid), thread="User Authenticator #1")
+		player.send(0x01, "int|ubyte|byte|ubyte|ubyte|string|bool", (player.eid, 0, 0, 1, self.maxPlayers, "flat", False))
+		player.send(0x05, "position", ((0, 64, 0),))
+		player.send(0x08, "double|double|double|float|float|byte", (0.5, 64.0, 0.5, 0.0, 0.0, 0))
+		radius = self.chunks / 2
+		for x in range(-radius, self.chunks - radius):
+			for z in range(-radius, self.chunks - radius):
+				player.send(0x21, "int|int|bool|ushort|varint|raw", (x, z, True, 1, len(self.chunkData), self.chunkData))
+		for eid in self.entities:
+			x, y, z = self.entities[eid]
+			player.send(0x0f, "varint|ubyte|int|int|int|byte|byte|byte|short|short|short|raw", (eid, 90, x, y, z, 0, 0, 0, 0, 0, 0, "\x7f")) # pigs
+		self.players[player.username] = player
+		self.log("%s[/%s:%d] logged in with entity id %d at (0.5, 64.0, 0.5)" % (player.username, player.addr[0], player.addr[1], player.eid))
+		self.log("%s joined the game" % player.username)
+		self.broadcast({"translate": "multiplayer.player.joined", "with": [player.username], "color": "yellow"})
+	def logout(self, player, reason):
+		if not self.players.get(player.username) == player: return
+		del self.players[player.username]
+		self.log("%s lost connection: TextComponent{text='%s', siblings=[], style=Style{hasParent=false, color=null, bold=null, italic=null, underlined=null, obfuscated=null, clickEvent=null, hoverEvent=null, insertion=null}}" % (player.username, reason))
+		self.log("%s left the game" % player.username)
+		self.broadcast({"translate": "multiplayer.player.left", "with": [player.username], "color": "yellow"})
+	def broadcast(self, message):
+		for name in self.players.keys():
+			player = self.players.get(name)
+			if player: player.send(0x02, "string|byte", (json.dumps(message), 0))
+	def message(self, sender, text):
+		""" Command feedback: the console gets a log line, a player gets a chat message. """
+		if sender == None: self.log(text)
+		else: sender.send(0x02, "string|byte", (json.dumps({"text": text}), 0))
+	def command(self, line, sender=None):
+		""" Handles the handful of vanilla commands Wrapper.py and its plugins use. """
+		args = line.strip().split(" ")
+		command = args[0].lower()
+		if command == "": return
+		if command == "stop":
+			self.log("Stopping the server")
+			self.log("Stopping server")
+			self.log("Saving players")
+			for player in self.players.values(): player.kick("Server closed")
+			self.log("Saving worlds")
+			self.log("Saving chunks for level '%s'/Overworld" % self.levelName)
+			self.halt = True
+		elif command == "say" and len(args) > 1:
+			name = "Server"
+			if sender: name = sender.username
+			self.log("[%s] %s" % (name, " ".join(args[1:])))
+			self.broadcast({"translate": "chat.type.announcement", "with": [name, " ".join(args[1:])]})
+		elif command == "tellraw" and len(args) > 2:
+			try: message = json.loads(" ".join(args[2:]))
+			except: return self.message(sender, "Invalid json: %s" % traceback.format_exc().splitlines()[-1])
+			if args[1] == "@a": targets = self.players.values()
+			else: targets = [self.players[args[1]]] if args[1] in self.players else []
+			for player in targets: player.send(0x02, "string|byte", (json.dumps(message), 0))
+		elif command == "list":
+			self.message(sender, "There are %d/%d players online:" % (len(self.players), self.maxPlayers))
+			self.message(sender, ", ".join(self.players.keys()))
+		elif command == "kick" and len(args) > 1:
+			if args[1] not in self.players: return self.message(sender, "That player cannot be found")
+			reason = " ".join(args[2:]) or "Kicked by an operator."
+			self.players[args[1]].kick(reason)
+			self.message(sender, "Kicked %s from the game: '%s'" % (args[1], reason))
+		elif command == "kill":
+			name = args[1] if len(args) > 1 else (sender.username if sender else None)
+			if name not in self.players: return self.message(sender, "That player cannot be found")
+			self.log("%s %s" % (name, random.choice(DEATHS)))
+			self.message(sender, "Killed %s" % name)
+		elif command == "save-all":
+			self.message(sender, "Saving...")
+			self.message(sender, "Saved the world")
+		elif command in ("save-on", "save-off"):
+			self.message(sender, "Turned %s world auto-saving" % ("on" if command == "save-on" else "off"))
+		elif command == "testforblock" and len(args) > 4:
+			try: x, y, z = int(args[1]), int(args[2]), int(args[3])
+			except ValueError: return self.message(sender, "Invalid coordinates")
+			names = {"minecraft:stone": "Stone", "minecraft:air": "Air"}
+			block = "Stone" if y > -1 and y < 4 else "Air" # the superflat world from buildChunk, everywhere
+			expected = names.get(args[4], args[4])
+			if block == expected: self.message(sender, "Successfully found the block at %d,%d,%d." % (x, y, z))
+			else: self.message(sender, "The block at %d,%d,%d is %s (expected: %s)." % (x, y, z, block, expected))
+		elif command in ("help", "?"):
+			self.message(sender, "--- Showing help page 1 of 1 (/help <page>) ---")
+			for name in ("help", "kick", "kill", "list", "save-all", "save-off", "save-on", "say", "stop", "tellraw", "testforblock"):
+				self.message(sender, "/%s" % name)
+		else:
+			self.message(sender, "Unknown command. Try /help for a list of commands")
+	def readConsole(self):
+		while not self.halt:
+			line = sys.stdin.readline()
+			if len(line) == 0: # stdin closed - the wrapper went away
+				self.command("stop")
+				break
+			self.command(line)
+		time.sleep(0.2) # let the kick messages flush
+def parseOptions(argv):
+	options = {}
+	i = 0
+	while i < len(argv):
+		if argv[i].startswith("--") and i + 1 < len(argv):
+			options[argv[i][2:]] = argv[i + 1]
+			i += 1
+		i += 1
+	return options
+if __name__ == "__main__":
+	StubServer(parseOptions(sys.argv[1:])).start()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# tickmonitor.py - estimates the server's tick health from the outside. The server warns "Can't keep up! ... Running 2345ms behind, skipping
+# 46 tick(s)" when it falls more than two seconds behind, and those skipped ticks are ticks that didn't happen: over a window of W seconds
+# the server managed 20 - skipped / W ticks per second. That misses lag that stays under the two seconds, so optionally the wrapper also
+# probes with a console command now and then, which the server only answers on its next tick; the reply time is a direct measure of tick delay.
+import threading, time, collections
+TICKS_PER_SECOND = 20
+WINDOWS = ((60, "1m"), (300, "5m"), (900, "15m"))
+class TickMonitor:
+	def __init__(self):
+		self.warnings = collections.deque() # (time, ms behind or None, ticks skipped or None)
+		self.probes = collections.deque() # (time, seconds to answer)
+		self.started = None # when the server finished booting; windows don't reach back past it
+		self.lagging = False
+		self.lock = threading.Lock()
+	def reset(self, now=None):
+		""" Called when the server has (re)started. """
+		with self.lock:
+			self.warnings.clear()
+			self.probes.clear()
+			self.started = now or time.time()
+			self.lagging = False
+	def overloaded(self, behind, skipped, now=None):
+		""" A "Can't keep up!" line. Servers before 1.8 don't say how far behind they are, so behind and skipped are None there; those warnings
+		are counted but don't lower the TPS estimate. """
+		with self.lock:
+			self.warnings.append((now or time.time(), behind, skipped))
+	def probe(self, latency, now=None):
+		with self.lock:
+			self.probes.append((now or time.time(), latency))
+	def prune(self, now):
+		oldest = now - WINDOWS[-1][0]
+		while self.warnings and self.warnings[0][0] < oldest: self.warnings.popleft()
+		while self.probes and self.probes[0][0] < oldest: self.probes.popleft()
+	def getTPS(self, window, now=None):
+		""" Estimated ticks per second over the last 'window' seconds, or None before the server has started. """
+		if now == None: now = time.time()
+		with self.lock:
+			if self.started == None: return None
+			covered = min(window, now - self.started)
+			if covered <= 0: return float(TICKS_PER_SECOND)
+			skipped = sum(warning[2] or 0 for warning in self.warnings if warning[0] > now - window)
+		return max(0.0, TICKS_PER_SECOND - skipped / float(covered))
+	def getStats(self, now=None):
+		""" TPS per window, plus the last minute's warnings, ticks skipped, most ms behind, and probe reply times in seconds. """
+		if now == None: now = time.time()
+		stats = {"tps": dict((name, self.getTPS(window, now)) for window, name in WINDOWS)}
+		with self.lock:
+			self.prune(now)
+			warnings = [warning for warning in self.warnings if warning[0] > now - 60]
+			probes = [probe[1] for probe in self.probes if probe[0] > now - 60]
+			stats["lagging"] = self.lagging
+		stats["warnings"] = len(warnings)
+		stats["skipped"] = sum(warning[2] or 0 for warning in warnings)
+		stats["behind"] = max([warning[1] for warning in warnings if not warning[1] == None] or [None])
+		stats["probeLatency"] = sum(probes) / len(probes) if probes else None
+		stats["probeLatencyMax"] = max(probes) if probes else None
+		return stats
+	def check(self, tpsThreshold, latencyThreshold, now=None):
+		""" Re-evaluates whether the server is lagging: one-minute TPS under tpsThreshold, or the average probe reply time over the last
+		minute above latencyThreshold seconds (0 leaves probes out of it). Returns the stats if that changed since the last check, else None. """
+		stats = self.getStats(now)
+		tps = stats["tps"]["1m"]
+		if tps == None: return None
+		lagging = tps < tpsThreshold
+		if latencyThreshold > 0 and not stats["probeLatency"] == None and stats["probeLatency"] > latencyThreshold: lagging = True
+		with self.lock:
+			if lagging == self.lagging: return None
+			self.lagging = stats["lagging"] = lagging
+		return stats
@@ -1,5 +1,6 @@
 # Unfinished web UI code. Yeah, I know. The code is awful. Probably not even a HTTP-compliant web server anyways. I just wrote it at like 3AM in like an hour.
-import socket, traceback, zipfile, threading, time, json, random, urlparse, storage, log, urllib, os, md5
+import socket, traceback, zipfile, threading, time, json, random, urlparse, storage, log, urllib, os, md5, proxy, metrics
+from server import COMMAND_ADMIN
 from api import API
 try:
 	import pkg_resources, requests
@@ -28,14 +29,10 @@ class Web:
 		self.api.registerEvent("irc.message", self.onChannelMessage)
 		self.consoleScrollback = []
 		self.chatScrollback = []
-		self.memoryGraph = []
 		self.loginAttempts = 0
 		self.lastAttempt = 0
 		self.disableLogins = 0
 		
-	#	t = threading.Thread(target=self.updateGraph, args=())
-#		t.daemon = True
-#		t.start()
 	def onServerConsole(self, payload):
 		while len(self.consoleScrollback) > 1000:
 			try:
@@ -64,13 +61,6 @@ class Web:
 			try: del self.chatScrollback[0]
 			except: break
 		self.chatScrollback.append((time.time(), {"type": "irc", "payload": payload}))
-	def updateGraph(self):
-		while not self.wrapper.halt:
-			while len(self.memoryGraph) > 200:
-				del self.memoryGraph[0]
-			if self.wrapper.server.getMemoryUsage():
-				self.memoryGraph.append([time.time(), self.wrapper.server.getMemoryUsage()])
-			time.sleep(1)
 	def checkLogin(self, password):
 		if time.time() - self.disableLogins < 60: return False # Threshold for logins
 		if password == self.wrapper.config["Web"]["web-password"]: return True
@@ -300,11 +290,16 @@ class Client:
 			players = []
 			for i in self.wrapper.server.players:
 				player = self.wrapper.server.players[i]
+				bytesSent, bytesReceived = None, None
+				if player.client and player.client.packet:
+					bytesSent, bytesReceived = player.client.packet.bytesSent, player.client.packet.bytesReceived
 				players.append({
 					"name": i, 
 					"loggedIn": player.loggedIn, 
 					"uuid": str(player.uuid),
-					"isOp": player.isOp()
+					"isOp": player.isOp(),
+					"bytesSent": bytesSent,
+					"bytesReceived": bytesReceived
 				})
 			plugins = []
 			for id in self.wrapper.plugins:
@@ -336,10 +331,25 @@ class Client:
 			for line in self.web.chatScrollback:
 				if line[0] > refreshTime:
 					chatScrollback.append(line[1])
-			memoryGraph = []
-			for line in self.web.memoryGraph:
-				if line[0] > refreshTime:
-					memoryGraph.append(line[1])
+			backendStatus = {}
+			compressionCache = None
+			packetStats = []
+			if self.wrapper.proxy:
+				backendStatus = self.wrapper.proxy.status
+				compressionCache = proxy.compressionCache.getStats()
+				compressionCache["levels"] = self.wrapper.proxy.getCompressionStats()
+				stats = self.wrapper.proxy.getPacketStats()
+				for direction in ("clientbound", "serverbound"):
+					for id in stats[direction]:
+						entry = stats[direction][id]
+						handlerTime = None
+						if entry["received"] > 0: handlerTime = entry["handlerTime"] / entry["received"]
+						packetStats.append({"direction": direction, "id": "0x%02x" % id, "received": entry["received"], "sent": entry["sent"],
+							"wireIn": entry["wireIn"], "wireOut": entry["wireOut"], "handlerTime": handlerTime})
+				packetStats.sort(key=lambda entry: -(entry["wireIn"] + entry["wireOut"]))
+				packetStats = packetStats[:15]
+			resources = self.wrapper.server.getResourceUsage() or {}
+			memoryGraph = [sample["rss"] for sample in self.wrapper.server.getResourceHistory(since=refreshTime, points=200)]
 			return {"playerCount": len(self.wrapper.server.players), 
 				"players": players,
 				"plugins": plugins,
@@ -354,11 +364,17 @@ class Client:
 				"server_name": self.wrapper.config["General"]["server-name"],
 				"server_memory": self.wrapper.server.getMemoryUsage(),
 				"server_memory_graph": memoryGraph,
+				"server_cpu": resources.get("cpuPercent"),
+				"server_threads": resources.get("threads"),
 				"world_size": self.wrapper.server.worldSize,
+				"tick_stats": self.wrapper.server.getTickStats(),
+				"backend_status": backendStatus,
+				"compression_cache": compressionCache,
+				"packet_stats": packetStats,
 				"disk_avail": self.wrapper.server.getStorageAvailable(".")}
 		if action == "console":
 			if not self.web.validateKey(get("key")): return EOFError
-			self.wrapper.server.console(get("execute"))
+			self.wrapper.server.console(get("execute"), COMMAND_ADMIN)
 			self.log.warn("[%s] Executed: %s" % (self.addr[0], get("execute")))
 			return True
 		if action == "chat":
@@ -372,14 +388,14 @@ class Client:
 			player = get("player")
 			reason = get("reason")
 			self.log.warn("[%s] %s was kicked with reason: %s" % (self.addr[0], player, reason))
-			self.wrapper.server.console("kick %s %s" % (player, reason))
+			self.wrapper.server.console("kick %s %s" % (player, reason), COMMAND_ADMIN)
 			return True
 		if action == "ban_player":
 			if not self.web.validateKey(get("key")): return EOFError
 			player = get("player")
 			reason = get("reason")
 			self.log.warn("[%s] %s was banned with reason: %s" % (self.addr[0], player, reason))
-			self.wrapper.server.console("ban %s %s" % (player, reason))
+			self.wrapper.server.console("ban %s %s" % (player, reason), COMMAND_ADMIN)
 			return True
 		if action == "change_plugin":
 			if not self.web.validateKey(get("key")): return EOFError
@@ -437,6 +453,18 @@ class Client:
 			except: return ""
 		if request == "/":
 			file = "index.html"
+		elif request.split("?")[0] == "/metrics":
+			key = urlparse.parse_qs(urlparse.urlparse(request).query).get("key", [""])[0]
+			if not self.wrapper.config["Web"]["public-metrics"] and not self.web.validateKey(key):
+				self.headers(status="403 Forbidden")
+				self.write("<h1>403 Forbidden</h1>")
+			else:
+				packetStats = None
+				if self.wrapper.proxy: packetStats = self.wrapper.proxy.getPacketStats()
+				self.headers(contentType="text/plain; version=0.0.4")
+				self.write(metrics.toPrometheus(self.wrapper.metrics.snapshot(), packetStats))
+			self.close()
+			return False
 		elif args(0) == "action":
 			try:
 				self.write(json.dumps(self.handleAction(request)))
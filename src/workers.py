@@ -0,0 +1,271 @@
+# Multi-process proxy mode (experimental). The main process forks proxy-workers processes which each bind the proxy port with SO_REUSEPORT and run their
+# own accept loop, so packet handling isn't limited to the one core the GIL gives us. Plugins, the console and storage stay in the main process; workers
+# reach them over two pipes each: an RPC pipe (worker asks, main answers) and a sync pipe (main pushes server state to the worker). Workers send their
+# metrics and packet stats to the main process every REPORT_INTERVAL seconds, and a worker that exits is reaped and replaced.
+#
+# Known limitations: fork() copies a multi-threaded process, so only the locks and descriptors we know about are reset in the worker (see
+# Workers.afterFork); sockets or files a plugin opened are still inherited. Up to REPORT_INTERVAL seconds of a worker's stats are lost when it dies,
+# and so are its connections. Plugins can't send packets to clients that live in a worker.
+import os, socket, threading, traceback, signal, time, pickle, thread
+from multiprocessing import Pipe
+import api, metrics, proxy as proxyModule
+REPORT_INTERVAL = 5
+RESPAWN_BACKOFF_MAX = 60 # seconds between respawns when workers keep dying right after they start
+def isSupported():
+	return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+def flatten(payload):
+	""" Make an event payload picklable. Player objects are sent by username and turned back into the main process' Player objects on the other side. """
+	if not isinstance(payload, dict): return payload
+	result = {}
+	for key in payload:
+		value = payload[key]
+		if hasattr(value, "username") and not isinstance(value, basestring):
+			result[key] = {"__player__": value.username}
+			continue
+		try:
+			pickle.dumps(value)
+			result[key] = value
+		except:
+			result[key] = str(value)
+	return result
+class RemotePlayer:
+	""" Stand-in for api.player.Player inside a worker. Only carries what the proxy code reads. """
+	def __init__(self, username, uuid, channel=None):
+		self.username = username
+		self.name = username
+		self.uuid = uuid
+		self.channel = channel
+	def hasPermission(self, node):
+		""" Permissions live in the main process, so this asks it. Anything that goes wrong along the way means no. """
+		if self.channel == None: return False
+		try: return self.channel.call("hasPermission", self.username, node)
+		except: return False
+	def __str__(self):
+		return self.username
+class WorkerChannel:
+	""" Worker-side end of the IPC channel. """
+	def __init__(self, proxy, rpc, sync):
+		self.proxy = proxy
+		self.wrapper = proxy.wrapper
+		self.rpc = rpc
+		self.sync = sync
+		self.lock = threading.Lock()
+	def call(self, method, *args):
+		with self.lock:
+			self.rpc.send((method, args))
+			good, result = self.rpc.recv()
+		if not good: raise Exception("Worker call '%s' failed in the main process: %s" % (method, result))
+		return result
+	def callEvent(self, event, payload):
+		return self.call("callEvent", event, flatten(payload))
+	def report(self):
+		""" Sends this worker's metrics and packet stats to the main process, which adds them to its own. """
+		while not self.wrapper.halt:
+			time.sleep(REPORT_INTERVAL)
+			try: self.call("report", os.getpid(), self.wrapper.metrics.report(), self.proxy.collectPacketStats())
+			except: pass # the main process is gone; listen() takes care of exiting
+	def listen(self):
+		""" Applies state pushed from the main process. Exits the worker once the main process goes away. """
+		while True:
+			try:
+				state = self.sync.recv()
+			except (EOFError, IOError):
+				self.wrapper.halt = True
+				os._exit(0)
+			if "addresses" in state: # ban/allow changes made in the main process; the worker's accept loop checks its own copy of the index
+				for action, network, kind in state["addresses"]:
+					if action == "add": self.proxy.addressIndex.add(network, kind)
+					else: self.proxy.addressIndex.remove(network)
+				continue
+			server = self.wrapper.server
+			server.state = state["state"]
+			server.protocolVersion = state["protocolVersion"]
+			server.version = state["version"]
+			server.motd = state["motd"]
+			server.maxPlayers = state["maxPlayers"]
+			server.players = dict((name, RemotePlayer(name, state["players"][name], self)) for name in state["players"])
+			self.proxy.status = state["status"]
+class Workers:
+	""" Main-process side: forks the workers and answers their calls. """
+	def __init__(self, proxy):
+		self.proxy = proxy
+		self.wrapper = proxy.wrapper
+		self.log = proxy.wrapper.log
+		self.api = api.API(self.wrapper, "Workers", internal=True)
+		self.workers = [] # (pid, rpc, sync)
+		self.started = {} # pid -> when it was forked
+		self.failures = 0 # workers in a row that died soon after starting, for the respawn backoff
+		self.syncLock = threading.Lock()
+		self.methods = {
+			"callEvent": self.callEvent,
+			"clientJoined": self.clientJoined,
+			"clientLeft": self.clientLeft,
+			"lookupUUID": proxy.lookupUUID,
+			"lookupUsername": proxy.lookupUsername,
+			"setUUID": proxy.setUUID,
+			"banUUID": proxy.banUUID,
+			"isUUIDBanned": proxy.isUUIDBanned,
+			"isAddressBanned": proxy.isAddressBanned,
+			"setAddressRanges": proxy.setAddressRanges,
+			"pardonAddress": proxy.pardonAddress,
+			"importAddressBans": proxy.importAddressBans,
+			"setSkin": proxy.setSkin,
+			"getStickyBackend": proxy.getStickyBackend,
+			"setStickyBackend": proxy.setStickyBackend,
+			"hasPermission": self.hasPermission,
+			"report": self.report
+		}
+		self.api.registerEvent("server.state", self.onChange)
+		self.api.registerEvent("player.login", self.onChange)
+		self.api.registerEvent("player.logout", self.onChange)
+	def start(self, count):
+		self.log.info("Starting %d proxy worker processes (experimental)" % count)
+		for i in range(count):
+			self.spawn()
+		self.sync()
+	def spawn(self):
+		""" Forks one worker and starts answering its calls. """
+		rpcParent, rpcChild = Pipe()
+		syncParent, syncChild = Pipe()
+		pid = os.fork()
+		if pid == 0:
+			rpcParent.close()
+			syncParent.close()
+			self.run(rpcChild, syncChild)
+			os._exit(0)
+		rpcChild.close()
+		syncChild.close()
+		with self.syncLock:
+			self.workers.append((pid, rpcParent, syncParent))
+			self.started[pid] = time.time()
+		t = threading.Thread(target=self.serve, args=(pid, rpcParent))
+		t.daemon = True
+		t.start()
+	def afterFork(self):
+		""" Runs first thing in a new worker. Only the thread that called fork() exists in the child, so any lock another thread held at that
+		moment would stay locked forever; the ones the proxy code uses are replaced. Descriptors that belong to the main process are closed:
+		a worker holding the server's stdin open would keep the server from ever seeing EOF on it. """
+		for obj in (self.wrapper, self.wrapper.server, self.wrapper.server.queries, self.wrapper.server.tickMonitor, self.wrapper.server.resources,
+				self.proxy, self.proxy.backends, self.proxy.addressIndex, proxyModule.compressionCache):
+			for name, value in vars(obj).items():
+				if isinstance(value, thread.LockType): setattr(obj, name, threading.Lock())
+				elif isinstance(value, threading._RLock): setattr(obj, name, threading.RLock())
+				elif isinstance(value, threading._Condition): setattr(obj, name, threading.Condition())
+		# Counters copied from the main process would be reported back to it twice
+		self.wrapper.metrics = metrics.Metrics()
+		self.proxy.packetTotals = {"clientbound": {}, "serverbound": {}}
+		self.proxy.queueTimes = {"clientbound": metrics.Histogram(), "serverbound": metrics.Histogram()}
+		self.proxy.remotePacketStats = {}
+		closing = []
+		proc = self.wrapper.server.proc
+		if proc: closing += [proc.stdin, proc.stdout, proc.stderr]
+		for service in (getattr(self.wrapper, "web", None), getattr(self.wrapper, "irc", None)):
+			if service and service.socket: closing.append(service.socket)
+		for pid, rpc, sync in self.workers: closing += [rpc, sync] # the pipes to workers forked before this one
+		for item in closing:
+			try: item.close()
+			except: pass
+		self.workers = []
+	def run(self, rpc, sync):
+		""" Entry point of a forked worker. Never returns into the main process' code. """
+		try:
+			signal.signal(signal.SIGINT, signal.SIG_DFL)
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			self.afterFork()
+			proxy = self.proxy
+			proxy.workers = None
+			proxy.clients = []
+			proxy.worker = WorkerChannel(proxy, rpc, sync)
+			self.wrapper.callEvent = proxy.worker.callEvent
+			t = threading.Thread(target=proxy.worker.listen, args=())
+			t.daemon = True
+			t.start()
+			t = threading.Thread(target=proxy.worker.report, args=())
+			t.daemon = True
+			t.start()
+			if proxy.backends.isEnabled() and self.wrapper.config["Backends"]["pool-size"] > 0:
+				t = threading.Thread(target=proxy.backends.replenish, args=())
+				t.daemon = True
+				t.start()
+			proxy.bind(reusePort=True)
+			proxy.listen()
+		except:
+			traceback.print_exc()
+		os._exit(0)
+	def serve(self, pid, rpc):
+		while not self.wrapper.halt:
+			try:
+				method, args = rpc.recv()
+			except (EOFError, IOError):
+				break
+			try:
+				rpc.send((True, self.methods[method](*args)))
+			except:
+				self.log.debug(traceback.format_exc())
+				rpc.send((False, traceback.format_exc().splitlines()[-1]))
+		self.exited(pid)
+	def exited(self, pid):
+		""" Reaps a worker whose RPC pipe closed, keeps the stats it last reported, and forks a replacement - after a delay that doubles
+		each time a worker dies within a minute of starting. """
+		try: status = os.waitpid(pid, 0)[1]
+		except OSError: status = None
+		with self.syncLock:
+			for worker in self.workers:
+				if worker[0] == pid:
+					self.workers.remove(worker)
+					for end in worker[1:]: end.close()
+			lifetime = time.time() - self.started.pop(pid, 0)
+		self.wrapper.metrics.retireRemote(pid)
+		self.proxy.retireRemotePacketStats(pid)
+		for username, info in self.proxy.remoteClients.items(): # its connections died with it
+			if info["worker"] == pid: del self.proxy.remoteClients[username]
+		if self.wrapper.halt: return
+		if status == None: reason = "exited"
+		elif os.WIFSIGNALED(status): reason = "was killed by signal %d" % os.WTERMSIG(status)
+		else: reason = "exited with status %d" % os.WEXITSTATUS(status)
+		if lifetime < 60: self.failures += 1
+		else: self.failures = 0
+		delay = min(RESPAWN_BACKOFF_MAX, 2 ** (self.failures - 1)) if self.failures else 0
+		self.log.error("Proxy worker %d %s - starting another in %d seconds" % (pid, reason, delay))
+		self.wrapper.metrics.increment("proxy.worker_restarts")
+		time.sleep(delay)
+		if self.wrapper.halt: return
+		self.spawn()
+		self.sync()
+	def callEvent(self, event, payload):
+		if isinstance(payload, dict):
+			for key in payload:
+				if isinstance(payload[key], dict) and "__player__" in payload[key]:
+					payload[key] = self.wrapper.server.getPlayer(payload[key]["__player__"])
+		return self.wrapper.callEvent(event, payload)
+	def hasPermission(self, username, node):
+		player = self.wrapper.server.players.get(username)
+		if player == None: return False
+		return player.hasPermission(node)
+	def report(self, pid, metricsReport, packetStats):
+		self.wrapper.metrics.setRemote(pid, metricsReport)
+		self.proxy.setRemotePacketStats(pid, packetStats)
+	def clientJoined(self, username, uuid, serverUUID, ip, pid):
+		self.proxy.remoteClients[username] = {"uuid": uuid, "serverUUID": serverUUID, "ip": ip, "time": time.time(), "worker": pid}
+	def clientLeft(self, username):
+		if username in self.proxy.remoteClients: del self.proxy.remoteClients[username]
+	def onChange(self, payload):
+		self.sync()
+	def syncAddresses(self, changes):
+		""" Push address ban changes to every worker. Workers were forked with a copy of the index, so only the changes need to go over. """
+		with self.syncLock:
+			for pid, rpc, sync in self.workers:
+				try: sync.send({"addresses": changes})
+				except: self.log.debug("Could not sync address bans to proxy worker %d" % pid)
+	def sync(self):
+		""" Push the server state workers need (boot state, version, player list, backend status) to every worker. """
+		server = self.wrapper.server
+		players = {}
+		for name in server.players:
+			players[name] = server.players[name].uuid
+		state = {"state": server.state, "protocolVersion": server.protocolVersion, "version": server.version,
+			"motd": server.motd, "maxPlayers": server.maxPlayers, "players": players, "status": self.proxy.status}
+		with self.syncLock:
+			for pid, rpc, sync in self.workers:
+				try: sync.send(state)
+				except: self.log.debug("Could not sync proxy worker %d" % pid)
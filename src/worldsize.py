@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# worldsize.py - keeps the size of the world folder up to date without walking all of it every time. Each directory's listing is cached
+# along with the directory's mtime, and only directories whose mtime changed (something was created, deleted or renamed in them) are listed
+# again. Files in unchanged directories still get a stat each pass, since region files grow in place without touching their directory's mtime.
+import os, stat
+try:
+	from scandir import scandir # the scandir backport; Python 3.5+ has it as os.scandir
+	IMPORT_SCANDIR_SUCCESS = True
+except ImportError:
+	scandir = getattr(os, "scandir", None)
+	IMPORT_SCANDIR_SUCCESS = not scandir == None
+class Directory:
+	def __init__(self, mtime):
+		self.mtime = mtime
+		self.files = {} # name -> size in bytes
+		self.dirs = []
+		self.total = 0 # this directory and everything under it, as of the last pass
+class SizeTracker:
+	""" Tracks the total size of the files under one directory. update() is meant to run on a background thread; the sizes it leaves behind
+	can be read from anywhere. Symlinks are counted as themselves and not followed, like os.walk does for directories. """
+	def __init__(self, root):
+		self.root = root
+		self.directories = {} # path -> Directory
+		self.size = 0
+		self.listed = 0 # directories listed in the last pass, for the curious
+	def update(self):
+		""" One pass over the tree. Returns the total size in bytes. """
+		seen = set()
+		self.listed = 0
+		self.size = self.visit(self.root, seen)
+		for path in self.directories.keys():
+			if path not in seen: del self.directories[path] # removed since the last pass
+		return self.size
+	def getSize(self, path=None):
+		""" The size of the root or of a directory under it as of the last pass, or None if it wasn't there. """
+		if path == None: return self.size
+		directory = self.directories.get(path)
+		if directory == None: return None
+		return directory.total
+	def visit(self, path, seen):
+		seen.add(path)
+		try: st = os.stat(path) # taken before listing, so a change during the listing shows up as a changed mtime next pass
+		except OSError: return 0
+		mtime = st.st_mtime
+		directory = self.directories.get(path)
+		if directory == None or not directory.mtime == mtime:
+			try: directory = self.list(path, mtime)
+			except OSError: return 0
+			self.directories[path] = directory
+		else:
+			self.refresh(path, directory)
+		total = st.st_size + sum(directory.files.itervalues()) # directories take up space too
+		for name in directory.dirs:
+			total += self.visit(os.path.join(path, name), seen)
+		directory.total = total
+		return total
+	def list(self, path, mtime):
+		self.listed += 1
+		directory = Directory(mtime)
+		if scandir:
+			for entry in scandir(path):
+				try:
+					if entry.is_dir(follow_symlinks=False): directory.dirs.append(entry.name)
+					else: directory.files[entry.name] = entry.stat(follow_symlinks=False).st_size
+				except OSError: pass # deleted since it was listed
+		else:
+			for name in os.listdir(path):
+				try: st = os.lstat(os.path.join(path, name))
+				except OSError: continue
+				if stat.S_ISDIR(st.st_mode): directory.dirs.append(name)
+				else: directory.files[name] = st.st_size
+		return directory
+	def refresh(self, path, directory):
+		""" Re-reads the sizes of a directory's files without listing it again. """
+		for name in directory.files:
+			try: directory.files[name] = os.lstat(os.path.join(path, name)).st_size
+			except OSError: pass # deleted, which also changed the directory's mtime, so it'll be listed again next pass